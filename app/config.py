@@ -1,5 +1,7 @@
+import codecs
 import os
 from dataclasses import dataclass
+from typing import Tuple
 
 
 def _get_env_float(name: str, default: float) -> float:
@@ -23,11 +25,32 @@ def _get_env_bool(name: str, default: bool) -> bool:
     return val.strip().lower() in {"1", "true", "t", "yes", "y", "on"}
 
 
+def _get_env_int_tuple(name: str, default: Tuple[int, ...]) -> Tuple[int, ...]:
+    val = os.getenv(name)
+    if val is None:
+        return default
+    try:
+        return tuple(int(v) for v in val.split(",") if v.strip())
+    except Exception:
+        return default
+
+
 def _get_env_str(name: str, default: str) -> str:
     val = os.getenv(name)
     return val if val is not None else default
 
 
+def _get_env_str_tuple(name: str, default: Tuple[str, ...]) -> Tuple[str, ...]:
+    # Comma-separated, with backslash escapes such as \n decoded
+    val = os.getenv(name)
+    if val is None:
+        return default
+    try:
+        return tuple(codecs.decode(v, "unicode_escape") for v in val.split(",") if v)
+    except Exception:
+        return default
+
+
 @dataclass
 class GenerationConfig:
     # Decoding
@@ -35,10 +58,57 @@ class GenerationConfig:
     temperature: float = 0.2
     top_p: float = 0.95
     top_k: int = 50
+    # Sample with the built-in decode loop (app/decode.py) instead of HF generate
+    lean_decode: bool = True
+    # Speculative decoding with a small draft MPT sharing the tokenizer ("" disables)
+    draft_model: str = ""
+    speculative_tokens: int = 4
+    # Without a draft model, propose continuations from an n-gram index of the prompt and past jobs
+    ngram_speculation: bool = False
+    ngram_index_entries: int = 200_000
+    # Stop a sequence once it emits one of these strings, or once the code is complete Python
+    # and the next line is not (see app/stopping.py)
+    stop_strings: Tuple[str, ...] = ("\n```\n", "\nTask:")
+    stop_when_complete: bool = False
     # Prompt/tokenization
     max_input_tokens: int = 1024
+    # KV cache: "dynamic" (grown per step), "static" (preallocated per sequence),
+    # "paged" (blocks from a pool shared by concurrent jobs), "sink" (first
+    # kv_sink_tokens plus a sliding window, for generating past the context length)
+    # "heavy_hitter" (sliding window plus the kv_heavy_tokens most-attended tokens)
+    # or "int8" (preallocated, K/V quantized to int8). Only registry caches (not "dynamic")
+    # take the model's single-token decode fast path
+    kv_cache: str = "static"
+    kv_block_size: int = 16
+    kv_num_blocks: int = 0  # 0 = enough for max_concurrency jobs of the longest prompt and completion
+    max_concurrency: int = 1  # concurrent generations allowed by app/main.py
+    kv_sink_tokens: int = 4
+    kv_window_size: int = 0  # 0 = a half (sink) or a quarter (heavy_hitter) of max_seq_len
+    kv_heavy_tokens: int = 0  # 0 = a quarter of max_seq_len
+    # Feed long prompts through the model this many tokens at a time (0 = whole prompt)
+    prefill_chunk_size: int = 0
+    # Prompt prefix K/V shared across requests (0 disables), optionally persisted
+    prefix_cache_mb: int = 0
+    prefix_cache_path: str = ""
     # Model loading
     use_fp16_if_available: bool = True
+    # torch.compile the transformer blocks, warmed up for prompts padded to these lengths
+    compile_model: bool = False
+    compile_buckets: Tuple[int, ...] = (128, 256, 512, 1024)
+    optimize_model: bool = False  # strip dropout, fold norms into linears, prepack weights for oneDNN
+    cpu_dtype: str = "fp32"  # "bf16" halves weight memory and uses bf16 matmuls on CPUs that support them
+    # Map *.safetensors checkpoints instead of reading them (see app/convert_checkpoint.py)
+    mmap_weights: bool = True
+    # Stream MPT blocks from the local checkpoint, keeping this many resident (0 = load everything)
+    layer_streaming_window: int = 0
+    # Weight-only quantization applied at load time: 0 (off), 8 or 4 bits
+    weight_bits: int = 0
+    weight_group_size: int = 128
+    # "torch" runs the model with PyTorch; "onnx" runs the graphs in onnx_dir with
+    # onnxruntime on CPU (export them with app/export_onnx.py)
+    backend: str = "torch"
+    onnx_dir: str = ""  # "" = <model_local_dir>/onnx
+    attn_impl: str = ""  # override the checkpoint's attn_impl, e.g. "sdpa" for the fused CPU kernel
     model_local_dir: str = "replit-code-v1-3b"
     model_id: str = "replit/replit-code-v1-3b"
     trust_remote_code: bool = True
@@ -50,8 +120,36 @@ def load_config() -> GenerationConfig:
         temperature=_get_env_float("GEN_TEMPERATURE", 0.2),
         top_p=_get_env_float("GEN_TOP_P", 0.95),
         top_k=_get_env_int("GEN_TOP_K", 50),
+        lean_decode=_get_env_bool("GEN_LEAN_DECODE", True),
+        draft_model=_get_env_str("GEN_DRAFT_MODEL", ""),
+        speculative_tokens=_get_env_int("GEN_SPECULATIVE_TOKENS", 4),
+        ngram_speculation=_get_env_bool("GEN_NGRAM_SPECULATION", False),
+        ngram_index_entries=_get_env_int("GEN_NGRAM_INDEX_ENTRIES", 200_000),
+        stop_strings=_get_env_str_tuple("GEN_STOP_STRINGS", ("\n```\n", "\nTask:")),
+        stop_when_complete=_get_env_bool("GEN_STOP_WHEN_COMPLETE", False),
         max_input_tokens=_get_env_int("GEN_MAX_INPUT_TOKENS", 1024),
+        kv_cache=_get_env_str("GEN_KV_CACHE", "static"),
+        kv_block_size=_get_env_int("GEN_KV_BLOCK_SIZE", 16),
+        kv_num_blocks=_get_env_int("GEN_KV_NUM_BLOCKS", 0),
+        max_concurrency=_get_env_int("APP_MAX_CONCURRENCY", 1),
+        kv_sink_tokens=_get_env_int("GEN_KV_SINK_TOKENS", 4),
+        kv_window_size=_get_env_int("GEN_KV_WINDOW_SIZE", 0),
+        kv_heavy_tokens=_get_env_int("GEN_KV_HEAVY_TOKENS", 0),
+        prefill_chunk_size=_get_env_int("GEN_PREFILL_CHUNK_SIZE", 0),
+        prefix_cache_mb=_get_env_int("GEN_PREFIX_CACHE_MB", 0),
+        prefix_cache_path=_get_env_str("GEN_PREFIX_CACHE_PATH", ""),
         use_fp16_if_available=_get_env_bool("USE_FP16", True),
+        cpu_dtype=_get_env_str("GEN_CPU_DTYPE", "fp32"),
+        optimize_model=_get_env_bool("GEN_OPTIMIZE_MODEL", False),
+        compile_model=_get_env_bool("GEN_COMPILE_MODEL", False),
+        compile_buckets=_get_env_int_tuple("GEN_COMPILE_BUCKETS", (128, 256, 512, 1024)),
+        mmap_weights=_get_env_bool("GEN_MMAP_WEIGHTS", True),
+        layer_streaming_window=_get_env_int("GEN_LAYER_STREAMING_WINDOW", 0),
+        weight_bits=_get_env_int("GEN_WEIGHT_BITS", 0),
+        weight_group_size=_get_env_int("GEN_WEIGHT_GROUP_SIZE", 128),
+        backend=_get_env_str("GEN_BACKEND", "torch"),
+        onnx_dir=_get_env_str("GEN_ONNX_DIR", ""),
+        attn_impl=_get_env_str("GEN_ATTN_IMPL", ""),
         model_local_dir=_get_env_str("MODEL_LOCAL_DIR", "replit-code-v1-3b"),
         model_id=_get_env_str("MODEL_ID", "replit/replit-code-v1-3b"),
         trust_remote_code=_get_env_bool("TRUST_REMOTE_CODE", True),
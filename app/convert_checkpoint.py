@@ -0,0 +1,33 @@
+"""Convert a checkpoint to a single safetensors file in the given dtype.
+
+The app memory-maps *.safetensors checkpoints (GEN_MMAP_WEIGHTS), so workers
+start without deserializing or copying weights and share page-cache pages:
+
+    python -m app.convert_checkpoint --dtype bf16 --output replit-code-v1-3b-bf16
+    MODEL_LOCAL_DIR=replit-code-v1-3b-bf16 uvicorn app.main:app
+"""
+import argparse
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--output", required=True, help="Directory to write the converted checkpoint to")
+    parser.add_argument("--dtype", default="bf16", choices=list(DTYPES))
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model, trust_remote_code=True, torch_dtype=DTYPES[args.dtype])
+    # One unsharded file keeps every tensor in a single mapping
+    model.save_pretrained(args.output, safe_serialization=True, max_shard_size="1000GB")
+    tokenizer.save_pretrained(args.output)
+    print(f"wrote {args.dtype} safetensors checkpoint to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
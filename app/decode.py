@@ -0,0 +1,238 @@
+import inspect
+from typing import Callable, Optional, Union
+
+import torch
+
+from .sampling import PerRow, sample_tokens, token_probs
+from .speculative import crop_cache
+
+
+def past_length(past_key_values) -> int:
+    # Tokens already in a registry KV cache or a legacy list of (key, value) tuples
+    if past_key_values is None or len(past_key_values) == 0:
+        return 0
+    if hasattr(past_key_values, "seen_tokens"):
+        return past_key_values.seen_tokens
+    layer_past = past_key_values[0]
+    return layer_past[0].size(1) if len(layer_past) else 0
+
+
+def expand_cache(past_key_values, num_sequences: int):
+    # Repeat each cached sequence num_sequences times; registry caches share or copy in place
+    if hasattr(past_key_values, "expand"):
+        past_key_values.expand(num_sequences)
+        return past_key_values
+    return [
+        tuple(t.expand(num_sequences, *t.shape[1:]) if t.size(0) == 1 else t.repeat_interleave(num_sequences, dim=0) for t in layer_past)
+        for layer_past in past_key_values
+    ]
+
+
+def repeat_per_row(value: PerRow, num_sequences: int) -> PerRow:
+    if isinstance(value, torch.Tensor) and value.dim() > 0:
+        return value.repeat_interleave(num_sequences, dim=0)
+    return value
+
+
+class DecodeEngine:
+    """
+    Sampling loop that drives the model's forward directly instead of HF `generate`.
+
+    Each step is one forward over the new tokens against the KV cache, one vectorized
+    `sample_tokens` call with per-row temperature/top-k/top-p and an in-place write into
+    preallocated token and mask buffers. There is no logits-processor chain, no
+    `prepare_inputs_for_generation` and no full-vocabulary sort.
+
+    With a `proposer` (see app/speculative.py), single-sequence requests decode
+    speculatively: the proposer suggests up to `num_speculative_tokens` tokens, the model
+    scores them all in one forward and rejection sampling keeps the output distribution
+    exactly that of the model. Counters of the last call are kept in `stats`.
+
+    With `num_return_sequences` > 1 the prompt is prefilled once and its K/V fanned out
+    to every sample (copy-on-write for the paged cache); only the decode steps run batched.
+    """
+
+    def __init__(
+        self,
+        model,
+        eos_token_id: Optional[int] = None,
+        pad_token_id: Optional[int] = None,
+        proposer=None,
+        num_speculative_tokens: int = 4,
+    ):
+        self.model = model
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id if pad_token_id is not None else eos_token_id
+        self.proposer = proposer
+        self.num_speculative_tokens = num_speculative_tokens
+        self.stats = {}
+        self._forward_kwargs = {}
+        if "logits_to_keep" in inspect.signature(model.forward).parameters:
+            self._forward_kwargs["logits_to_keep"] = 1
+
+    def _init_cache(self, max_seq_len: int):
+        decoder = self.model.get_decoder() if hasattr(self.model, "get_decoder") else None
+        if decoder is None or not hasattr(decoder, "init_kv_cache"):
+            return None
+        return decoder.init_kv_cache(max_seq_len=max_seq_len)
+
+    @torch.no_grad()
+    def generate(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        past_key_values=None,
+        max_new_tokens: int = 128,
+        temperature: PerRow = 1.0,
+        top_k: PerRow = 0,
+        top_p: PerRow = 1.0,
+        generator: Optional[torch.Generator] = None,
+        num_return_sequences: int = 1,
+        stopping_criteria: Optional[Callable[[torch.Tensor], Union[bool, torch.Tensor]]] = None,
+    ) -> torch.Tensor:
+        """
+        Returns `input_ids` followed by the generated tokens, shaped like HF `generate`.
+
+        `past_key_values` may already hold a prefix of `input_ids` (e.g. from the prefix
+        cache); only the remaining tokens are prefilled. Rows that emit EOS are padded
+        with `pad_token_id` until every row has finished. With `num_return_sequences` > 1
+        each row yields that many consecutive samples, as in HF `generate`.
+        `stopping_criteria` is called with the token ids so far after every step (every
+        verification round when decoding speculatively) and returns True, or a per-row
+        bool tensor, for the rows to finish.
+        """
+        batch, prompt_len = input_ids.shape
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if self.proposer is not None and batch * num_return_sequences == 1 and self.num_speculative_tokens > 0:
+            return self._generate_speculative(
+                input_ids, attention_mask, past_key_values, max_new_tokens, temperature, top_k, top_p, generator, stopping_criteria
+            )
+        self.stats = {"forwards": 0, "proposed": 0, "accepted": 0}
+        if past_key_values is None:
+            past_key_values = self._init_cache(prompt_len + max_new_tokens)
+        logits = None
+        if num_return_sequences > 1:
+            # Prefill once, then decode every sample against copies of the prompt K/V
+            out = self.model(
+                input_ids=input_ids[:, past_length(past_key_values):],
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+                **self._forward_kwargs,
+            )
+            self.stats["forwards"] += 1
+            past_key_values = expand_cache(out.past_key_values, num_return_sequences)
+            logits = out.logits[:, -1].repeat_interleave(num_return_sequences, dim=0)
+            input_ids = input_ids.repeat_interleave(num_return_sequences, dim=0)
+            attention_mask = attention_mask.repeat_interleave(num_return_sequences, dim=0)
+            temperature, top_k, top_p = (repeat_per_row(v, num_return_sequences) for v in (temperature, top_k, top_p))
+            batch *= num_return_sequences
+        # Fixed buffers, sliced per step instead of concatenated
+        mask = attention_mask.new_ones(batch, prompt_len + max_new_tokens)
+        mask[:, :prompt_len] = attention_mask
+        tokens = input_ids.new_full((batch, max_new_tokens), self.pad_token_id if self.pad_token_id is not None else 0)
+        finished = torch.zeros(batch, dtype=torch.bool, device=input_ids.device)
+        step_input = input_ids[:, past_length(past_key_values):]
+        generated = 0
+        for step in range(max_new_tokens):
+            if logits is None:
+                out = self.model(
+                    input_ids=step_input,
+                    attention_mask=mask[:, : prompt_len + step],
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    **self._forward_kwargs,
+                )
+                past_key_values = out.past_key_values
+                self.stats["forwards"] += 1
+                logits = out.logits[:, -1]
+            next_token = sample_tokens(logits, temperature, top_k, top_p, generator=generator)
+            logits = None
+            if self.eos_token_id is not None:
+                next_token = next_token.masked_fill(finished, self.pad_token_id)
+                finished |= next_token == self.eos_token_id
+            tokens[:, step] = next_token
+            generated = step + 1
+            if stopping_criteria is not None:
+                stop = stopping_criteria(torch.cat([input_ids, tokens[:, :generated]], dim=1))
+                finished |= torch.as_tensor(stop, device=finished.device).expand(batch)
+            if (self.eos_token_id is not None or stopping_criteria is not None) and bool(finished.all()):
+                break
+            step_input = next_token[:, None]
+        return torch.cat([input_ids, tokens[:, :generated]], dim=1)
+
+    @torch.no_grad()
+    def _generate_speculative(self, input_ids, attention_mask, past_key_values, max_new_tokens, temperature, top_k, top_p, generator, stopping_criteria=None):
+        prompt_len = input_ids.size(1)
+        k = self.num_speculative_tokens
+        capacity = prompt_len + max_new_tokens + k + 1
+        if past_key_values is None:
+            past_key_values = self._init_cache(capacity)
+        mask = attention_mask.new_ones(1, capacity)
+        mask[:, :prompt_len] = attention_mask
+        seq = input_ids.new_empty(1, capacity)
+        seq[:, :prompt_len] = input_ids
+        length = prompt_len
+        cached = past_length(past_key_values)
+        self.proposer.reset(capacity)
+        self.stats = {"forwards": 0, "proposed": 0, "accepted": 0}
+        while length < prompt_len + max_new_tokens:
+            # The model also emits one token of its own, so never overshoot max_new_tokens
+            n_draft = min(k, prompt_len + max_new_tokens - length - 1)
+            drafts, draft_probs = input_ids.new_empty(0), None
+            if n_draft > 0:
+                drafts, draft_probs = self.proposer.propose(seq[:, :length], mask, n_draft, temperature, top_k, top_p, generator=generator)
+            n_draft = drafts.numel()
+            feed = torch.cat([seq[:, cached:length], drafts[None]], dim=1)
+            forward_kwargs = {"logits_to_keep": n_draft + 1} if self._forward_kwargs else {}
+            out = self.model(
+                input_ids=feed,
+                attention_mask=mask[:, : cached + feed.size(1)],
+                past_key_values=past_key_values,
+                use_cache=True,
+                **forward_kwargs,
+            )
+            past_key_values = out.past_key_values
+            self.stats["forwards"] += 1
+            probs = token_probs(out.logits[0, -(n_draft + 1):], temperature, top_k, top_p)
+            accepted, next_token = 0, None
+            for i in range(n_draft):
+                token = drafts[i]
+                q = draft_probs[i, token] if draft_probs is not None else 1.0
+                if torch.rand((), generator=generator) * q < probs[i, token]:
+                    accepted += 1
+                    continue
+                # Rejected: resample from the part of the model's distribution the proposer under-weights
+                if draft_probs is not None:
+                    residual = (probs[i] - draft_probs[i]).clamp_min(0)
+                else:
+                    residual = probs[i].clone()
+                    residual[token] = 0
+                if residual.sum() <= 0:
+                    residual = probs[i]
+                next_token = torch.multinomial(residual, 1, generator=generator)[0]
+                break
+            if next_token is None:
+                next_token = torch.multinomial(probs[n_draft], 1, generator=generator)[0]
+            self.stats["proposed"] += n_draft
+            self.stats["accepted"] += accepted
+            # Keep K/V of the committed tokens only; the new token is fed next round
+            cached = length + accepted
+            crop_cache(past_key_values, cached)
+            self.proposer.rollback(cached)
+            new_tokens = torch.cat([drafts[:accepted], next_token[None]])
+            finished = False
+            if self.eos_token_id is not None:
+                hits = (new_tokens == self.eos_token_id).nonzero()
+                if hits.numel():
+                    new_tokens = new_tokens[: int(hits[0, 0]) + 1]
+                    finished = True
+            seq[0, length:length + new_tokens.numel()] = new_tokens
+            length += new_tokens.numel()
+            if stopping_criteria is not None:
+                # A round commits several tokens; the criteria see them all at once
+                finished = finished or bool(torch.as_tensor(stopping_criteria(seq[:, :length])).all())
+            if finished:
+                break
+        return seq[:, :length].clone()
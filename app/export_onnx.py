@@ -0,0 +1,28 @@
+"""Export the model to ONNX prefill/decode graphs for the onnxruntime backend.
+
+    python -m app.export_onnx --output replit-code-v1-3b/onnx
+    GEN_BACKEND=onnx uvicorn app.main:app
+"""
+import argparse
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--output", required=True, help="Directory to write prefill.onnx, decode.onnx and onnx_config.json to")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    config = AutoConfig.from_pretrained(args.model, trust_remote_code=True)
+    # The graphs are traced through the plain torch attention path
+    config.attn_config = {**config.attn_config, "attn_impl": "torch"}
+    model = AutoModelForCausalLM.from_pretrained(args.model, config=config, trust_remote_code=True, torch_dtype=torch.float32)
+    paths = model.export_onnx(args.output, opset=args.opset)
+    print(f"wrote {paths['prefill']} and {paths['decode']}")
+
+
+if __name__ == "__main__":
+    main()
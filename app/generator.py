@@ -1,12 +1,19 @@
 import os
 import asyncio
-from typing import Optional
+import inspect
+from typing import List, Optional
 
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, GenerationConfig
 
 from .config import load_config
+from .decode import DecodeEngine
+from .onnx_engine import OnnxCausalLM
+from .mmap_loader import load_safetensors_mmap, safetensors_files
 from .postprocess import clean_code_markers
+from .prefix_cache import PrefixKVCache
+from .speculative import BOILERPLATE_SEEDS, DraftModelProposer, NgramIndex, NgramProposer
+from .stopping import CodeStoppingCriteria, StopStringMatcher, token_pieces
 
 
 class CodeGenerator:
@@ -15,10 +22,24 @@ class CodeGenerator:
         self.model_path = model_path
         self._tokenizer: Optional[AutoTokenizer] = None
         self._model: Optional[AutoModelForCausalLM] = None
+        self._onnx: Optional[OnnxCausalLM] = None
+        self._decode: Optional[DecodeEngine] = None
+        self._stop_matcher: Optional[StopStringMatcher] = None
         self._cfg = load_config()
+        self._forward_kwargs = {}
+        self._prefix_cache: Optional[PrefixKVCache] = None
+        if self._cfg.prefix_cache_mb > 0:
+            self._prefix_cache = PrefixKVCache(max_bytes=self._cfg.prefix_cache_mb * 1024 * 1024)
+        # Token n-grams of finished jobs, shared by every request's speculative proposer
+        self._ngram_index: Optional[NgramIndex] = None
+        if self._cfg.ngram_speculation:
+            self._ngram_index = NgramIndex(max_entries=self._cfg.ngram_index_entries)
 
     def _ensure_loaded(self):
-        if self._tokenizer is not None and self._model is not None:
+        if self._tokenizer is not None and (self._model is not None or self._onnx is not None):
+            return
+        if self._cfg.backend == "onnx":
+            self._load_onnx()
             return
 
         # Prefer env-configured paths, then provided model_path, then HF hub
@@ -28,26 +49,286 @@ class CodeGenerator:
             try:
                 self._tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=self._cfg.trust_remote_code)
                 use_fp16 = torch.cuda.is_available() and self._cfg.use_fp16_if_available
-                dtype = torch.float16 if use_fp16 else None
-                self._model = AutoModelForCausalLM.from_pretrained(
-                    path,
-                    trust_remote_code=self._cfg.trust_remote_code,
-                    torch_dtype=dtype,
-                )
-                if torch.cuda.is_available():
+                # Explicit fp32 otherwise, so a reduced-precision checkpoint is not mapped as stored
+                dtype = torch.float16 if use_fp16 else torch.float32
+                if not torch.cuda.is_available() and self._cfg.cpu_dtype == "bf16":
+                    # Linears run in bf16; norms and attention softmax upcast to fp32 internally
+                    dtype = torch.bfloat16
+                model_config = AutoConfig.from_pretrained(path, trust_remote_code=self._cfg.trust_remote_code)
+                if self._cfg.attn_impl:
+                    model_config.attn_config = {**model_config.attn_config, "attn_impl": self._cfg.attn_impl}
+                self._model = None
+                if self._cfg.layer_streaming_window > 0 and os.path.isdir(path):
+                    self._model = self._load_streaming(path, model_config, dtype)
+                elif self._cfg.mmap_weights and safetensors_files(path):
+                    self._model = self._load_mmap(path, model_config, dtype)
+                if self._model is None:
+                    self._model = AutoModelForCausalLM.from_pretrained(
+                        path,
+                        config=model_config,
+                        trust_remote_code=self._cfg.trust_remote_code,
+                        torch_dtype=dtype,
+                    )
+                streaming = getattr(self._model.get_decoder(), "block_streamer", None) is not None
+                if torch.cuda.is_available() and not streaming:
                     self._model = self._model.to("cuda")
                 self._model.eval()
+                if not streaming:
+                    # Streamed blocks are read as stored; quantize the checkpoint instead (app/quantize.py)
+                    self._quantize_weights()
+                    self._optimize_model()
+                # The compile warmup builds the cache configured here
+                self._configure_kv_cache()
+                if not streaming:
+                    self._compile_model()
+                self._forward_kwargs = {}
+                if "logits_to_keep" in inspect.signature(self._model.forward).parameters:
+                    # Prefill only needs the cache, not a full (seq x vocab) logits tensor
+                    self._forward_kwargs["logits_to_keep"] = 1
+                self._load_prefix_cache()
+                self._decode = None
+                if self._cfg.lean_decode and hasattr(self._model, "get_decoder"):
+                    self._decode = DecodeEngine(
+                        self._model,
+                        eos_token_id=self._tokenizer.eos_token_id,
+                        pad_token_id=self._tokenizer.pad_token_id,
+                        proposer=self._load_proposer(dtype),
+                        num_speculative_tokens=self._cfg.speculative_tokens,
+                    )
+                self._stop_matcher = None
+                if self._decode is not None and (self._cfg.stop_strings or self._cfg.stop_when_complete):
+                    # Token pieces of the whole vocabulary, computed once per model
+                    self._stop_matcher = StopStringMatcher(self._cfg.stop_strings, token_pieces(self._tokenizer))
                 return
             except Exception as e:
                 last_err = e
                 self._tokenizer = None
                 self._model = None
+                self._decode = None
                 continue
         # If all attempts failed, re-raise the last error
         if last_err:
             raise last_err
 
+    def _load_onnx(self):
+        onnx_dir = self._cfg.onnx_dir or os.path.join(self._cfg.model_local_dir, "onnx")
+        tokenizer_paths = [self._cfg.model_local_dir, self.model_path, self._cfg.model_id]
+        self._onnx = OnnxCausalLM(onnx_dir)
+        last_err = None
+        for path in tokenizer_paths:
+            try:
+                self._tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=self._cfg.trust_remote_code)
+                return
+            except Exception as e:
+                last_err = e
+        self._onnx = None
+        raise last_err
+
+    def _generate_onnx(self, text: str, max_new: int, num_candidates: int = 1):
+        gen_cfg = self._cfg
+        inputs = self._tokenizer(text, return_tensors="np", truncation=True, max_length=gen_cfg.max_input_tokens)
+        # The exported graphs take no shared cache, so each candidate is its own row
+        return self._onnx.generate(
+            inputs["input_ids"].repeat(num_candidates, axis=0),
+            attention_mask=inputs["attention_mask"].repeat(num_candidates, axis=0),
+            max_new_tokens=max_new,
+            temperature=gen_cfg.temperature,
+            top_p=gen_cfg.top_p,
+            top_k=gen_cfg.top_k,
+            eos_token_id=self._tokenizer.eos_token_id,
+        )
+
+    def _load_proposer(self, dtype):
+        if self._cfg.kv_cache in ("sink", "heavy_hitter"):
+            # Caches that evict tokens cannot roll back rejected proposals
+            return None
+        if self._cfg.draft_model:
+            return self._load_draft(dtype)
+        if self._ngram_index is None:
+            return None
+        if not len(self._ngram_index):
+            for text in BOILERPLATE_SEEDS:
+                self._ngram_index.add(self._tokenizer(text).input_ids)
+        return NgramProposer(self._ngram_index)
+
+    def _load_draft(self, dtype):
+        draft = AutoModelForCausalLM.from_pretrained(
+            self._cfg.draft_model,
+            trust_remote_code=self._cfg.trust_remote_code,
+            torch_dtype=dtype,
+        )
+        if draft.config.vocab_size != self._model.config.vocab_size:
+            raise ValueError(
+                f"Draft model vocab_size={draft.config.vocab_size} does not match the target's {self._model.config.vocab_size}"
+            )
+        return DraftModelProposer(draft.to(self._model.device).eval())
+
+    def _build_empty(self, model_config):
+        # Build the module tree on the meta device, without allocating weights
+        init_device = getattr(model_config, "init_device", None)
+        if init_device is None:
+            return None
+        model_config.init_device = "meta"
+        try:
+            model = AutoModelForCausalLM.from_config(model_config, trust_remote_code=self._cfg.trust_remote_code)
+        finally:
+            model_config.init_device = init_device
+        model.config.init_device = init_device
+        return model
+
+    def _load_mmap(self, path: str, model_config, dtype):
+        # Bind parameters to the memory-mapped checkpoint instead of copying them in
+        state_dict = load_safetensors_mmap(path)
+        if dtype is not None and any(t.is_floating_point() and t.dtype != dtype for t in state_dict.values()):
+            # Casting would copy every weight anyway; let from_pretrained convert it
+            return None
+        model = self._build_empty(model_config)
+        if model is None:
+            return None
+        model.load_state_dict(state_dict, strict=True, assign=True)
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(path)
+        except OSError:
+            # No generation_config.json; keep the defaults derived from the model config
+            pass
+        return model
+
+    def _load_streaming(self, path: str, model_config, dtype):
+        model = self._build_empty(model_config)
+        if model is None or not hasattr(model.get_decoder(), "enable_layer_streaming"):
+            return None
+        model.get_decoder().enable_layer_streaming(path, window=self._cfg.layer_streaming_window, dtype=dtype)
+        return model
+
+    def _quantize_weights(self):
+        if not self._cfg.weight_bits or not hasattr(self._model, "quantize"):
+            return
+        quant_cfg = getattr(self._model.config, "quant_config", None) or {}
+        if quant_cfg.get("bits"):
+            # Checkpoint was saved quantized (see app/quantize.py)
+            return
+        self._model.quantize(bits=self._cfg.weight_bits, group_size=self._cfg.weight_group_size)
+
+    def _optimize_model(self):
+        if not self._cfg.optimize_model or not hasattr(self._model, "optimize_for_inference"):
+            return
+        check_input_ids = None
+        if self._model.dtype == torch.float32:
+            # Rewrites must not change fp32 outputs; reduced precision legitimately drifts
+            check_input_ids = self._tokenizer("def main():\n    return 0\n", return_tensors="pt").input_ids.to(self._model.device)
+        self._model.optimize_for_inference(prepack=self._model.device.type == "cpu", check_input_ids=check_input_ids)
+
+    def _compile_buckets(self):
+        return sorted(b for b in self._cfg.compile_buckets if 0 < b <= self._cfg.max_input_tokens)
+
+    def _compile_model(self):
+        decoder = self._model.get_decoder()
+        if not self._cfg.compile_model or not hasattr(decoder, "compile_blocks"):
+            return
+        buckets = self._compile_buckets()
+        if hasattr(torch, "compile"):
+            import torch._dynamo
+
+            # Each bucket traces its own prefill and decode graphs; the app owns this process-wide limit
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(buckets) + 8)
+        # Warms every prefill bucket now, with the cache and padded mask requests use;
+        # stays eager if compilation fails on this host
+        decoder.compile_blocks(warmup_lengths=tuple(buckets), name=self._cfg.kv_cache, padded=True)
+
+    def _pad_to_bucket(self, inputs):
+        # Left-pad prompts to a warmed-up length so prefill never compiles a new graph
+        if getattr(self._model.get_decoder(), "compiled_blocks", None) is None:
+            return inputs
+        length = inputs["input_ids"].shape[1]
+        bucket = next((b for b in self._compile_buckets() if b >= length), None)
+        if bucket is None or bucket == length:
+            return inputs
+        pad_id = self._tokenizer.pad_token_id if self._tokenizer.pad_token_id is not None else self._tokenizer.eos_token_id
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs.get("attention_mask", torch.ones_like(input_ids))
+        pad = input_ids.new_full((input_ids.shape[0], bucket - length), pad_id)
+        return {
+            **inputs,
+            "input_ids": torch.cat([pad, input_ids], dim=1),
+            "attention_mask": torch.cat([torch.zeros_like(pad), attention_mask], dim=1),
+        }
+
+    def _default_kv_blocks(self) -> int:
+        # Every concurrent job at its longest, plus the speculative lookahead, so the pool never runs dry
+        tokens = self._cfg.max_input_tokens + self._cfg.max_new_tokens + self._cfg.speculative_tokens + 1
+        return max(self._cfg.max_concurrency, 1) * -(-tokens // self._cfg.kv_block_size)
+
+    def _configure_kv_cache(self):
+        cache_cfg = getattr(self._model.config, "kv_cache_config", None)
+        if cache_cfg is None:
+            return
+        # Copy rather than mutate: the dict may be the remote code's shared defaults
+        self._model.config.kv_cache_config = {
+            **cache_cfg,
+            "name": self._cfg.kv_cache,
+            "block_size": self._cfg.kv_block_size,
+            "num_blocks": self._cfg.kv_num_blocks or self._default_kv_blocks(),
+            "sink_tokens": self._cfg.kv_sink_tokens,
+            "window_size": self._cfg.kv_window_size or None,
+            "heavy_tokens": self._cfg.kv_heavy_tokens or None,
+            "prefill_chunk_size": self._cfg.prefill_chunk_size or None,
+        }
+
+    def _load_prefix_cache(self):
+        path = self._cfg.prefix_cache_path
+        if self._prefix_cache is None or not path or not os.path.exists(path):
+            return
+        param = next(self._model.parameters())
+        try:
+            self._prefix_cache.load(path, device=param.device, dtype=param.dtype)
+        except Exception:
+            # A stale or unreadable snapshot only costs a cold prefill
+            pass
+
+    def save_prefix_cache(self):
+        if self._prefix_cache is not None and self._cfg.prefix_cache_path:
+            self._prefix_cache.save(self._cfg.prefix_cache_path)
+
+    def _prefill_prefix(self, input_ids, past_key_values):
+        # Fill the cache with every prompt token but the last (generate feeds that one),
+        # reusing K/V of the longest cached prefix and only prefilling the rest
+        tokens = input_ids[0, :-1].tolist()
+        matched, prefix_kv, handle = self._prefix_cache.lookup(tokens)
+        try:
+            if past_key_values is None:
+                past_key_values = [() for _ in range(self._model.config.n_layers)]
+            if prefix_kv is not None:
+                for i, (k, v) in enumerate(prefix_kv):
+                    if hasattr(past_key_values[i], "update"):
+                        past_key_values[i].update(k, v)
+                    else:
+                        past_key_values[i] = (k, v)
+            if matched < len(tokens):
+                with torch.no_grad():
+                    out = self._model(input_ids=input_ids[:, matched:-1], past_key_values=past_key_values, use_cache=True, **self._forward_kwargs)
+                past_key_values = out.past_key_values
+                # Sink and heavy-hitter caches may already have evicted part of the prompt
+                if past_key_values[0][0].size(1) == len(tokens):
+                    self._prefix_cache.insert(tokens, [tuple(layer) for layer in past_key_values])
+        finally:
+            self._prefix_cache.release(handle)
+        return past_key_values
+
+    def _init_kv_cache(self, input_len: int, max_new: int):
+        # Size a preallocated cache for exactly this request; None keeps the model default
+        if self._cfg.kv_cache == "dynamic":
+            return None
+        decoder = self._model.get_decoder()
+        if not hasattr(decoder, "init_kv_cache"):
+            return None
+        return decoder.init_kv_cache(max_seq_len=input_len + max_new, name=self._cfg.kv_cache)
+
     async def generate_code(self, prompt: str, framework: str = "streamlit", max_new_tokens: Optional[int] = None) -> str:
+        return (await self.generate_candidates(prompt, framework, max_new_tokens))[0]
+
+    async def generate_candidates(
+        self, prompt: str, framework: str = "streamlit", max_new_tokens: Optional[int] = None, num_candidates: int = 1
+    ) -> List[str]:
         # Friendly system prompt to bias toward runnable apps
         system = (
             "You are an AI that writes small, runnable Python apps. "
@@ -63,21 +344,76 @@ Task: Build a minimal {framework} app for the following request:
 
         def _run():
             self._ensure_loaded()
+            if self._onnx is not None:
+                return [self._finish(row, prompt) for row in self._generate_onnx(wrapped, max_new, num_candidates)]
             inputs = self._tokenizer(wrapped, return_tensors="pt", truncation=True, max_length=gen_cfg.max_input_tokens)
+            if self._prefix_cache is None:
+                # The prefix cache is keyed on unpadded prompts
+                inputs = self._pad_to_bucket(inputs)
             if torch.cuda.is_available():
-                inputs = {k: v.to("cuda") for k, v in inputs.items()}
-            out = self._model.generate(
-                **inputs,
-                max_new_tokens=max_new,
-                do_sample=True,
-                temperature=gen_cfg.temperature,
-                top_p=gen_cfg.top_p,
-                top_k=gen_cfg.top_k,
-                eos_token_id=self._tokenizer.eos_token_id,
-            )
-            text = self._tokenizer.decode(out[0], skip_special_tokens=True, clean_up_tokenization_spaces=False)
-            # Return only the completion portion after the prompt
-            completion = text.split(prompt, 1)[-1].strip()
-            return clean_code_markers(completion)
+                inputs = {k: v.to(self._model.device) for k, v in inputs.items()}
+            past_key_values = self._init_kv_cache(inputs["input_ids"].shape[1], max_new)
+            if self._prefix_cache is not None and inputs["input_ids"].shape[1] > 1:
+                past_key_values = self._prefill_prefix(inputs["input_ids"], past_key_values)
+            if past_key_values is not None:
+                inputs["past_key_values"] = past_key_values
+            stopping = None
+            if self._stop_matcher is not None:
+                stopping = CodeStoppingCriteria(self._stop_matcher, inputs["input_ids"].shape[1], check_python=gen_cfg.stop_when_complete)
+            try:
+                if self._decode is not None:
+                    out = self._decode.generate(
+                        inputs["input_ids"],
+                        attention_mask=inputs.get("attention_mask"),
+                        past_key_values=inputs.get("past_key_values"),
+                        max_new_tokens=max_new,
+                        temperature=gen_cfg.temperature,
+                        top_k=gen_cfg.top_k,
+                        top_p=gen_cfg.top_p,
+                        num_return_sequences=num_candidates,
+                        stopping_criteria=stopping,
+                    )
+                else:
+                    if num_candidates > 1:
+                        # HF generate repeats the prompt rows itself and cannot fan out a filled cache
+                        inputs.pop("past_key_values", None)
+                    out = self._model.generate(
+                        **inputs,
+                        max_new_tokens=max_new,
+                        do_sample=True,
+                        temperature=gen_cfg.temperature,
+                        top_p=gen_cfg.top_p,
+                        top_k=gen_cfg.top_k,
+                        eos_token_id=self._tokenizer.eos_token_id,
+                        num_return_sequences=num_candidates,
+                    )
+            finally:
+                # Hand paged KV blocks back to the shared pool
+                if hasattr(past_key_values, "release"):
+                    past_key_values.release()
+            rows, drops = list(out), [0] * len(out)
+            if stopping is not None and stopping.keep:
+                # Drop the stop string, or whatever followed the last complete program
+                prompt_len = inputs["input_ids"].shape[1]
+                rows = [row if keep is None else row[: prompt_len + keep] for row, keep in zip(rows, stopping.keep)]
+                drops = stopping.drop
+            if self._ngram_index is not None:
+                # Index only the completions, up to EOS; the prompt holds bucket padding and the system prompt
+                prompt_len = inputs["input_ids"].shape[1]
+                for row in rows:
+                    completion = row[prompt_len:].tolist()
+                    if self._tokenizer.eos_token_id in completion:
+                        completion = completion[: completion.index(self._tokenizer.eos_token_id)]
+                    self._ngram_index.add(completion)
+            return [self._finish(row, prompt, drop) for row, drop in zip(rows, drops)]
+
+        return await asyncio.to_thread(_run)
 
-        return await asyncio.to_thread(_run)
\ No newline at end of file
+    def _finish(self, token_ids, prompt: str, drop: int = 0) -> str:
+        text = self._tokenizer.decode(token_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        if drop:
+            # Text of the last token past a stop cut
+            text = text[:-drop]
+        # Return only the completion portion after the prompt
+        completion = text.split(prompt, 1)[-1].strip()
+        return clean_code_markers(completion)
\ No newline at end of file
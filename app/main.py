@@ -31,6 +31,12 @@ async def _startup():
     JobStore.start_pruner()
 
 
+@app.on_event("shutdown")
+async def _shutdown():
+    # persist hot prompt prefixes so they survive a restart
+    generator.save_prefix_cache()
+
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
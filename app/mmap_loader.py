@@ -0,0 +1,59 @@
+import glob
+import json
+import mmap
+import os
+import struct
+import warnings
+from typing import Dict, List
+
+import torch
+
+_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def safetensors_files(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return []
+    return sorted(glob.glob(os.path.join(path, "*.safetensors")))
+
+
+def load_safetensors_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Map every *.safetensors file under `path` into memory and return tensors that
+    view the mapping directly, without reading or copying the weights.
+
+    The mapping is private copy-on-write, so untouched pages stay shared with the
+    page cache and with every other process that maps the same file.
+    """
+    tensors: Dict[str, torch.Tensor] = {}
+    for file in safetensors_files(path):
+        with open(file, "rb") as f:
+            (header_len,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_len))
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        data_start = 8 + header_len
+        header.pop("__metadata__", None)
+        with warnings.catch_warnings():
+            # Tensors sharing one mapping is intended; torch warns about buffer ownership
+            warnings.simplefilter("ignore")
+            for name, info in header.items():
+                dtype = _DTYPES[info["dtype"]]
+                begin, end = info["data_offsets"]
+                count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+                if count == 0:
+                    tensors[name] = torch.empty(info["shape"], dtype=dtype)
+                    continue
+                flat = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + begin)
+                tensors[name] = flat.view(info["shape"])
+    return tensors
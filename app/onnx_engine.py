@@ -0,0 +1,87 @@
+import json
+import os
+from typing import List, Optional
+
+import numpy as np
+
+
+def sample_next_token(logits: np.ndarray, temperature: float, top_p: float, top_k: int, rng: np.random.Generator) -> np.ndarray:
+    # logits: (batch, vocab) -> (batch,) token ids; temperature <= 0 is greedy
+    if temperature <= 0:
+        return logits.argmax(axis=-1)
+    logits = logits.astype(np.float64) / temperature
+    if 0 < top_k < logits.shape[-1]:
+        kth = np.partition(logits, -top_k, axis=-1)[:, -top_k][:, None]
+        logits = np.where(logits < kth, -np.inf, logits)
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    probs /= probs.sum(axis=-1, keepdims=True)
+    if 0 < top_p < 1:
+        order = np.argsort(-probs, axis=-1)
+        sorted_probs = np.take_along_axis(probs, order, axis=-1)
+        # Keep the smallest prefix whose mass reaches top_p, always including the top token
+        drop = np.cumsum(sorted_probs, axis=-1) - sorted_probs >= top_p
+        sorted_probs[drop] = 0
+        probs = np.zeros_like(probs)
+        np.put_along_axis(probs, order, sorted_probs, axis=-1)
+        probs /= probs.sum(axis=-1, keepdims=True)
+    return np.array([rng.choice(probs.shape[-1], p=row) for row in probs])
+
+
+class OnnxCausalLM:
+    """
+    Decode loop over the prefill/decode graphs written by `python -m app.export_onnx`,
+    run with onnxruntime on the CPU execution provider.
+
+    The decode graph takes every layer's K/V from the previous step as explicit inputs
+    and returns them grown by one token, so the cache lives in numpy arrays here.
+    """
+
+    def __init__(self, onnx_dir: str, num_threads: int = 0):
+        import onnxruntime as ort
+
+        with open(os.path.join(onnx_dir, "onnx_config.json")) as f:
+            self.config = json.load(f)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.prefill = ort.InferenceSession(os.path.join(onnx_dir, "prefill.onnx"), options, providers=providers)
+        self.decode = ort.InferenceSession(os.path.join(onnx_dir, "decode.onnx"), options, providers=providers)
+        self.past_names: List[str] = self.config["past_names"]
+
+    def generate(
+        self,
+        input_ids: np.ndarray,
+        attention_mask: Optional[np.ndarray] = None,
+        max_new_tokens: int = 128,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        top_k: int = 0,
+        eos_token_id: Optional[int] = None,
+        seed: Optional[int] = None,
+    ) -> np.ndarray:
+        """Returns `input_ids` followed by up to `max_new_tokens` sampled tokens per row."""
+        input_ids = input_ids.astype(np.int64)
+        if attention_mask is None:
+            attention_mask = np.ones_like(input_ids)
+        attention_mask = attention_mask.astype(np.int64)
+        max_new_tokens = min(max_new_tokens, self.config["max_seq_len"] - input_ids.shape[1])
+        rng = np.random.default_rng(seed)
+        logits, *past = self.prefill.run(None, {"input_ids": input_ids, "attention_mask": attention_mask})
+        tokens = [input_ids]
+        finished = np.zeros(input_ids.shape[0], dtype=bool)
+        for step in range(max_new_tokens):
+            next_token = sample_next_token(logits, temperature, top_p, top_k, rng)
+            if eos_token_id is not None:
+                # Rows that already stopped keep emitting eos
+                next_token = np.where(finished, eos_token_id, next_token)
+                finished |= next_token == eos_token_id
+            tokens.append(next_token[:, None])
+            if finished.all() or step == max_new_tokens - 1:
+                break
+            attention_mask = np.concatenate([attention_mask, np.ones_like(next_token[:, None])], axis=1)
+            feeds = {"input_ids": next_token[:, None].astype(np.int64), "attention_mask": attention_mask}
+            feeds.update(zip(self.past_names, past))
+            logits, *past = self.decode.run(None, feeds)
+        return np.concatenate(tokens, axis=1)
@@ -0,0 +1,279 @@
+"""Pipeline-parallel generation: contiguous ranges of MPT blocks on separate processes or hosts.
+
+Rank r holds one contiguous slice of `blocks` (rank 0 also the embedding, the
+last rank also the final norm and head) and the KV cache of its own layers
+only. Prompts are split into micro-batches that flow through the stages over
+gloo (TCP), so every stage works on a different micro-batch at the same time.
+Rank 0 tokenizes, samples and feeds each micro-batch's next token back in.
+
+All stages on one machine:
+
+    python -m app.pp_launch --local --world_size 4 --num_prompts 8 --micro_batch_size 2
+    python -m app.pp_launch --local --tiny --world_size 3 --check
+
+One stage per host, started on every host with its own --rank:
+
+    python -m app.pp_launch --world_size 2 --rank 0 --master_addr 10.0.0.1 --stages 14,18
+"""
+import argparse
+import copy
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from .sampling import sample_next_token
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16}
+OP_PREFILL, OP_DECODE, OP_RELEASE, OP_STOP = range(4)
+# op, micro-batch id, batch, new tokens, mask length, cache length
+HEADER_SIZE = 6
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory")
+    parser.add_argument("--world_size", type=int, default=2, help="Number of pipeline stages")
+    parser.add_argument("--rank", type=int, default=0, help="This process's stage, without --local")
+    parser.add_argument("--local", action="store_true", help="Spawn every stage on this machine")
+    parser.add_argument("--master_addr", default="127.0.0.1")
+    parser.add_argument("--master_port", type=int, default=29521)
+    parser.add_argument("--stages", default="", help="Comma-separated block counts per stage (default: even split)")
+    parser.add_argument("--prompt", default="def fibonacci(n):")
+    parser.add_argument("--prompts_file", default="", help="One prompt per line, instead of --prompt")
+    parser.add_argument("--num_prompts", type=int, default=4, help="Copies of --prompt to serve")
+    parser.add_argument("--micro_batch_size", type=int, default=1)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.0, help="0 decodes greedily")
+    parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--dtype", default="fp32", choices=list(DTYPES))
+    parser.add_argument("--tiny", action="store_true", help="Split a small randomly initialised model instead of the checkpoint")
+    parser.add_argument("--check", action="store_true", help="With --tiny, compare greedy tokens against the unsplit model on rank 0")
+    return parser.parse_args()
+
+
+def stage_ranges(n_layers: int, world_size: int, stages: str = "") -> List[Tuple[int, int]]:
+    if stages:
+        counts = [int(c) for c in stages.split(",")]
+        if len(counts) != world_size or sum(counts) != n_layers:
+            raise ValueError(f"--stages must give {world_size} block counts summing to n_layers={n_layers}, got {stages}")
+    else:
+        # Rank 0 also embeds and samples, so later stages take the remainder
+        counts = [n_layers // world_size] * world_size
+        for i in range(n_layers % world_size):
+            counts[world_size - 1 - i] += 1
+    bounds = [sum(counts[:i]) for i in range(world_size + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def load_stage(args, rank: int, world_size: int):
+    config = AutoConfig.from_pretrained(args.model, trust_remote_code=True)
+    reference = None
+    if args.tiny:
+        config.n_layers, config.d_model, config.n_heads = 6, 256, 8
+        config.init_device = "cpu"
+        torch.manual_seed(0)  # identical weights on every rank before splitting
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True).to(DTYPES[args.dtype]).eval()
+        if args.check and rank == 0:
+            reference = copy.deepcopy(model)
+        start, end = stage_ranges(config.n_layers, world_size, args.stages)[rank]
+        model.get_decoder().enable_pipeline_stage(start, end)
+        return model, reference
+    init_device = config.init_device
+    config.init_device = "meta"
+    model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+    model.config.init_device = init_device
+    start, end = stage_ranges(config.n_layers, world_size, args.stages)[rank]
+    model.get_decoder().enable_pipeline_stage(start, end, checkpoint_path=args.model, dtype=DTYPES[args.dtype])
+    return model.eval(), reference
+
+
+class Stage:
+    """One pipeline stage: its slice of the model and a KV cache per in-flight micro-batch."""
+
+    def __init__(self, model, rank: int, world_size: int):
+        self.model = model
+        self.decoder = model.get_decoder()
+        self.rank = rank
+        self.world_size = world_size
+        self.caches: Dict[int, object] = {}
+        self._pending: List[tuple] = []
+
+    @torch.no_grad()
+    def forward(self, header: List[int], x: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        op, mb, _, _, _, cache_len = header
+        if op == OP_PREFILL:
+            self.caches[mb] = self.decoder.init_kv_cache(max_seq_len=cache_len, name="static")
+        return self.decoder.forward_stage(x, past_key_values=self.caches[mb], attention_mask=mask)
+
+    @torch.no_grad()
+    def logits(self, hidden: torch.Tensor) -> torch.Tensor:
+        return self.model.compute_logits(hidden[:, -1:])[:, -1].float()
+
+    def release(self, mb: int):
+        self.caches.pop(mb, None)
+
+    def send(self, tensors: List[torch.Tensor], dst: int):
+        # Non-blocking, so a stage can take the next micro-batch while this one is in flight
+        self._pending = [(work, t) for work, t in self._pending if not work.is_completed()]
+        for t in tensors:
+            t = t.contiguous()
+            self._pending.append((dist.isend(t, dst), t))
+
+    def flush(self):
+        for work, _ in self._pending:
+            work.wait()
+        self._pending = []
+
+
+def run_stage(stage: Stage, hidden_size: int, dtype: torch.dtype):
+    # Ranks 1..N-1: receive from the previous stage, compute, pass on (or return logits to rank 0)
+    prev, last = stage.rank - 1, stage.rank == stage.world_size - 1
+    header = torch.empty(HEADER_SIZE, dtype=torch.long)
+    while True:
+        dist.recv(header, src=prev)
+        fields = header.tolist()
+        op, mb, batch, seq, mask_len, _ = fields
+        if op in (OP_RELEASE, OP_STOP):
+            stage.release(mb)
+            if not last:
+                stage.send([header.clone()], stage.rank + 1)
+            if op == OP_STOP:
+                break
+            continue
+        x = torch.empty(batch, seq, hidden_size, dtype=dtype)
+        mask = torch.empty(batch, mask_len, dtype=torch.long)
+        dist.recv(x, src=prev)
+        dist.recv(mask, src=prev)
+        hidden = stage.forward(fields, x, mask)
+        if last:
+            stage.send([header.clone(), stage.logits(hidden)], 0)
+        else:
+            stage.send([header.clone(), hidden, mask], stage.rank + 1)
+    stage.flush()
+
+
+def drive(stage: Stage, micro_batches: List[Tuple[torch.Tensor, torch.Tensor]], args, vocab_size: int, eos_token_id: Optional[int]) -> List[torch.Tensor]:
+    # Rank 0: first stage plus the decode loop of every micro-batch
+    last = stage.world_size - 1
+    masks = [mask for _, mask in micro_batches]
+    tokens: List[List[torch.Tensor]] = [[] for _ in micro_batches]
+    finished = [torch.zeros(ids.size(0), dtype=torch.bool) for ids, _ in micro_batches]
+
+    def feed(op: int, mb: int, x: torch.Tensor):
+        mask = masks[mb]
+        cache_len = micro_batches[mb][0].size(1) + args.max_new_tokens
+        header = [op, mb, x.size(0), x.size(1), mask.size(1), cache_len]
+        hidden = stage.forward(header, x, mask)
+        stage.send([torch.tensor(header), hidden, mask], 1)
+
+    def retire(mb: int, op: int = OP_RELEASE):
+        stage.release(mb)
+        stage.send([torch.tensor([op, mb, 0, 0, 0, 0])], 1)
+
+    for mb, (ids, _) in enumerate(micro_batches):
+        feed(OP_PREFILL, mb, ids)
+    active = len(micro_batches)
+    header = torch.empty(HEADER_SIZE, dtype=torch.long)
+    while active:
+        dist.recv(header, src=last)
+        mb, batch = header[1].item(), header[2].item()
+        logits = torch.empty(batch, vocab_size)
+        dist.recv(logits, src=last)
+        next_token = sample_next_token(logits, args.temperature, args.top_k, args.top_p)
+        if eos_token_id is not None:
+            # Rows that already stopped keep emitting eos
+            next_token = next_token.masked_fill(finished[mb][:, None], eos_token_id)
+            finished[mb] |= next_token[:, 0] == eos_token_id
+        tokens[mb].append(next_token)
+        if len(tokens[mb]) == args.max_new_tokens or finished[mb].all():
+            retire(mb)
+            active -= 1
+            continue
+        masks[mb] = torch.cat([masks[mb], torch.ones_like(next_token)], dim=1)
+        feed(OP_DECODE, mb, next_token)
+    retire(0, OP_STOP)
+    stage.flush()
+    return [torch.cat(t, dim=1) for t in tokens]
+
+
+@torch.no_grad()
+def reference_greedy(model, input_ids: torch.Tensor, attention_mask: torch.Tensor, new_tokens: int) -> torch.Tensor:
+    past = model.get_decoder().init_kv_cache(max_seq_len=input_ids.size(1) + new_tokens, name="static")
+    out = model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past, use_cache=True, logits_to_keep=1)
+    tokens = []
+    for _ in range(new_tokens):
+        tokens.append(out.logits[:, -1].argmax(-1, keepdim=True))
+        attention_mask = torch.cat([attention_mask, torch.ones_like(tokens[-1])], dim=1)
+        out = model(input_ids=tokens[-1], attention_mask=attention_mask, past_key_values=out.past_key_values, use_cache=True, logits_to_keep=1)
+    return torch.cat(tokens, dim=1)
+
+
+def build_micro_batches(args, tokenizer, vocab_size: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    if tokenizer is None:
+        torch.manual_seed(1)
+        ids = torch.randint(0, vocab_size, (args.num_prompts, 32))
+        mask = torch.ones_like(ids)
+        mask[1::2, :8] = 0  # left padding on every other prompt
+    else:
+        if args.prompts_file:
+            with open(args.prompts_file) as f:
+                prompts = [line.rstrip("\n") for line in f if line.strip()]
+        else:
+            prompts = [args.prompt] * args.num_prompts
+        tokenizer.padding_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        enc = tokenizer(prompts, return_tensors="pt", padding=True)
+        ids, mask = enc.input_ids, enc.attention_mask
+    size = args.micro_batch_size
+    return [(ids[i:i + size], mask[i:i + size]) for i in range(0, ids.size(0), size)]
+
+
+def worker(rank: int, args):
+    os.environ.setdefault("MASTER_ADDR", args.master_addr)
+    os.environ.setdefault("MASTER_PORT", str(args.master_port))
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    try:
+        model, reference = load_stage(args, rank, args.world_size)
+        stage = Stage(model, rank, args.world_size)
+        if rank > 0:
+            run_stage(stage, model.config.d_model, DTYPES[args.dtype])
+            return
+        tokenizer = None if args.tiny else AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+        eos_token_id = None if tokenizer is None else tokenizer.eos_token_id
+        micro_batches = build_micro_batches(args, tokenizer, model.config.vocab_size)
+        start = time.perf_counter()
+        outputs = drive(stage, micro_batches, args, model.config.vocab_size, eos_token_id)
+        elapsed = time.perf_counter() - start
+        generated = sum(t.numel() for t in outputs)
+        if tokenizer is not None:
+            for t in outputs:
+                for row in t:
+                    print(tokenizer.decode(row, skip_special_tokens=True))
+                    print("-" * 40)
+        print(f"{args.world_size} stages, {len(micro_batches)} micro-batches: {generated} tokens in {elapsed:.2f}s ({generated / elapsed:.1f} tokens/s)")
+        if reference is not None:
+            agree = [(reference_greedy(reference, ids, mask, t.size(1)) == t).float().mean().item() for (ids, mask), t in zip(micro_batches, outputs)]
+            print(f"greedy agreement with the unsplit model: {100 * sum(agree) / len(agree):.1f}%")
+    finally:
+        dist.destroy_process_group()
+
+
+def main():
+    args = parse_args()
+    if args.world_size < 2:
+        raise SystemExit("A pipeline needs at least two stages; use the regular server for one process")
+    if args.local:
+        mp.spawn(worker, args=(args,), nprocs=args.world_size, join=True)
+    else:
+        worker(args.rank, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+# One (key, value) pair per layer, each shaped (1, seq, kv_dim)
+LayerKV = Tuple[torch.Tensor, torch.Tensor]
+
+
+class _Node:
+    __slots__ = ("tokens", "kv", "parent", "children", "ref_count", "last_access", "nbytes")
+
+    def __init__(self, tokens: Tuple[int, ...], kv: List[LayerKV], parent: Optional["_Node"]):
+        self.tokens = tokens
+        self.kv = kv
+        self.parent = parent
+        self.children: Dict[int, "_Node"] = {}
+        self.ref_count = 0
+        self.last_access = time.monotonic()
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+
+def _slice_kv(kv: Sequence[LayerKV], start: int, end: int) -> List[LayerKV]:
+    # Clone so a node never pins the (larger) tensor it was cut from
+    return [(k[:, start:end].clone(), v[:, start:end].clone()) for k, v in kv]
+
+
+class PrefixKVCache:
+    """
+    Radix tree of prompt token IDs holding the per-layer K/V of shared prefixes.
+
+    Nodes on a path handed out by `lookup` are ref-counted and never evicted
+    until `release`; other leaves are evicted least-recently-used first once
+    the cache holds more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._root = _Node((), [], None)
+        self._lock = threading.Lock()
+
+    def lookup(self, token_ids: Sequence[int]) -> Tuple[int, Optional[List[LayerKV]], _Node]:
+        """Return (matched length, K/V of the matched prefix or None, handle to pass to `release`)."""
+        with self._lock:
+            node, pos, segments = self._root, 0, []
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    break
+                common = _common_prefix_len(child.tokens, token_ids[pos:])
+                segments.append((child, common))
+                node, pos = child, pos + common
+                if common < len(child.tokens):
+                    break
+            now = time.monotonic()
+            for n in _path(node):
+                n.ref_count += 1
+                n.last_access = now
+            if pos == 0:
+                return 0, None, node
+            kv = [
+                (
+                    torch.cat([seg.kv[i][0][:, :n] for seg, n in segments], dim=1),
+                    torch.cat([seg.kv[i][1][:, :n] for seg, n in segments], dim=1),
+                )
+                for i in range(len(segments[0][0].kv))
+            ]
+            return pos, kv, node
+
+    def release(self, handle: _Node):
+        with self._lock:
+            for n in _path(handle):
+                n.ref_count -= 1
+            self._evict()
+
+    def insert(self, token_ids: Sequence[int], kv: Sequence[LayerKV], start: int = 0):
+        """Cache `kv`, which holds the K/V of `token_ids[start:]`; `token_ids[:start]` must already be cached."""
+        token_ids = tuple(token_ids)
+        with self._lock:
+            node, pos = self._root, 0
+            while pos < len(token_ids):
+                child = node.children.get(token_ids[pos])
+                if child is None:
+                    if pos < start:
+                        return
+                    leaf = _Node(token_ids[pos:], _slice_kv(kv, pos - start, len(token_ids) - start), node)
+                    node.children[token_ids[pos]] = leaf
+                    self.nbytes += leaf.nbytes
+                    break
+                common = _common_prefix_len(child.tokens, token_ids[pos:])
+                if common < len(child.tokens):
+                    child = self._split(child, common)
+                child.last_access = time.monotonic()
+                node, pos = child, pos + common
+            self._evict()
+
+    def _split(self, node: _Node, at: int) -> _Node:
+        upper = _Node(node.tokens[:at], _slice_kv(node.kv, 0, at), node.parent)
+        lower = _Node(node.tokens[at:], _slice_kv(node.kv, at, len(node.tokens)), upper)
+        # Anyone holding a path through `node` now holds it through both halves
+        upper.ref_count = lower.ref_count = node.ref_count
+        lower.children = node.children
+        for c in lower.children.values():
+            c.parent = lower
+        upper.children = {lower.tokens[0]: lower}
+        node.parent.children[upper.tokens[0]] = upper
+        self.nbytes += upper.nbytes + lower.nbytes - node.nbytes
+        # Outstanding handles may point at `node`; keep it chained to the new path
+        node.parent, node.children, node.kv = lower, {}, []
+        node.ref_count = 0
+        return upper
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            leaves = [n for n in self._iter_nodes() if not n.children and n.ref_count <= 0]
+            if not leaves:
+                return
+            victim = min(leaves, key=lambda n: n.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self.nbytes -= victim.nbytes
+
+    def _iter_nodes(self):
+        stack = list(self._root.children.values())
+        while stack:
+            n = stack.pop()
+            yield n
+            stack.extend(n.children.values())
+
+    def save(self, path: str):
+        # Parents are written before children so `load` can re-insert in order
+        with self._lock:
+            entries, queue = [], [(self._root, ())]
+            while queue:
+                node, prefix = queue.pop(0)
+                for child in node.children.values():
+                    full = prefix + child.tokens
+                    entries.append((list(full), len(prefix), [(k.cpu(), v.cpu()) for k, v in child.kv]))
+                    queue.append((child, full))
+        tmp_path = path + ".tmp"
+        torch.save({"entries": entries}, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str, device=None, dtype=None):
+        state = torch.load(path, map_location=device or "cpu")
+        for tokens, start, kv in state["entries"]:
+            if dtype is not None:
+                kv = [(k.to(dtype=dtype), v.to(dtype=dtype)) for k, v in kv]
+            self.insert(tokens, kv, start=start)
+
+
+def _path(node: _Node):
+    while node is not None:
+        yield node
+        node = node.parent
+
+
+def _common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
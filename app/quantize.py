@@ -0,0 +1,28 @@
+"""Write a weight-only quantized copy of the model that loads directly.
+
+    python -m app.quantize --bits 4 --output replit-code-v1-3b-int4
+    MODEL_LOCAL_DIR=replit-code-v1-3b-int4 uvicorn app.main:app
+"""
+import argparse
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--output", required=True, help="Directory to write the quantized checkpoint to")
+    parser.add_argument("--bits", type=int, default=8, choices=[8, 4])
+    parser.add_argument("--group_size", type=int, default=128, help="Input features sharing one scale")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model, trust_remote_code=True)
+    model.quantize(bits=args.bits, group_size=args.group_size)
+    model.save_pretrained(args.output)
+    tokenizer.save_pretrained(args.output)
+    print(f"wrote {args.bits}-bit weights to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+from typing import Optional, Union
+
+import torch
+
+PerRow = Union[float, int, torch.Tensor]
+
+
+def sample_tokens(
+    logits: torch.Tensor,
+    temperature: PerRow,
+    top_k: PerRow = 0,
+    top_p: PerRow = 1.0,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """
+    Sample one token per row of `logits` (batch, vocab) -> (batch,).
+
+    `temperature`, `top_k` and `top_p` are scalars or per-row tensors. Rows with
+    temperature <= 0 decode greedily and top_k <= 0 disables top-k, as in HF
+    `generate`. Candidates are cut to the largest top_k first, so top-p only sorts
+    those k logits instead of the whole vocabulary; the kept set and its
+    renormalised probabilities equal HF's temperature -> top-k -> top-p chain.
+    """
+    batch, vocab = logits.shape
+    device = logits.device
+    temperature = torch.as_tensor(temperature, dtype=torch.float32, device=device).expand(batch)
+    top_k = torch.as_tensor(top_k, dtype=torch.long, device=device).expand(batch)
+    top_p = torch.as_tensor(top_p, dtype=torch.float32, device=device).expand(batch)
+    greedy = temperature <= 0
+    if bool(greedy.all()):
+        return logits.argmax(-1)
+    scale = temperature.clamp_min(1e-5)[:, None]
+    top_k = torch.where((top_k > 0) & (top_k < vocab), top_k, torch.full_like(top_k, vocab))
+    k = int(top_k.max())
+    if k == vocab and bool((top_p >= 1).all()):
+        # Nothing to truncate: sample the full softmax without sorting
+        sampled = torch.multinomial((logits.float() / scale).softmax(-1), 1, generator=generator)[:, 0]
+        return torch.where(greedy, logits.argmax(-1), sampled)
+    values, indices = logits.float().topk(k, dim=-1)
+    ranks = torch.arange(k, device=device)
+    values = values.masked_fill(ranks >= top_k[:, None], float("-inf"))
+    probs = (values / scale).softmax(-1)
+    # Keep the smallest prefix whose mass reaches top_p, always including the top token
+    drop = probs.cumsum(-1) - probs >= top_p[:, None]
+    choice = torch.multinomial(probs.masked_fill(drop, 0), 1, generator=generator)
+    sampled = indices.gather(-1, choice)[:, 0]
+    return torch.where(greedy, indices[:, 0], sampled)
+
+
+def token_probs(logits: torch.Tensor, temperature: PerRow, top_k: PerRow = 0, top_p: PerRow = 1.0) -> torch.Tensor:
+    """
+    The distribution `sample_tokens` draws from, as dense (batch, vocab) probabilities.
+
+    Greedy rows are one-hot on the argmax. Speculative decoding needs the full
+    distributions of the target and the proposer to accept or resample exactly.
+    """
+    batch, vocab = logits.shape
+    device = logits.device
+    temperature = torch.as_tensor(temperature, dtype=torch.float32, device=device).expand(batch)
+    top_k = torch.as_tensor(top_k, dtype=torch.long, device=device).expand(batch)
+    top_p = torch.as_tensor(top_p, dtype=torch.float32, device=device).expand(batch)
+    top_k = torch.where((top_k > 0) & (top_k < vocab), top_k, torch.full_like(top_k, vocab))
+    values, indices = logits.float().topk(int(top_k.max()), dim=-1)
+    ranks = torch.arange(values.size(-1), device=device)
+    values = values.masked_fill(ranks >= top_k[:, None], float("-inf"))
+    kept = (values / temperature.clamp_min(1e-5)[:, None]).softmax(-1)
+    kept = kept.masked_fill(kept.cumsum(-1) - kept >= top_p[:, None], 0)
+    kept = torch.where((temperature <= 0)[:, None], (ranks == 0).float().expand_as(kept), kept)
+    kept = kept / kept.sum(-1, keepdim=True)
+    return torch.zeros(batch, vocab, device=device).scatter_(-1, indices, kept)
+
+
+def sample_next_token(logits: torch.Tensor, temperature: float, top_k: int = 0, top_p: float = 1.0) -> torch.Tensor:
+    # logits: (batch, vocab) -> (batch, 1) token ids; temperature <= 0 is greedy
+    return sample_tokens(logits, temperature, top_k, top_p)[:, None]
@@ -0,0 +1,181 @@
+import inspect
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
+from .sampling import PerRow, token_probs
+
+
+def crop_cache(past_key_values, length: int):
+    # Drop cached tokens past `length` from a registry KV cache or a legacy list of tuples
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return
+    for i, layer_past in enumerate(past_key_values):
+        if len(layer_past):
+            past_key_values[i] = tuple(t[:, :length] for t in layer_past)
+
+
+class DraftModelProposer:
+    """
+    Proposes speculative tokens by sampling a small draft model (any MPTConfig sharing
+    the target's vocabulary) for k steps against its own KV cache.
+
+    Returns the draft's full sampling distribution for every proposed token, which the
+    target needs to accept or resample exactly. After verification `rollback` crops the
+    draft cache back to the tokens the target kept. The draft cache is thread-local, so
+    one proposer serves concurrent jobs.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._request = threading.local()
+        self._forward_kwargs = {}
+        if "logits_to_keep" in inspect.signature(model.forward).parameters:
+            self._forward_kwargs["logits_to_keep"] = 1
+
+    def reset(self, max_seq_len: int):
+        decoder = self.model.get_decoder()
+        self._request.past = decoder.init_kv_cache(max_seq_len=max_seq_len, name="static")
+        self._request.cached = 0
+
+    @torch.no_grad()
+    def propose(
+        self,
+        seq: torch.Tensor,
+        mask: torch.Tensor,
+        k: int,
+        temperature: PerRow,
+        top_k: PerRow,
+        top_p: PerRow,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """`seq` (1, n) is every committed token; returns k tokens and their (k, vocab) draft distributions."""
+        request = self._request
+        feed = seq[:, request.cached:]
+        drafts, probs = [], []
+        for _ in range(k):
+            end = request.cached + feed.size(1)
+            out = self.model(input_ids=feed, attention_mask=mask[:, :end], past_key_values=request.past, use_cache=True, **self._forward_kwargs)
+            request.past = out.past_key_values
+            request.cached = end
+            q = token_probs(out.logits[:, -1], temperature, top_k, top_p)
+            feed = torch.multinomial(q, 1, generator=generator)
+            drafts.append(feed[0, 0])
+            probs.append(q[0])
+        return torch.stack(drafts), torch.stack(probs)
+
+    def rollback(self, length: int):
+        request = self._request
+        if length < request.cached:
+            crop_cache(request.past, length)
+            request.cached = length
+
+
+# Scaffolding generated apps keep repeating; seeds the n-gram index before any job completes
+BOILERPLATE_SEEDS = (
+    "import streamlit as st\n\nst.set_page_config(page_title=",
+    "st.title(",
+    "if st.button(",
+    "import gradio as gr\n\n",
+    "demo = gr.Interface(fn=",
+    'if __name__ == "__main__":\n    demo.launch()\n',
+    'if __name__ == "__main__":\n    main()\n',
+)
+
+
+class NgramIndex:
+    """
+    Bounded map from the last n tokens (min_n <= n <= max_n) to the tokens that followed
+    them, most recent continuation first.
+
+    Keys are evicted least-recently-used once `max_entries` is reached, and each key keeps at
+    most `max_continuations` distinct next tokens, so memory stays bounded however many jobs
+    are added. Safe to share between concurrent jobs.
+    """
+
+    def __init__(self, min_n: int = 2, max_n: int = 4, max_entries: int = 200_000, max_continuations: int = 4):
+        self.min_n = min_n
+        self.max_n = max_n
+        self.max_entries = max_entries
+        self.max_continuations = max_continuations
+        self._table: "OrderedDict[Tuple[int, ...], List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._table)
+
+    def add(self, tokens: Sequence[int], start: int = 0):
+        # Index every n-gram ending before position i (i >= start) with tokens[i] as its continuation
+        with self._lock:
+            for i in range(max(start, self.min_n), len(tokens)):
+                for n in range(self.min_n, min(self.max_n, i) + 1):
+                    key = tuple(tokens[i - n:i])
+                    nexts = self._table.pop(key, [])
+                    if tokens[i] in nexts:
+                        nexts.remove(tokens[i])
+                    nexts.insert(0, tokens[i])
+                    del nexts[self.max_continuations:]
+                    self._table[key] = nexts
+            while len(self._table) > self.max_entries:
+                self._table.popitem(last=False)
+
+    def next_token(self, context: Sequence[int]) -> Optional[int]:
+        # Longest matching suffix wins
+        with self._lock:
+            for n in range(min(self.max_n, len(context)), self.min_n - 1, -1):
+                nexts = self._table.get(tuple(context[-n:]))
+                if nexts:
+                    self._table.move_to_end(tuple(context[-n:]))
+                    return nexts[0]
+        return None
+
+
+class NgramProposer:
+    """
+    Proposes speculative tokens by following n-gram continuations, without a draft model.
+
+    The current request's prompt and output are indexed as they grow, and looked up before
+    the `shared` index of completed jobs. Proposals are deterministic, so the decode loop
+    verifies them as one-hot drafts; the output distribution is unchanged. Per-request
+    state is thread-local, so one proposer serves concurrent jobs.
+    """
+
+    def __init__(self, shared: NgramIndex):
+        self.shared = shared
+        self._request = threading.local()
+
+    def reset(self, max_seq_len: int):
+        self._request.index = NgramIndex(self.shared.min_n, self.shared.max_n, max_entries=4 * max_seq_len)
+        self._request.indexed = 0
+
+    def propose(
+        self,
+        seq: torch.Tensor,
+        mask: torch.Tensor,
+        k: int,
+        temperature: PerRow,
+        top_k: PerRow,
+        top_p: PerRow,
+        generator: Optional[torch.Generator] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        local = self._request.index
+        # Left padding of the prompt would index n-grams of pad tokens
+        tokens = seq[0][mask[0, : seq.size(1)].bool()].tolist()
+        local.add(tokens, start=self._request.indexed)
+        self._request.indexed = len(tokens)
+        drafts: List[int] = []
+        for _ in range(k):
+            context = tokens + drafts
+            token = local.next_token(context)
+            if token is None:
+                token = self.shared.next_token(context)
+            if token is None:
+                break
+            drafts.append(token)
+        return torch.tensor(drafts, dtype=seq.dtype, device=seq.device), None
+
+    def rollback(self, length: int):
+        pass
@@ -0,0 +1,209 @@
+import ast
+import codeop
+import re
+import warnings
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+# SentencePiece marks word starts with "▁" and spells unknown characters as byte tokens
+_BYTE_PIECE = re.compile(r"^<0x([0-9A-Fa-f]{2})>$")
+
+COMPLETE, INCOMPLETE, INVALID = "complete", "incomplete", "invalid"
+
+
+def token_pieces(tokenizer) -> List[str]:
+    """
+    The text every token id contributes when decoded in the middle of a sequence.
+
+    Special tokens contribute nothing; byte tokens outside ASCII stand in as U+FFFD,
+    which no stop string or Python keyword contains.
+    """
+    special = set(tokenizer.all_special_ids)
+    pieces = []
+    for token_id, piece in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token_id in special or piece is None:
+            pieces.append("")
+            continue
+        byte = _BYTE_PIECE.match(piece)
+        if byte:
+            value = int(byte.group(1), 16)
+            pieces.append(chr(value) if value < 0x80 else "�")
+        else:
+            pieces.append(piece.replace("▁", " "))
+    return pieces
+
+
+class StopStringMatcher:
+    """
+    Finds stop strings in a token stream without decoding it.
+
+    The stop strings form an Aho-Corasick trie over characters. Tokens whose piece
+    shares no character with any stop string reset the match and are marked once,
+    up front, over the whole vocabulary; for the rest the walk of a piece from a trie
+    state is memoised, so a match that spans several tokens costs one dict lookup per
+    token.
+    """
+
+    def __init__(self, stop_strings: Sequence[str], pieces: Sequence[str]):
+        self.stop_strings = [s for s in stop_strings if s]
+        self.pieces = pieces
+        self._goto: List[Dict[str, int]] = [{}]
+        self._match_len = [0]  # longest stop string ending at this state, via fail links
+        for stop in self.stop_strings:
+            state = 0
+            for ch in stop:
+                if ch not in self._goto[state]:
+                    self._goto.append({})
+                    self._match_len.append(0)
+                    self._goto[state][ch] = len(self._goto) - 1
+                state = self._goto[state][ch]
+            self._match_len[state] = max(self._match_len[state], len(stop))
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, child in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                self._match_len[child] = max(self._match_len[child], self._match_len[self._fail[child]])
+                queue.append(child)
+        alphabet = set("".join(self.stop_strings))
+        self.inert = [not alphabet.intersection(piece) for piece in pieces]
+        self._memo: Dict[Tuple[int, int], Tuple[int, int, int]] = {}
+
+    def step(self, state: int, token_id: int) -> Tuple[int, int, int]:
+        """
+        Feeds one token; returns the new state and, for the first stop string completed
+        inside the token, its end offset within the piece and its length ((-1, 0) if none).
+        """
+        if self.inert[token_id]:
+            return 0, -1, 0
+        key = (state, token_id)
+        result = self._memo.get(key)
+        if result is None:
+            end, length = -1, 0
+            for i, ch in enumerate(self.pieces[token_id]):
+                while state and ch not in self._goto[state]:
+                    state = self._fail[state]
+                state = self._goto[state].get(ch, 0)
+                if end < 0 and self._match_len[state]:
+                    end, length = i + 1, self._match_len[state]
+            result = self._memo[key] = (state, end, length)
+        return result
+
+
+def python_status(source: str) -> str:
+    """Whether `source` is a complete program, a prefix of one, or can no longer become one."""
+    try:
+        ast.parse(source)
+        return COMPLETE
+    except (SyntaxError, ValueError):
+        pass
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            return INCOMPLETE if codeop.compile_command(source, "<generated>", "exec") is None else COMPLETE
+        except (SyntaxError, ValueError, OverflowError):
+            return INVALID
+
+
+def _has_code(text: str) -> bool:
+    # Any non-blank line besides code fences
+    return any(line.strip() and not line.lstrip().startswith("```") for line in text.split("\n"))
+
+
+class _Row:
+    def __init__(self):
+        self.state = 0
+        self.text = ""
+        self.offsets: List[int] = []  # length of text after each generated token
+        self.code_start = 0  # leading prose and fences before the code are skipped
+        self.code_seen = False
+        self.complete_end: Optional[int] = None  # end of the last complete program in text
+        self.keep: Optional[int] = None
+        self.drop = 0
+
+
+class CodeStoppingCriteria:
+    """
+    Per-row stopping for `DecodeEngine.generate(stopping_criteria=...)`.
+
+    A row stops when it emits a stop string, or, with `check_python`, when a line makes
+    the code after the prompt invalid Python although the code up to an earlier newline
+    parsed as a complete program (a closing fence, an echoed "Task:", prose). Matches
+    are only armed once the row has written a line of code, so an opening fence does not
+    stop it. The cut falls before the stop string or after the last complete program:
+    `keep[row]` is the number of generated tokens up to the one holding the cut (None keeps
+    everything) and `drop[row]` the characters of that token's text past the cut.
+    """
+
+    def __init__(self, matcher: StopStringMatcher, prompt_len: int, check_python: bool = False):
+        self.matcher = matcher
+        self.prompt_len = prompt_len
+        self.check_python = check_python
+        self._rows: List[_Row] = []
+
+    @property
+    def keep(self) -> List[Optional[int]]:
+        return [row.keep for row in self._rows]
+
+    @property
+    def drop(self) -> List[int]:
+        return [row.drop for row in self._rows]
+
+    def __call__(self, input_ids: torch.Tensor) -> torch.Tensor:
+        if not self._rows:
+            self._rows = [_Row() for _ in range(input_ids.size(0))]
+        done = []
+        for row, ids in zip(self._rows, input_ids[:, self.prompt_len:].tolist()):
+            for token_id in ids[len(row.offsets):]:
+                if row.keep is None:
+                    self._feed(row, token_id)
+                row.offsets.append(len(row.text))
+            done.append(row.keep is not None)
+        return torch.tensor(done, device=input_ids.device)
+
+    def _feed(self, row: _Row, token_id: int):
+        piece = self.matcher.pieces[token_id]
+        start = len(row.text)
+        row.text += piece
+        row.state, end, length = self.matcher.step(row.state, token_id)
+        if end >= 0:
+            cut = start + end - length
+            # The stop string may itself end the first line of code
+            if row.code_seen or _has_code(row.text[:cut]):
+                self._cut(row, cut)
+                return
+        newline = piece.rfind("\n")
+        if newline < 0:
+            return
+        line_end = start + newline + 1
+        if not row.code_seen:
+            row.code_seen = _has_code(row.text[:line_end])
+        if self.check_python:
+            self._check_python(row, line_end)
+
+    def _check_python(self, row: _Row, line_end: int):
+        source = row.text[row.code_start:line_end].lstrip()
+        if not source:
+            return
+        status = python_status(source)
+        if status == COMPLETE:
+            row.complete_end = line_end
+        elif status == INVALID:
+            if row.complete_end is None:
+                # Not in the code yet: start parsing after this line
+                row.code_start = line_end
+            else:
+                self._cut(row, row.complete_end)
+
+    def _cut(self, row: _Row, offset: int):
+        # A token may straddle the cut, so keep it and drop only the text past the cut
+        ends = row.offsets + [len(row.text)]
+        row.keep = bisect_left(ends, offset) + 1 if offset > 0 else 0
+        row.drop = ends[row.keep - 1] - offset if row.keep else 0
@@ -0,0 +1,135 @@
+"""Tensor-parallel CPU generation: one process per core group, all-reducing over gloo.
+
+Each rank builds the model on the meta device and reads only its own shards of
+the block weights from the local checkpoint. Ranks are pinned to disjoint sets
+of cores, so on a multi-socket host `--world_size` is usually the socket count:
+
+    python -m app.tp_launch --model replit-code-v1-3b --world_size 2 --prompt "def fib(n):"
+    python -m app.tp_launch --tiny --world_size 4 --check
+"""
+import argparse
+import copy
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+from .sampling import sample_next_token
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory")
+    parser.add_argument("--world_size", type=int, default=2)
+    parser.add_argument("--prompt", default="def fibonacci(n):")
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.0, help="0 decodes greedily")
+    parser.add_argument("--top_k", type=int, default=0)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--dtype", default="fp32", choices=list(DTYPES))
+    parser.add_argument("--tiny", action="store_true", help="Shard a small randomly initialised model instead of the checkpoint")
+    parser.add_argument("--check", action="store_true", help="With --tiny, compare logits against the unsharded model on rank 0")
+    parser.add_argument("--no_pin", action="store_true", help="Do not pin each rank to its own cores")
+    parser.add_argument("--port", type=int, default=29511)
+    return parser.parse_args()
+
+
+def pin_cores(rank: int, world_size: int):
+    # Disjoint core ranges per rank; intra-op threads stay on their own socket/cores
+    cores = sorted(os.sched_getaffinity(0))
+    per_rank = max(1, len(cores) // world_size)
+    mine = cores[rank * per_rank:(rank + 1) * per_rank] or cores
+    os.sched_setaffinity(0, mine)
+    torch.set_num_threads(len(mine))
+
+
+def load_model(args, rank: int, world_size: int):
+    config = AutoConfig.from_pretrained(args.model, trust_remote_code=True)
+    reference = None
+    if args.tiny:
+        config.n_layers, config.d_model, config.n_heads = 2, 256, 8
+        config.init_device = "cpu"
+        torch.manual_seed(0)  # identical weights on every rank before sharding
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True).to(DTYPES[args.dtype]).eval()
+        if args.check and rank == 0:
+            reference = copy.deepcopy(model)
+        model.get_decoder().enable_tensor_parallel(rank, world_size)
+        return model, reference
+    init_device = config.init_device
+    config.init_device = "meta"
+    model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+    model.config.init_device = init_device
+    model.get_decoder().enable_tensor_parallel(rank, world_size, checkpoint_path=args.model, dtype=DTYPES[args.dtype])
+    return model.eval(), reference
+
+
+@torch.no_grad()
+def generate(model, input_ids: torch.Tensor, args) -> tuple:
+    decoder = model.get_decoder()
+    past = decoder.init_kv_cache(max_seq_len=input_ids.size(1) + args.max_new_tokens, name="static")
+    start = time.perf_counter()
+    out = model(input_ids=input_ids, past_key_values=past, use_cache=True, logits_to_keep=1)
+    prefill = time.perf_counter() - start
+    tokens = []
+    start = time.perf_counter()
+    for step in range(args.max_new_tokens):
+        next_token = sample_next_token(out.logits[:, -1], args.temperature, args.top_k, args.top_p)
+        # Ranks hold identical logits; rank 0's draw keeps sampling in lockstep
+        dist.broadcast(next_token, src=0)
+        tokens.append(next_token)
+        if step == args.max_new_tokens - 1:
+            break
+        out = model(input_ids=next_token, past_key_values=out.past_key_values, use_cache=True, logits_to_keep=1)
+    decode = time.perf_counter() - start
+    return torch.cat(tokens, dim=1), prefill, decode
+
+
+def worker(rank: int, args):
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(args.port))
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    try:
+        if not args.no_pin:
+            pin_cores(rank, args.world_size)
+        model, reference = load_model(args, rank, args.world_size)
+        if args.tiny:
+            torch.manual_seed(1)
+            input_ids = torch.randint(0, model.config.vocab_size, (1, 32))
+            tokenizer = None
+        else:
+            tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+            input_ids = tokenizer(args.prompt, return_tensors="pt").input_ids
+        if reference is not None:
+            with torch.no_grad():
+                expected = reference(input_ids=input_ids).logits.float()
+                actual = model(input_ids=input_ids).logits.float()
+            print(f"max |dlogit| vs unsharded model: {(actual - expected).abs().max():.2e}")
+        elif args.check:
+            with torch.no_grad():
+                model(input_ids=input_ids)  # match rank 0's collectives
+        tokens, prefill, decode = generate(model, input_ids, args)
+        if rank == 0:
+            if tokenizer is not None:
+                print(tokenizer.decode(tokens[0], skip_special_tokens=True))
+            steps = max(tokens.size(1) - 1, 1)
+            print(f"world_size={args.world_size} prefill {prefill * 1000:.1f} ms | decode {decode / steps * 1000:.1f} ms/token")
+    finally:
+        dist.destroy_process_group()
+
+
+def main():
+    args = parse_args()
+    if args.world_size == 1:
+        # Still goes through gloo so the same code path is measured
+        worker(0, args)
+        return
+    mp.spawn(worker, args=(args,), nprocs=args.world_size, join=True)
+
+
+if __name__ == "__main__":
+    main()
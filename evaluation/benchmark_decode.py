@@ -0,0 +1,230 @@
+"""Prefill and per-token decode latency benchmark for the local MPT model.
+
+Examples:
+
+    # full model from the local checkpoint directory
+    python evaluation/benchmark_decode.py --model replit-code-v1-3b --kv_cache static
+
+    # small randomly initialised model with the same architecture, no weights needed
+    python evaluation/benchmark_decode.py --tiny --compare_fast_decode
+
+    # sink cache against full attention once generation runs past the window
+    python evaluation/benchmark_decode.py --tiny --kv_cache sink --window_size 128 --compare_full_attention
+
+    # fully resident model against blocks streamed from the checkpoint, two blocks resident
+    python evaluation/benchmark_decode.py --model replit-code-v1-3b --layer_streaming 2
+
+    # speculative decoding with a draft checkpoint, against the plain decode loop
+    python evaluation/benchmark_decode.py --model replit-code-v1-3b --draft_model replit-draft-4l --speculative_tokens 4
+
+    # n-gram speculation on a prompt that repeats a 32-token span, as boilerplate-heavy code does
+    python evaluation/benchmark_decode.py --model replit-code-v1-3b --ngram --repeat_span 32
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from app.decode import DecodeEngine  # noqa: E402
+from app.speculative import DraftModelProposer, NgramIndex, NgramProposer  # noqa: E402
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--tiny", action="store_true", help="Use a small randomly initialised model with the same architecture")
+    parser.add_argument("--prompt_len", type=int, default=256)
+    parser.add_argument("--new_tokens", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--precision", default="fp32", choices=list(DTYPES))
+    parser.add_argument("--weight_bits", type=int, default=None, choices=[8, 4], help="Quantize weights to int8 or int4 before benchmarking")
+    parser.add_argument("--attn_impl", default=None, help="Override attn_config['attn_impl'], e.g. torch or sdpa")
+    parser.add_argument("--kv_cache", default="static", help="KV cache to decode with: dynamic, static, paged, sink or heavy_hitter")
+    parser.add_argument("--sink_tokens", type=int, default=4, help="Initial tokens the sink cache always keeps")
+    parser.add_argument("--window_size", type=int, default=None, help="Recent tokens the sink and heavy-hitter caches keep")
+    parser.add_argument("--heavy_tokens", type=int, default=None, help="Most-attended tokens the heavy-hitter cache keeps")
+    parser.add_argument("--compare_compiled", action="store_true", help="Also run with the blocks compiled by torch.compile")
+    parser.add_argument("--compare_optimized", action="store_true", help="Also run after optimize_for_inference (checked against the original logits)")
+    parser.add_argument("--compare_fast_decode", action="store_true", help="Also run with the single-token decode fast path disabled")
+    parser.add_argument("--compare_full_attention", action="store_true", help="Also decode with a static cache and report greedy token agreement")
+    parser.add_argument("--layer_streaming", type=int, default=0, metavar="WINDOW", help="Also decode with blocks streamed from disk, WINDOW blocks resident")
+    parser.add_argument("--draft_model", default=None, help="Draft checkpoint for speculative decoding (single sequence)")
+    parser.add_argument("--draft_layers", type=int, default=0, help="Without --draft_model, speculate with a random draft of this many layers (mechanics only)")
+    parser.add_argument("--ngram", action="store_true", help="Speculate with the n-gram index of the prompt instead of a draft model")
+    parser.add_argument("--repeat_span", type=int, default=0, help="Build the prompt by repeating this many random tokens (0 = all random)")
+    parser.add_argument("--speculative_tokens", type=int, default=4)
+    parser.add_argument("--temperature", type=float, default=0.0, help="Sampling temperature of the speculative comparison; 0 is greedy")
+    parser.add_argument("--warmup", type=int, default=1)
+    return parser.parse_args()
+
+
+def load_model(args):
+    config = AutoConfig.from_pretrained(args.model, trust_remote_code=True)
+    config.kv_cache_config = {**config.kv_cache_config, "sink_tokens": args.sink_tokens, "window_size": args.window_size, "heavy_tokens": args.heavy_tokens}
+    if args.attn_impl:
+        config.attn_config = {**config.attn_config, "attn_impl": args.attn_impl}
+    if args.tiny:
+        config.n_layers, config.d_model, config.n_heads = 4, 256, 8
+        config.init_device = "cpu"
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+        model = model.to(dtype=DTYPES[args.precision])
+    else:
+        model = AutoModelForCausalLM.from_pretrained(args.model, config=config, trust_remote_code=True, torch_dtype=DTYPES[args.precision])
+    if args.weight_bits:
+        model.quantize(bits=args.weight_bits)
+    return model.eval()
+
+
+def load_streamed_model(model, args):
+    checkpoint = args.model
+    if args.tiny or args.weight_bits or not os.path.isdir(args.model):
+        checkpoint = tempfile.mkdtemp(prefix="mpt-streaming-")
+        model.save_pretrained(checkpoint)
+    config = type(model.config).from_dict(model.config.to_dict())
+    config.init_device = "meta"
+    streamed = AutoModelForCausalLM.from_config(config, trust_remote_code=True)
+    streamed.get_decoder().enable_layer_streaming(checkpoint, window=args.layer_streaming, dtype=DTYPES[args.precision])
+    return streamed.eval()
+
+
+@torch.no_grad()
+def run_once(model, input_ids, new_tokens, kv_cache):
+    past = model.get_decoder().init_kv_cache(max_seq_len=input_ids.size(1) + new_tokens, name=kv_cache)
+    start = time.perf_counter()
+    out = model(input_ids=input_ids, past_key_values=past, use_cache=True, logits_to_keep=1)
+    prefill = time.perf_counter() - start
+    next_ids = out.logits[:, -1:].argmax(-1)
+    past = out.past_key_values
+    steps, tokens = [], [next_ids]
+    for _ in range(new_tokens):
+        start = time.perf_counter()
+        out = model(input_ids=next_ids, past_key_values=past, use_cache=True, logits_to_keep=1)
+        steps.append(time.perf_counter() - start)
+        next_ids = out.logits[:, -1:].argmax(-1)
+        tokens.append(next_ids)
+        past = out.past_key_values
+    if hasattr(past, "release"):
+        past.release()
+    return prefill, steps, torch.cat(tokens, dim=1)
+
+
+def load_draft(model, args):
+    if args.draft_model:
+        draft = AutoModelForCausalLM.from_pretrained(args.draft_model, trust_remote_code=True, torch_dtype=DTYPES[args.precision])
+    else:
+        config = type(model.config).from_dict(model.config.to_dict())
+        config.n_layers = args.draft_layers
+        config.init_device = "cpu"
+        draft = AutoModelForCausalLM.from_config(config, trust_remote_code=True).to(dtype=DTYPES[args.precision])
+    return draft.eval()
+
+
+def run_engine(engine, input_ids, new_tokens, temperature):
+    generator = torch.Generator().manual_seed(0)
+    start = time.perf_counter()
+    out = engine.generate(input_ids, max_new_tokens=new_tokens, temperature=temperature, generator=generator)
+    return time.perf_counter() - start, out.size(1) - input_ids.size(1), dict(engine.stats)
+
+
+def compare_speculative(model, input_ids, args):
+    input_ids = input_ids[:1]
+    model.get_decoder().decode_fast_path = True
+    plain = DecodeEngine(model)
+    if args.ngram:
+        proposer, name = NgramProposer(NgramIndex()), "n-gram"
+    else:
+        proposer, name = DraftModelProposer(load_draft(model, args)), "draft"
+    speculative = DecodeEngine(model, proposer=proposer, num_speculative_tokens=args.speculative_tokens)
+    for engine in (plain, speculative):
+        for _ in range(args.warmup):
+            run_engine(engine, input_ids, min(8, args.new_tokens), args.temperature)
+    base_time, base_tokens, _ = run_engine(plain, input_ids, args.new_tokens, args.temperature)
+    spec_time, spec_tokens, stats = run_engine(speculative, input_ids, args.new_tokens, args.temperature)
+    acceptance = stats["accepted"] / max(stats["proposed"], 1)
+    print(f"{'decode loop':>24}: {base_tokens / base_time:7.1f} tokens/s")
+    print(
+        f"{f'{name} speculative k={args.speculative_tokens}':>24}: {spec_tokens / spec_time:7.1f} tokens/s | "
+        f"acceptance {acceptance * 100:5.1f}% | {spec_tokens / stats['forwards']:4.2f} tokens per target forward | "
+        f"speedup {base_time / base_tokens / (spec_time / spec_tokens):4.2f}x"
+    )
+
+
+def report(name, prefill, steps):
+    window = max(1, min(64, len(steps) // 4))
+    print(
+        f"{name:>24}: prefill {prefill * 1e3:8.1f} ms | "
+        f"decode mean {statistics.mean(steps) * 1e3:7.2f} ms/token | "
+        f"first {window} {statistics.mean(steps[:window]) * 1e3:7.2f} ms | "
+        f"last {window} {statistics.mean(steps[-window:]) * 1e3:7.2f} ms | "
+        f"{len(steps) / sum(steps):7.1f} tokens/s"
+    )
+
+
+def report_agreement(tokens, reference, window):
+    # Greedy decoding diverges for good after the first differing token
+    match = (tokens == reference).all(dim=0).long()
+    first_diff = int(match.argmin()) if not match.all() else match.numel()
+    print(f"{'token agreement':>24}: {match.float().mean() * 100:5.1f}% | first divergence at generated token {first_diff} (window fills at {window})")
+
+
+def main():
+    args = parse_args()
+    model = load_model(args)
+    torch.manual_seed(0)
+    input_ids = torch.randint(0, model.config.vocab_size, (args.batch_size, args.prompt_len))
+    if args.repeat_span:
+        input_ids = input_ids[:, :args.repeat_span].repeat(1, -(-args.prompt_len // args.repeat_span))[:, :args.prompt_len]
+
+    variants = [(args.kv_cache, "fast decode", True)]
+    if args.compare_fast_decode:
+        variants.append((args.kv_cache, "no fast decode", False))
+    if args.compare_full_attention:
+        variants.append(("static", "fast decode", True))
+    tokens = {}
+    for kv_cache, name, fast in variants:
+        model.get_decoder().decode_fast_path = fast
+        for _ in range(args.warmup):
+            run_once(model, input_ids, min(8, args.new_tokens), kv_cache)
+        prefill, steps, tokens[kv_cache] = run_once(model, input_ids, args.new_tokens, kv_cache)
+        report(f"{kv_cache}/{name}", prefill, steps)
+    if args.draft_model or args.draft_layers or args.ngram:
+        compare_speculative(model, input_ids, args)
+    if args.layer_streaming:
+        streamed = load_streamed_model(model, args)
+        for _ in range(args.warmup):
+            run_once(streamed, input_ids, min(8, args.new_tokens), args.kv_cache)
+        prefill, steps, _ = run_once(streamed, input_ids, args.new_tokens, args.kv_cache)
+        report(f"{args.kv_cache}/streamed x{args.layer_streaming}", prefill, steps)
+    if args.compare_compiled:
+        start = time.perf_counter()
+        compiled = model.get_decoder().compile_blocks(warmup_lengths=(args.prompt_len,), name=args.kv_cache)
+        print(f"{'compile + warmup':>24}: {time.perf_counter() - start:8.1f} s{'' if compiled else ' (failed, eager)'}")
+        prefill, steps, _ = run_once(model, input_ids, args.new_tokens, args.kv_cache)
+        report(f"{args.kv_cache}/compiled", prefill, steps)
+        model.get_decoder().compiled_blocks = None
+    # Optimizing rewrites the model in place, so it runs after every other variant
+    if args.compare_optimized:
+        model.optimize_for_inference(check_input_ids=input_ids[:1, :32], atol=1e-3 if args.precision == "fp32" else 1e-1)
+        model.get_decoder().decode_fast_path = True
+        for _ in range(args.warmup):
+            run_once(model, input_ids, min(8, args.new_tokens), args.kv_cache)
+        prefill, steps, _ = run_once(model, input_ids, args.new_tokens, args.kv_cache)
+        report(f"{args.kv_cache}/optimized", prefill, steps)
+    if args.compare_full_attention and args.kv_cache != "static":
+        if args.kv_cache == "heavy_hitter":
+            kept = (args.heavy_tokens or model.config.max_seq_len // 4) + (args.window_size or model.config.max_seq_len // 4)
+        else:
+            kept = args.sink_tokens + (args.window_size or model.config.max_seq_len // 2)
+        report_agreement(tokens[args.kv_cache], tokens["static"], max(0, kept - args.prompt_len))
+
+
+if __name__ == "__main__":
+    main()
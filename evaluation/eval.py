@@ -1,5 +1,7 @@
 import fnmatch
 import json
+import os
+import sys
 
 import datasets
 import torch
@@ -140,6 +142,11 @@ def parse_args():
         action="store_true",
         help="Whether to save reference solutions/tests",
     )
+    parser.add_argument(
+        "--shared_prefill",
+        action="store_true",
+        help="Prefill each prompt once and decode its batch_size samples from the shared KV cache (app/decode.py)",
+    )
     return parser.parse_args()
 
 
@@ -153,6 +160,35 @@ def pattern_match(patterns, source_list):
     return list(task_names)
 
 
+def enable_shared_prefill(model, tokenizer):
+    """Routes the harness's sampled `generate` calls, one prompt with
+    num_return_sequences=batch_size, through the app's decode loop, which prefills
+    the prompt once instead of once per sample"""
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    from app.decode import DecodeEngine
+
+    engine = DecodeEngine(model, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id)
+    hf_generate = model.generate
+
+    def generate(input_ids=None, num_return_sequences=1, **kwargs):
+        if num_return_sequences == 1 or input_ids.size(0) != 1 or not kwargs.get("do_sample"):
+            return hf_generate(input_ids=input_ids, num_return_sequences=num_return_sequences, **kwargs)
+        max_new_tokens = kwargs.get("max_new_tokens") or kwargs["max_length"] - input_ids.size(1)
+        criteria = kwargs.get("stopping_criteria")
+        return engine.generate(
+            input_ids,
+            attention_mask=kwargs.get("attention_mask"),
+            max_new_tokens=max_new_tokens,
+            temperature=kwargs.get("temperature", 1.0),
+            top_k=kwargs.get("top_k", 0),
+            top_p=kwargs.get("top_p", 1.0),
+            num_return_sequences=num_return_sequences,
+            stopping_criteria=(lambda ids: criteria(ids, None)) if criteria else None,
+        )
+
+    model.generate = generate
+
+
 def main():
     args = parse_args()
     transformers.logging.set_verbosity_error()
@@ -259,6 +295,9 @@ def main():
         tokenizer.decode_backup = tokenizer.decode
         tokenizer.decode = partial(patched_decode, tokenizer)
 
+        if args.shared_prefill:
+            enable_shared_prefill(model, tokenizer)
+
         evaluator = Evaluator(accelerator, model, tokenizer, args)
 
         for task in task_names:
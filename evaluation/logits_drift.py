@@ -0,0 +1,81 @@
+"""Logits drift and decode throughput of reduced-precision CPU inference against fp32.
+
+The same model is run in fp32 and in each requested dtype on identical inputs:
+
+    python evaluation/logits_drift.py --model replit-code-v1-3b --dtypes bf16
+    python evaluation/logits_drift.py --tiny --dtypes bf16 fp16
+"""
+import argparse
+import copy
+import time
+
+import torch
+import torch.nn.functional as F
+from transformers import AutoConfig, AutoModelForCausalLM
+
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--tiny", action="store_true", help="Use a small randomly initialised model with the same architecture")
+    parser.add_argument("--dtypes", nargs="+", default=["bf16"], choices=list(DTYPES))
+    parser.add_argument("--prompt_len", type=int, default=512)
+    parser.add_argument("--new_tokens", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=1)
+    return parser.parse_args()
+
+
+def load_model(args):
+    config = AutoConfig.from_pretrained(args.model, trust_remote_code=True)
+    if args.tiny:
+        config.n_layers, config.d_model, config.n_heads = 4, 256, 8
+        config.init_device = "cpu"
+        return AutoModelForCausalLM.from_config(config, trust_remote_code=True).eval()
+    return AutoModelForCausalLM.from_pretrained(args.model, config=config, trust_remote_code=True, torch_dtype=torch.float32).eval()
+
+
+@torch.no_grad()
+def greedy(model, input_ids, new_tokens):
+    past = model.get_decoder().init_kv_cache(max_seq_len=input_ids.size(1) + new_tokens, name="static")
+    out = model(input_ids=input_ids, past_key_values=past, use_cache=True, logits_to_keep=1)
+    tokens = [out.logits[:, -1:].argmax(-1)]
+    start = time.perf_counter()
+    for _ in range(new_tokens - 1):
+        out = model(input_ids=tokens[-1], past_key_values=out.past_key_values, use_cache=True, logits_to_keep=1)
+        tokens.append(out.logits[:, -1:].argmax(-1))
+    elapsed = time.perf_counter() - start
+    return torch.cat(tokens, dim=1), (new_tokens - 1) / elapsed
+
+
+def main():
+    args = parse_args()
+    reference = load_model(args)
+    torch.manual_seed(0)
+    input_ids = torch.randint(0, reference.config.vocab_size, (args.batch_size, args.prompt_len))
+
+    with torch.no_grad():
+        ref_logits = reference(input_ids=input_ids).logits.float()
+    ref_tokens, ref_tps = greedy(reference, input_ids, args.new_tokens)
+    print(f"{'fp32':>6}: {ref_tps:7.1f} tokens/s")
+
+    ref_logprobs = F.log_softmax(ref_logits, dim=-1)
+    for name in args.dtypes:
+        model = copy.deepcopy(reference).to(dtype=DTYPES[name])
+        with torch.no_grad():
+            logits = model(input_ids=input_ids).logits.float()
+        kl = F.kl_div(F.log_softmax(logits, dim=-1), ref_logprobs, log_target=True, reduction="none").sum(-1)
+        top1 = (logits.argmax(-1) == ref_logits.argmax(-1)).float().mean()
+        tokens, tps = greedy(model, input_ids, args.new_tokens)
+        agree = (tokens == ref_tokens).float().mean()
+        print(
+            f"{name:>6}: {tps:7.1f} tokens/s ({tps / ref_tps:4.2f}x) | "
+            f"max |dlogit| {(logits - ref_logits).abs().max():.4f} | mean KL {kl.mean():.2e} | "
+            f"top-1 agreement {top1 * 100:5.1f}% | greedy agreement {agree * 100:5.1f}%"
+        )
+        del model
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Parity of the exported ONNX prefill/decode graphs against the PyTorch model.
+
+A tiny randomly initialised MPT is exported, then the same prompts (including a
+left-padded row) are run through PyTorch and through onnxruntime on CPU, and
+the logits of the prefill and of every greedy decode step are compared:
+
+    python evaluation/onnx_parity.py
+    python evaluation/onnx_parity.py --model replit-code-v1-3b --full
+"""
+import argparse
+import os
+import sys
+import tempfile
+
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from app.onnx_engine import OnnxCausalLM  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--full", action="store_true", help="Export the real weights instead of a tiny random config")
+    parser.add_argument("--prompt_len", type=int, default=24)
+    parser.add_argument("--new_tokens", type=int, default=16)
+    parser.add_argument("--atol", type=float, default=1e-3)
+    return parser.parse_args()
+
+
+def load_model(args):
+    config = AutoConfig.from_pretrained(args.model, trust_remote_code=True)
+    config.attn_config = {**config.attn_config, "attn_impl": "torch"}
+    if not args.full:
+        config.n_layers, config.d_model, config.n_heads = 2, 128, 4
+        config.max_seq_len, config.vocab_size = 128, 1024
+        config.init_device = "cpu"
+        torch.manual_seed(0)
+        return AutoModelForCausalLM.from_config(config, trust_remote_code=True).eval()
+    return AutoModelForCausalLM.from_pretrained(args.model, config=config, trust_remote_code=True, torch_dtype=torch.float32).eval()
+
+
+def main():
+    args = parse_args()
+    model = load_model(args)
+    torch.manual_seed(1)
+    input_ids = torch.randint(0, model.config.vocab_size, (2, args.prompt_len))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, : args.prompt_len // 3] = 0
+
+    with tempfile.TemporaryDirectory() as onnx_dir:
+        model.export_onnx(onnx_dir)
+        engine = OnnxCausalLM(onnx_dir)
+        feeds = {"input_ids": input_ids.numpy(), "attention_mask": attention_mask.numpy()}
+        ort_logits, *ort_past = engine.prefill.run(None, feeds)
+        with torch.no_grad():
+            out = model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=[() for _ in range(model.config.n_layers)], use_cache=True, logits_to_keep=1)
+        diffs = [np.abs(ort_logits - out.logits[:, -1].numpy()).max()]
+        past = out.past_key_values
+        for _ in range(args.new_tokens):
+            next_token = out.logits[:, -1].argmax(-1, keepdim=True)
+            attention_mask = torch.cat([attention_mask, torch.ones_like(next_token)], dim=1)
+            feeds = {"input_ids": next_token.numpy(), "attention_mask": attention_mask.numpy()}
+            feeds.update(zip(engine.past_names, ort_past))
+            ort_logits, *ort_past = engine.decode.run(None, feeds)
+            with torch.no_grad():
+                out = model(input_ids=next_token, attention_mask=attention_mask, past_key_values=past, use_cache=True, logits_to_keep=1)
+            past = out.past_key_values
+            diffs.append(np.abs(ort_logits - out.logits[:, -1].numpy()).max())
+
+    print(f"prefill max |dlogit| {diffs[0]:.2e} | decode max |dlogit| {max(diffs[1:], default=0.0):.2e} over {len(diffs) - 1} steps")
+    if max(diffs) > args.atol:
+        raise SystemExit(f"ONNX logits differ from PyTorch by up to {max(diffs):.3g} (atol={args.atol})")
+    print("parity OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Perplexity of the local MPT model on a local code corpus, decoded through a KV cache.
+
+Every file is fed through the model `--chunk` tokens at a time, so each chunk
+attends over K/V that earlier chunks left in the cache. Comparing caches
+therefore measures the quality cost of how the cache stores K/V, e.g.:
+
+    python evaluation/perplexity.py --corpus app --kv_cache static int8
+"""
+import argparse
+import glob
+import math
+import os
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--corpus", default=".", help="Directory searched recursively for source files")
+    parser.add_argument("--pattern", default="**/*.py", help="Glob of files to score, relative to --corpus")
+    parser.add_argument("--max_files", type=int, default=50)
+    parser.add_argument("--max_tokens", type=int, default=2048, help="Tokens scored per file")
+    parser.add_argument("--chunk", type=int, default=128, help="Tokens fed through the model per forward")
+    parser.add_argument("--precision", default="fp32", choices=list(DTYPES))
+    parser.add_argument("--kv_cache", nargs="+", default=["static", "int8"], help="KV caches to compare")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def file_nll(model, input_ids, chunk, kv_cache):
+    past = model.get_decoder().init_kv_cache(max_seq_len=input_ids.size(1), name=kv_cache)
+    nll, count = 0.0, 0
+    for start in range(0, input_ids.size(1) - 1, chunk):
+        ids = input_ids[:, start:start + chunk + 1]
+        out = model(input_ids=ids[:, :-1], past_key_values=past, use_cache=True)
+        past = out.past_key_values
+        logprobs = torch.log_softmax(out.logits.float(), dim=-1)
+        nll -= logprobs.gather(-1, ids[:, 1:, None]).sum().item()
+        count += ids.size(1) - 1
+    if hasattr(past, "release"):
+        past.release()
+    return nll, count
+
+
+def main():
+    args = parse_args()
+    tokenizer = AutoTokenizer.from_pretrained(args.model, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model, trust_remote_code=True, torch_dtype=DTYPES[args.precision]).eval()
+    paths = sorted(glob.glob(os.path.join(args.corpus, args.pattern), recursive=True))[: args.max_files]
+    corpus = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            ids = tokenizer(f.read(), return_tensors="pt").input_ids[:, : args.max_tokens]
+        if ids.size(1) > 1:
+            corpus.append(ids)
+    print(f"scoring {sum(ids.size(1) for ids in corpus)} tokens from {len(corpus)} files")
+
+    results = {}
+    for kv_cache in args.kv_cache:
+        nll, count = 0.0, 0
+        for ids in corpus:
+            file_total, file_count = file_nll(model, ids, args.chunk, kv_cache)
+            nll, count = nll + file_total, count + file_count
+        results[kv_cache] = math.exp(nll / count)
+    baseline = results[args.kv_cache[0]]
+    for kv_cache, ppl in results.items():
+        print(f"{kv_cache:>12}: perplexity {ppl:8.4f} | delta {ppl - baseline:+.4f} ({(ppl / baseline - 1) * 100:+.2f}%)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Checks the lean decode loop (app/decode.py) against HF `generate`.
+
+1. Distribution: for random logits, the exact next-token distribution after
+   HF's temperature -> top-k -> top-p warpers is compared with the empirical
+   distribution of `sample_tokens` (total variation distance).
+2. Overhead: per-token decode latency of HF `generate` and of `DecodeEngine`
+   on the same model, prompt and sampling settings.
+
+    python evaluation/sampling_check.py --tiny
+    python evaluation/sampling_check.py --model replit-code-v1-3b --new_tokens 64
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+from transformers.generation.logits_process import LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from app.decode import DecodeEngine  # noqa: E402
+from app.sampling import sample_tokens  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="replit-code-v1-3b", help="Local model directory or Hugging Face repo")
+    parser.add_argument("--tiny", action="store_true", help="Use a small randomly initialised model with the same architecture")
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--top_k", type=int, default=50)
+    parser.add_argument("--top_p", type=float, default=0.95)
+    parser.add_argument("--samples", type=int, default=200_000)
+    parser.add_argument("--prompt_len", type=int, default=128)
+    parser.add_argument("--new_tokens", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=1)
+    return parser.parse_args()
+
+
+def check_distribution(args, vocab_size: int):
+    torch.manual_seed(0)
+    logits = torch.randn(1, vocab_size) * 3
+    warpers = LogitsProcessorList([TemperatureLogitsWarper(args.temperature), TopKLogitsWarper(args.top_k), TopPLogitsWarper(args.top_p)])
+    expected = warpers(torch.zeros(1, 1, dtype=torch.long), logits.clone()).softmax(-1)[0]
+    rows = logits.expand(args.samples, -1)
+    counts = torch.bincount(sample_tokens(rows, args.temperature, args.top_k, args.top_p), minlength=vocab_size).float()
+    empirical = counts / counts.sum()
+    tv = 0.5 * (empirical - expected).abs().sum().item()
+    outside = empirical[expected == 0].sum().item()
+    print(f"sampling: TV distance to HF {tv:.4f} over {args.samples} draws | mass outside HF's support {outside:.2e}")
+
+
+def load_model(args):
+    config = AutoConfig.from_pretrained(args.model, trust_remote_code=True)
+    if args.tiny:
+        config.n_layers, config.d_model, config.n_heads = 4, 256, 8
+        config.init_device = "cpu"
+        return AutoModelForCausalLM.from_config(config, trust_remote_code=True).eval()
+    return AutoModelForCausalLM.from_pretrained(args.model, config=config, trust_remote_code=True, torch_dtype=torch.float32).eval()
+
+
+def per_token_ms(fn, new_tokens: int) -> float:
+    fn(1)  # warm up, and time prefill alone to subtract it
+    start = time.perf_counter()
+    fn(1)
+    prefill = time.perf_counter() - start
+    start = time.perf_counter()
+    fn(new_tokens)
+    return (time.perf_counter() - start - prefill) / (new_tokens - 1) * 1000
+
+
+def main():
+    args = parse_args()
+    model = load_model(args)
+    check_distribution(args, model.config.vocab_size)
+
+    input_ids = torch.randint(0, model.config.vocab_size, (args.batch_size, args.prompt_len))
+    attention_mask = torch.ones_like(input_ids)
+    engine = DecodeEngine(model)
+    sampling = dict(temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+
+    def hf(n):
+        with torch.no_grad():
+            model.generate(input_ids=input_ids, attention_mask=attention_mask, max_new_tokens=n, min_new_tokens=n, do_sample=True, **sampling)
+
+    def lean(n):
+        engine.generate(input_ids, attention_mask=attention_mask, max_new_tokens=n, **sampling)
+
+    hf_ms = per_token_ms(hf, args.new_tokens)
+    lean_ms = per_token_ms(lean, args.new_tokens)
+    print(f"decode: HF generate {hf_ms:.2f} ms/token | DecodeEngine {lean_ms:.2f} ms/token ({hf_ms / lean_ms:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
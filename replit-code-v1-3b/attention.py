@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 from einops import rearrange
 from torch import nn
+from .kv_cache import KVCacheLayer
 from .norm import LPLayerNorm
 
 def _reset_is_causal(num_query_tokens: int, num_key_tokens: int, original_is_causal: bool):
@@ -17,15 +18,19 @@ def _reset_is_causal(num_query_tokens: int, num_key_tokens: int, original_is_cau
     return original_is_causal
 
 def scaled_multihead_dot_product_attention(query, key, value, n_heads, softmax_scale=None, attn_bias=None, key_padding_mask=None, is_causal=False, dropout_p=0.0, training=False, needs_weights=False, multiquery=False):
-    q = rearrange(query, 'b s (h d) -> b h s d', h=n_heads)
-    k = rearrange(key, 'b s (h d) -> b h d s', h=1 if multiquery else n_heads)
-    v = rearrange(value, 'b s (h d) -> b h s d', h=1 if multiquery else n_heads)
-    min_val = torch.finfo(q.dtype).min
+    kv_n_heads = 1 if multiquery else n_heads
+    q = query.view(*query.shape[:2], n_heads, -1).transpose(1, 2)
+    k = key.view(*key.shape[:2], kv_n_heads, -1).permute(0, 2, 3, 1)
+    v = value.view(*value.shape[:2], kv_n_heads, -1).transpose(1, 2)
     (b, _, s_q, d) = q.shape
     s_k = k.size(-1)
     if softmax_scale is None:
         softmax_scale = 1 / math.sqrt(d)
-    attn_weight = q.matmul(k) * softmax_scale
+    attn_weight = q.matmul(k)
+    if attn_weight.dtype == torch.bfloat16:
+        attn_weight = attn_weight.float()
+    attn_weight = attn_weight * softmax_scale
+    min_val = torch.finfo(attn_weight.dtype).min
     if attn_bias is not None:
         if attn_bias.size(-1) != 1 and attn_bias.size(-1) != s_k or (attn_bias.size(-2) != 1 and attn_bias.size(-2) != s_q):
             raise RuntimeError(f'attn_bias (shape: {attn_bias.shape}) is expected to broadcast to shape: {attn_weight.shape}.')
@@ -34,7 +39,7 @@ def scaled_multihead_dot_product_attention(query, key, value, n_heads, softmax_s
         if attn_bias is not None:
             warnings.warn('Propogating key_padding_mask to the attention module ' + 'and applying it within the attention module can cause ' + 'unneccessary computation/memory usage. Consider integrating ' + 'into attn_bias once and passing that to each attention ' + 'module instead.')
         attn_weight = attn_weight.masked_fill(~key_padding_mask.view((b, 1, 1, s_k)), min_val)
-    if is_causal:
+    if is_causal and s_q > 1:
         s = max(s_q, s_k)
         causal_mask = attn_weight.new_ones(s, s, dtype=torch.float16)
         causal_mask = causal_mask.tril()
@@ -42,15 +47,60 @@ def scaled_multihead_dot_product_attention(query, key, value, n_heads, softmax_s
         causal_mask = ~causal_mask
         causal_mask = causal_mask[-s_q:, -s_k:]
         attn_weight = attn_weight.masked_fill(causal_mask.view(1, 1, s_q, s_k), min_val)
-    attn_weight = torch.softmax(attn_weight, dim=-1)
+    attn_weight = torch.softmax(attn_weight, dim=-1).to(dtype=v.dtype)
     if dropout_p:
         attn_weight = torch.nn.functional.dropout(attn_weight, p=dropout_p, training=training, inplace=True)
     out = attn_weight.matmul(v)
-    out = rearrange(out, 'b h s d -> b s (h d)')
+    out = out.transpose(1, 2).reshape(b, s_q, -1)
     if needs_weights:
         return (out, attn_weight)
     return (out, None)
 
+_SDPA_HAS_SCALE = tuple((int(v) for v in torch.__version__.split('.')[:2])) >= (2, 1)
+
+def sdpa_attn_fn(query, key, value, n_heads, softmax_scale=None, attn_bias=None, key_padding_mask=None, is_causal=False, dropout_p=0.0, training=False, needs_weights=False, multiquery=False):
+    if not hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+        raise RuntimeError('attn_impl: sdpa requires torch>=2.0')
+    if needs_weights:
+        raise NotImplementedError('attn_impl: sdpa cannot return attn weights.')
+    kv_n_heads = 1 if multiquery else n_heads
+    q = query.view(*query.shape[:2], n_heads, -1).transpose(1, 2)
+    k = key.view(*key.shape[:2], kv_n_heads, -1).transpose(1, 2)
+    v = value.view(*value.shape[:2], kv_n_heads, -1).transpose(1, 2)
+    if multiquery:
+        k = k.expand(-1, n_heads, -1, -1)
+        v = v.expand(-1, n_heads, -1, -1)
+    min_val = torch.finfo(q.dtype).min
+    (b, _, s_q, d) = q.shape
+    s_k = k.size(-2)
+    if softmax_scale is None:
+        softmax_scale = 1 / math.sqrt(d)
+    attn_mask = None
+    if attn_bias is not None:
+        if attn_bias.size(-1) != 1 and attn_bias.size(-1) != s_k or (attn_bias.size(-2) != 1 and attn_bias.size(-2) != s_q):
+            raise RuntimeError(f'attn_bias (shape: {attn_bias.shape}) is expected to broadcast to shape: {(b, n_heads, s_q, s_k)}.')
+        attn_mask = attn_bias.to(dtype=q.dtype)
+    if key_padding_mask is not None:
+        if attn_mask is None:
+            attn_mask = q.new_zeros(b, 1, 1, s_k)
+        attn_mask = attn_mask.masked_fill(~key_padding_mask.view((b, 1, 1, s_k)), min_val)
+    sdpa_is_causal = False
+    if is_causal and s_q > 1:
+        if attn_mask is None and s_q == s_k:
+            sdpa_is_causal = True
+        else:
+            if attn_mask is None:
+                attn_mask = q.new_zeros(1, 1, s_q, s_k)
+            causal_mask = torch.ones(s_q, s_k, dtype=torch.bool, device=q.device).tril(s_k - s_q)
+            attn_mask = attn_mask.masked_fill(~causal_mask.view(1, 1, s_q, s_k), min_val)
+    scale_kwargs = {'scale': softmax_scale}
+    if not _SDPA_HAS_SCALE:
+        q = q * (softmax_scale * math.sqrt(d))
+        scale_kwargs = {}
+    out = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p if training else 0.0, is_causal=sdpa_is_causal, **scale_kwargs)
+    out = out.transpose(1, 2).reshape(b, s_q, -1)
+    return (out, None)
+
 def check_valid_inputs(*tensors, valid_dtypes=[torch.float16, torch.bfloat16]):
     for tensor in tensors:
         if tensor.dtype not in valid_dtypes:
@@ -115,7 +165,7 @@ def triton_flash_attn_fn(query, key, value, n_heads, softmax_scale=None, attn_bi
 class MultiheadAttention(nn.Module):
     """Multi-head self attention.
 
-    Using torch or triton attention implemetation enables user to also use
+    Using torch, sdpa or triton attention implemetation enables user to also use
     additive bias.
     """
 
@@ -143,6 +193,8 @@ class MultiheadAttention(nn.Module):
             self.attn_fn = triton_flash_attn_fn
             if verbose:
                 warnings.warn('While `attn_impl: triton` can be faster than `attn_impl: flash` ' + 'it uses more memory. When training larger models this can trigger ' + 'alloc retries which hurts performance. If encountered, we recommend ' + 'using `attn_impl: flash` if your model does not use `alibi` or `prefix_lm`.')
+        elif self.attn_impl == 'sdpa':
+            self.attn_fn = sdpa_attn_fn
         elif self.attn_impl == 'torch':
             self.attn_fn = scaled_multihead_dot_product_attention
             if torch.cuda.is_available() and verbose:
@@ -162,20 +214,25 @@ class MultiheadAttention(nn.Module):
             dtype = query.dtype
             query = self.q_ln(query).to(dtype)
             key = self.k_ln(key).to(dtype)
-        if past_key_value is not None:
+        if isinstance(past_key_value, KVCacheLayer):
+            (key, value) = past_key_value.update(key, value)
+        elif past_key_value is not None:
             if len(past_key_value) != 0:
                 key = torch.cat([past_key_value[0], key], dim=1)
                 value = torch.cat([past_key_value[1], value], dim=1)
             past_key_value = (key, value)
         if attn_bias is not None:
             attn_bias = attn_bias[:, :, -query.size(1):, -key.size(1):]
-        (context, attn_weights) = self.attn_fn(query, key, value, self.n_heads, softmax_scale=self.softmax_scale, attn_bias=attn_bias, key_padding_mask=key_padding_mask, is_causal=is_causal, dropout_p=self.attn_dropout_p, training=self.training, needs_weights=needs_weights)
-        return (self.out_proj(context), attn_weights, past_key_value)
+        observe = isinstance(past_key_value, KVCacheLayer) and past_key_value.needs_attn_weights
+        (context, attn_weights) = self.attn_fn(query, key, value, self.n_heads, softmax_scale=self.softmax_scale, attn_bias=attn_bias, key_padding_mask=key_padding_mask, is_causal=is_causal, dropout_p=self.attn_dropout_p, training=self.training, needs_weights=needs_weights or observe)
+        if observe:
+            past_key_value.observe(attn_weights)
+        return (self.out_proj(context), attn_weights if needs_weights else None, past_key_value)
 
 class MultiQueryAttention(nn.Module):
     """Multi-Query self attention.
 
-    Using torch or triton attention implemetation enables user to also use
+    Using torch, sdpa or triton attention implemetation enables user to also use
     additive bias.
     """
 
@@ -204,6 +261,8 @@ class MultiQueryAttention(nn.Module):
             self.attn_fn = triton_flash_attn_fn
             if verbose:
                 warnings.warn('While `attn_impl: triton` can be faster than `attn_impl: flash` ' + 'it uses more memory. When training larger models this can trigger ' + 'alloc retries which hurts performance. If encountered, we recommend ' + 'using `attn_impl: flash` if your model does not use `alibi` or `prefix_lm`.')
+        elif self.attn_impl == 'sdpa':
+            self.attn_fn = sdpa_attn_fn
         elif self.attn_impl == 'torch':
             self.attn_fn = scaled_multihead_dot_product_attention
             if torch.cuda.is_available() and verbose:
@@ -223,20 +282,25 @@ class MultiQueryAttention(nn.Module):
             dtype = query.dtype
             query = self.q_ln(query).to(dtype)
             key = self.k_ln(key).to(dtype)
-        if past_key_value is not None:
+        if isinstance(past_key_value, KVCacheLayer):
+            (key, value) = past_key_value.update(key, value)
+        elif past_key_value is not None:
             if len(past_key_value) != 0:
                 key = torch.cat([past_key_value[0], key], dim=1)
                 value = torch.cat([past_key_value[1], value], dim=1)
             past_key_value = (key, value)
         if attn_bias is not None:
             attn_bias = attn_bias[:, :, -query.size(1):, -key.size(1):]
-        (context, attn_weights) = self.attn_fn(query, key, value, self.n_heads, softmax_scale=self.softmax_scale, attn_bias=attn_bias, key_padding_mask=key_padding_mask, is_causal=is_causal, dropout_p=self.attn_dropout_p, training=self.training, needs_weights=needs_weights, multiquery=True)
-        return (self.out_proj(context), attn_weights, past_key_value)
+        observe = isinstance(past_key_value, KVCacheLayer) and past_key_value.needs_attn_weights
+        (context, attn_weights) = self.attn_fn(query, key, value, self.n_heads, softmax_scale=self.softmax_scale, attn_bias=attn_bias, key_padding_mask=key_padding_mask, is_causal=is_causal, dropout_p=self.attn_dropout_p, training=self.training, needs_weights=needs_weights or observe, multiquery=True)
+        if observe:
+            past_key_value.observe(attn_weights)
+        return (self.out_proj(context), attn_weights if needs_weights else None, past_key_value)
 
 def attn_bias_shape(attn_impl, n_heads, seq_len, alibi, prefix_lm, causal, use_sequence_id):
     if attn_impl == 'flash':
         return None
-    elif attn_impl in ['torch', 'triton']:
+    elif attn_impl in ['torch', 'sdpa', 'triton']:
         if alibi:
             if (prefix_lm or not causal) or use_sequence_id:
                 return (1, n_heads, seq_len, seq_len)
@@ -250,7 +314,7 @@ def attn_bias_shape(attn_impl, n_heads, seq_len, alibi, prefix_lm, causal, use_s
 def build_attn_bias(attn_impl, attn_bias, n_heads, seq_len, causal=False, alibi=False, alibi_bias_max=8):
     if attn_impl == 'flash':
         return None
-    elif attn_impl in ['torch', 'triton']:
+    elif attn_impl in ['torch', 'sdpa', 'triton']:
         if alibi:
             (device, dtype) = (attn_bias.device, attn_bias.dtype)
             attn_bias = attn_bias.add(build_alibi_bias(n_heads, seq_len, full=not causal, alibi_bias_max=alibi_bias_max, device=device, dtype=dtype))
@@ -0,0 +1,58 @@
+"""Reading ``save_pretrained`` checkpoint directories without ``PreTrainedModel.from_pretrained``."""
+import json
+import os
+from typing import Callable, Dict, List, Optional
+import torch
+CHECKPOINT_FILES = ['model.safetensors.index.json', 'model.safetensors', 'pytorch_model.bin.index.json', 'pytorch_model.bin']
+
+def checkpoint_shards(path: str) -> Optional[List[str]]:
+    """Local checkpoint files of a ``save_pretrained`` directory, or None."""
+    for name in CHECKPOINT_FILES:
+        file = os.path.join(path, name)
+        if not os.path.isfile(file):
+            continue
+        if name.endswith('.index.json'):
+            with open(file) as f:
+                weight_map = json.load(f)['weight_map']
+            return [os.path.join(path, shard) for shard in sorted(set(weight_map.values()))]
+        return [file]
+    return None
+
+def load_shard(file: str) -> Dict[str, torch.Tensor]:
+    """Loads one checkpoint file, memory-mapping ``.bin`` files where torch supports it."""
+    if file.endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(file)
+    try:
+        return torch.load(file, map_location='cpu', mmap=True, weights_only=True)
+    except TypeError:
+        return torch.load(file, map_location='cpu')
+
+def open_lazy_checkpoint(path: str) -> Dict[str, Callable[[], torch.Tensor]]:
+    """Maps every tensor name of a checkpoint directory to a function reading it.
+
+    Safetensors files are read one tensor at a time and ``.bin`` files are
+    memory-mapped, so opening a checkpoint does not read its weights. A reader
+    called with an ``index`` tuple of slices reads only that slice.
+    """
+    shards = checkpoint_shards(path)
+    if shards is None:
+        raise FileNotFoundError(f'No checkpoint ({", ".join(CHECKPOINT_FILES)}) found in {path}.')
+    readers = {}
+    for shard in shards:
+        if shard.endswith('.safetensors'):
+            from safetensors import safe_open
+            handle = safe_open(shard, framework='pt')
+            for name in handle.keys():
+                readers[name] = lambda index=None, handle=handle, name=name: handle.get_tensor(name) if index is None else handle.get_slice(name)[index]
+        else:
+            for (name, tensor) in load_shard(shard).items():
+                readers[name] = lambda index=None, tensor=tensor: tensor.clone() if index is None else tensor[index].clone()
+    return readers
+
+def blocks_prefix(readers: Dict[str, Callable[..., torch.Tensor]], path: str) -> str:
+    """The prefix, e.g. ``transformer.``, of an MPT checkpoint's ``blocks.`` tensors."""
+    block_name = next((name for name in readers if name.startswith('blocks.') or '.blocks.' in name), None)
+    if block_name is None:
+        raise ValueError(f'Checkpoint at {path} has no MPT blocks.')
+    return block_name[:block_name.index('blocks.')]
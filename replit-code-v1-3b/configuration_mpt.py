@@ -3,11 +3,13 @@ from typing import Dict, Optional, Union
 from transformers import PretrainedConfig
 attn_config_defaults: Dict = {'attn_type': 'multihead_attention', 'attn_pdrop': 0.0, 'attn_impl': 'triton', 'qk_ln': False, 'clip_qkv': None, 'softmax_scale': None, 'prefix_lm': False, 'attn_uses_sequence_id': False, 'alibi': False, 'alibi_bias_max': 8}
 init_config_defaults: Dict = {'name': 'kaiming_normal_', 'fan_mode': 'fan_in', 'init_nonlinearity': 'relu', 'init_div_is_residual': True, 'emb_init_std': None, 'emb_init_uniform_lim': None, 'init_std': None, 'init_gain': 0.0}
+kv_cache_config_defaults: Dict = {'name': 'dynamic', 'max_seq_len': None, 'block_size': 16, 'num_blocks': None, 'prefill_chunk_size': None, 'sink_tokens': 4, 'window_size': None, 'heavy_tokens': None}
+quant_config_defaults: Dict = {'bits': None, 'group_size': 128}
 
 class MPTConfig(PretrainedConfig):
     model_type = 'mpt'
 
-    def __init__(self, d_model: int=2048, n_heads: int=16, n_layers: int=24, expansion_ratio: int=4, max_seq_len: int=2048, vocab_size: int=50368, resid_pdrop: float=0.0, emb_pdrop: float=0.0, learned_pos_emb: bool=True, attn_config: Dict=attn_config_defaults, init_device: str='cpu', logit_scale: Optional[Union[float, str]]=None, no_bias: bool=False, verbose: int=0, embedding_fraction: float=1.0, norm_type: str='low_precision_layernorm', use_cache: bool=False, init_config: Dict=init_config_defaults, **kwargs):
+    def __init__(self, d_model: int=2048, n_heads: int=16, n_layers: int=24, expansion_ratio: int=4, max_seq_len: int=2048, vocab_size: int=50368, resid_pdrop: float=0.0, emb_pdrop: float=0.0, learned_pos_emb: bool=True, attn_config: Dict=attn_config_defaults, init_device: str='cpu', logit_scale: Optional[Union[float, str]]=None, no_bias: bool=False, verbose: int=0, embedding_fraction: float=1.0, norm_type: str='low_precision_layernorm', use_cache: bool=False, init_config: Dict=init_config_defaults, kv_cache_config: Dict=kv_cache_config_defaults, quant_config: Dict=quant_config_defaults, **kwargs):
         """The MPT configuration class.
 
         Args:
@@ -23,7 +25,7 @@ class MPTConfig(PretrainedConfig):
             attn_config (Dict):  A dictionary used to configure the model's attention module:
                 attn_type (str): type of attention to use. Options: multihead_attention, multiquery_attention
                 attn_pdrop (float): The dropout probability for the attention layers.
-                attn_impl (str): The attention implementation to use. One of 'torch', 'flash', or 'triton'.
+                attn_impl (str): The attention implementation to use. One of 'torch', 'sdpa', 'flash', or 'triton'.
                 qk_ln (bool): Whether to apply layer normalization to the queries and keys in the attention layer.
                 clip_qkv (Optional[float]): If not None, clip the queries, keys, and values in the attention layer to
                     this value.
@@ -61,6 +63,31 @@ class MPTConfig(PretrainedConfig):
                 init_nonlinearity (str): The nonlinearity to use for parameter initialization with kaiming initialization schemes.
                 ---
                 See llmfoundry.models.utils.param_init_fns.py for info on other param init config options
+            kv_cache_config (Dict): A dictionary used to configure the KV cache built for generation:
+                name (str): The cache to use. 'dynamic' grows the legacy ``(key, value)`` tuples with ``torch.cat``,
+                    'static' preallocates per-layer buffers once per sequence and writes into them in place.
+                    'paged' stores K/V in fixed-size blocks taken from a pool shared by all sequences of the model.
+                    'sink' keeps ``sink_tokens`` initial tokens plus a rolling window of recent tokens, so generation can
+                    continue past ``max_seq_len`` with constant memory. Requires alibi.
+                    'heavy_hitter' keeps a rolling window of recent tokens plus the ``heavy_tokens`` older tokens that
+                    accumulated the most attention, evicting the rest. Requires alibi and attn_impl 'torch'.
+                    'int8' preallocates like 'static' but stores K/V as int8 with a scale per token and head.
+                max_seq_len (Optional[int]): Number of tokens a preallocated ('static' or 'int8') cache is sized for. Defaults to ``max_seq_len``.
+                block_size (int): Number of tokens per block of the paged cache.
+                num_blocks (Optional[int]): Number of blocks in the shared paged pool. Defaults to enough blocks
+                    for a single ``max_seq_len`` sequence.
+                prefill_chunk_size (Optional[int]): If set, prompts longer than this many tokens are fed through the
+                    model in chunks of this size during inference, filling the KV cache incrementally so that peak
+                    activation memory is bounded by the chunk size rather than the prompt length.
+                sink_tokens (int): Number of initial "attention sink" tokens the sink cache always keeps.
+                window_size (Optional[int]): Number of recent tokens the sink and heavy-hitter caches keep. Defaults to
+                    ``max_seq_len // 2`` for the sink cache and ``max_seq_len // 4`` for the heavy-hitter cache.
+                heavy_tokens (Optional[int]): Number of high-attention tokens the heavy-hitter cache keeps beyond its
+                    recent window. Defaults to ``max_seq_len // 4``.
+            quant_config (Dict): A dictionary describing weight-only quantization of the checkpoint:
+                bits (Optional[int]): None for full precision weights, or 8 or 4 to store the attention and FFN
+                    linears and the tied ``wte`` embedding as int8 or packed int4.
+                group_size (int): Number of consecutive input features sharing one quantization scale.
         """
         self.d_model = d_model
         self.n_heads = n_heads
@@ -80,6 +107,8 @@ class MPTConfig(PretrainedConfig):
         self.norm_type = norm_type
         self.use_cache = use_cache
         self.init_config = init_config
+        self.kv_cache_config = kv_cache_config
+        self.quant_config = quant_config
         if 'name' in kwargs:
             del kwargs['name']
         if 'loss_fn' in kwargs:
@@ -96,23 +125,35 @@ class MPTConfig(PretrainedConfig):
     def _validate_config(self):
         self.attn_config = self._set_config_defaults(self.attn_config, attn_config_defaults)
         self.init_config = self._set_config_defaults(self.init_config, init_config_defaults)
+        self.kv_cache_config = self._set_config_defaults(self.kv_cache_config, kv_cache_config_defaults)
+        self.quant_config = self._set_config_defaults(self.quant_config, quant_config_defaults)
         if self.d_model % self.n_heads != 0:
             raise ValueError('d_model must be divisible by n_heads')
         if any((prob < 0 or prob > 1 for prob in [self.attn_config['attn_pdrop'], self.resid_pdrop, self.emb_pdrop])):
             raise ValueError("self.attn_config['attn_pdrop'], resid_pdrop, emb_pdrop are probabilities and must be between 0 and 1")
-        if self.attn_config['attn_impl'] not in ['torch', 'flash', 'triton']:
+        if self.attn_config['attn_impl'] not in ['torch', 'sdpa', 'flash', 'triton']:
             raise ValueError(f"Unknown attn_impl={self.attn_config['attn_impl']}")
-        if self.attn_config['prefix_lm'] and self.attn_config['attn_impl'] not in ['torch', 'triton']:
-            raise NotImplementedError('prefix_lm only implemented with torch and triton attention.')
-        if self.attn_config['alibi'] and self.attn_config['attn_impl'] not in ['torch', 'triton']:
-            raise NotImplementedError('alibi only implemented with torch and triton attention.')
-        if self.attn_config['attn_uses_sequence_id'] and self.attn_config['attn_impl'] not in ['torch', 'triton']:
-            raise NotImplementedError('attn_uses_sequence_id only implemented with torch and triton attention.')
+        if self.attn_config['prefix_lm'] and self.attn_config['attn_impl'] not in ['torch', 'sdpa', 'triton']:
+            raise NotImplementedError('prefix_lm only implemented with torch, sdpa and triton attention.')
+        if self.attn_config['alibi'] and self.attn_config['attn_impl'] not in ['torch', 'sdpa', 'triton']:
+            raise NotImplementedError('alibi only implemented with torch, sdpa and triton attention.')
+        if self.attn_config['attn_uses_sequence_id'] and self.attn_config['attn_impl'] not in ['torch', 'sdpa', 'triton']:
+            raise NotImplementedError('attn_uses_sequence_id only implemented with torch, sdpa and triton attention.')
         if self.embedding_fraction > 1 or self.embedding_fraction <= 0:
             raise ValueError('model.embedding_fraction must be between 0 (exclusive) and 1 (inclusive)!')
         if isinstance(self.logit_scale, str) and self.logit_scale != 'inv_sqrt_d_model':
             raise ValueError(f"self.logit_scale={self.logit_scale!r} is not recognized as an option; use numeric value or 'inv_sqrt_d_model'.")
         if self.init_config.get('name', None) is None:
             raise ValueError(f"self.init_config={self.init_config!r} 'name' needs to be set.")
+        if self.kv_cache_config['name'] not in ['dynamic', 'static', 'paged', 'sink', 'heavy_hitter', 'int8']:
+            raise ValueError(f"Unknown kv_cache_config name={self.kv_cache_config['name']}")
+        if self.kv_cache_config['name'] in ['sink', 'heavy_hitter'] and (not self.attn_config['alibi']):
+            raise NotImplementedError(f"The {self.kv_cache_config['name']} KV cache is only implemented for models using alibi.")
+        if self.kv_cache_config['name'] == 'heavy_hitter' and self.attn_config['attn_impl'] != 'torch':
+            raise NotImplementedError("The heavy_hitter KV cache needs attention weights and is only implemented for attn_impl: torch.")
+        if self.quant_config['bits'] not in [None, 8, 4]:
+            raise ValueError(f"quant_config bits={self.quant_config['bits']} is not supported; use None, 8 or 4.")
+        if self.quant_config['bits'] and self.d_model % self.quant_config['group_size'] != 0:
+            raise ValueError(f"d_model must be divisible by quant_config group_size={self.quant_config['group_size']}.")
         if not self.learned_pos_emb and (not self.attn_config['alibi']):
             raise ValueError(f'Positional information must be provided to the model using either learned_pos_emb or alibi.')
\ No newline at end of file
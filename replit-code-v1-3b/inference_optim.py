@@ -0,0 +1,85 @@
+"""Load-time graph simplifications for serving an already trained model."""
+from typing import Optional
+import torch
+import torch.nn as nn
+from .blocks import MPTBlock
+from .norm import RMSNorm
+
+@torch.no_grad()
+def fold_norm_into_linear(norm: nn.Module, linear: nn.Linear):
+    """Moves the affine parameters of ``norm`` into the ``linear`` it feeds.
+
+    ``W (n(x) * g + b) + c == (W * g) n(x) + (W b + c)``, so after folding the
+    norm only normalizes and the linear applies the scale and shift.
+    """
+    if isinstance(norm, nn.LayerNorm):
+        (weight, bias) = (norm.weight, norm.bias)
+    elif isinstance(norm, RMSNorm):
+        (weight, bias) = (norm.weight, None)
+    else:
+        raise NotImplementedError(f'Cannot fold {norm.__class__.__name__} into a linear layer.')
+    if bias is not None:
+        shift = linear.weight.float() @ bias.float()
+        if linear.bias is None:
+            linear.bias = nn.Parameter(shift.to(linear.weight.dtype))
+        else:
+            linear.bias.add_(shift.to(linear.bias.dtype))
+    if weight is not None:
+        linear.weight.mul_(weight.to(linear.weight.dtype))
+    norm.register_parameter('weight', None)
+    if isinstance(norm, nn.LayerNorm):
+        norm.register_parameter('bias', None)
+
+def optimize_for_inference(model: nn.Module, prepack: bool=True, check_input_ids: Optional[torch.LongTensor]=None, atol: float=0.001) -> nn.Module:
+    """Strips training-only structure from an MPT model, in place.
+
+    * dropout modules become ``nn.Identity`` and ``embedding_fraction`` is
+      reset to 1, which only affects gradients;
+    * the affine parameters of ``norm_1`` and ``norm_2`` are folded into
+      ``Wqkv`` and ``up_proj``;
+    * with ``prepack``, linears on a CPU with oneDNN are converted to
+      ``MkldnnLinear``, which keeps its weight in the backend's blocked layout
+      instead of reordering it on every call. The tied ``wte`` head is left
+      dense.
+
+    If ``check_input_ids`` is given, the logits of the model before and after
+    the pass are compared and a ``RuntimeError`` is raised if they differ by
+    more than ``atol``. The result is meant for serving: prepacked weights
+    are not parameters, so do not ``save_pretrained`` it.
+    """
+    decoder = model.get_decoder() if hasattr(model, 'get_decoder') else model
+    if getattr(decoder, 'block_streamer', None) is not None:
+        raise ValueError('optimize_for_inference cannot rewrite blocks that are streamed from disk.')
+    model.eval()
+    reference = None
+    if check_input_ids is not None:
+        with torch.no_grad():
+            reference = model(input_ids=check_input_ids, use_cache=False).logits.float()
+    for module in list(model.modules()):
+        for (name, child) in list(module.named_children()):
+            if isinstance(child, nn.Dropout):
+                setattr(module, name, nn.Identity())
+    if hasattr(decoder, 'embedding_fraction'):
+        decoder.embedding_fraction = 1
+    for block in model.modules():
+        if not isinstance(block, MPTBlock):
+            continue
+        for (norm, linear) in ((block.norm_1, getattr(block.attn, 'Wqkv', None)), (block.norm_2, getattr(block.ffn, 'up_proj', None))):
+            if isinstance(linear, nn.Linear) and isinstance(norm, (nn.LayerNorm, RMSNorm)):
+                fold_norm_into_linear(norm, linear)
+    if prepack:
+        param = next(model.parameters())
+        bf16_supported = param.dtype == torch.bfloat16 and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        if param.device.type == 'cpu' and torch.backends.mkldnn.is_available() and (param.dtype == torch.float32 or bf16_supported):
+            from torch.utils.mkldnn import MkldnnLinear
+            for module in list(model.modules()):
+                for (name, child) in list(module.named_children()):
+                    if type(child) is nn.Linear and child.weight.dtype == param.dtype:
+                        setattr(module, name, MkldnnLinear(child, param.dtype))
+    if reference is not None:
+        with torch.no_grad():
+            logits = model(input_ids=check_input_ids, use_cache=False).logits.float()
+        max_diff = (logits - reference).abs().max().item()
+        if max_diff > atol:
+            raise RuntimeError(f'optimize_for_inference changed the logits by up to {max_diff:.3g} (atol={atol}).')
+    return model
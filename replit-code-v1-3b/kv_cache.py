@@ -0,0 +1,606 @@
+"""Key/value caches for incremental decoding.
+
+The legacy cache format is a list holding one ``(key, value)`` tuple per
+layer that every attention layer grows with ``torch.cat``. The caches in this
+module keep the same list-of-layers shape, so ``past_key_values[i][0]`` still
+returns the cached keys of layer ``i``, but store K/V in buffers that are
+written in place.
+"""
+import math
+import threading
+from typing import List, Optional, Tuple
+import torch
+
+class KVCacheLayer:
+    """Key/value storage for a single attention layer.
+
+    Subclasses implement ``update``, which stores the new ``key`` and ``value``
+    (each of shape ``(batch, seq, kv_dim)``) and returns the full cached
+    ``(key, value)`` that the attention function should attend over.
+
+    ``seq_len`` is the number of tokens held in the cache and ``seen_tokens``
+    the number of tokens written to it; they differ once a cache evicts.
+
+    Layers that set ``needs_attn_weights`` are passed the softmaxed attention
+    weights of every forward through ``observe`` after ``update``.
+    """
+    seq_len: int = 0
+    needs_attn_weights: bool = False
+
+    @property
+    def seen_tokens(self) -> int:
+        return self.seq_len
+
+    def update(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        raise NotImplementedError
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        raise NotImplementedError
+
+    def crop(self, length: int):
+        raise NotImplementedError
+
+    def expand(self, num_sequences: int):
+        raise NotImplementedError(f'{self.__class__.__name__} cannot be expanded to several sequences.')
+
+    def observe(self, attn_weights: torch.Tensor):
+        pass
+
+    def __len__(self):
+        return 2 if self.seq_len > 0 else 0
+
+    def __getitem__(self, idx):
+        return self.get()[idx]
+
+    def __iter__(self):
+        return iter(self.get() if self.seq_len > 0 else ())
+
+def _repeat_rows(x: torch.Tensor, num_sequences: int) -> torch.Tensor:
+    if x.size(0) == 1:
+        return x.expand(num_sequences, *x.shape[1:])
+    return x.repeat_interleave(num_sequences, dim=0)
+
+def _repeat_prefix(buffer: torch.Tensor, num_sequences: int, length: int) -> torch.Tensor:
+    out = buffer.new_empty(buffer.size(0) * num_sequences, *buffer.shape[1:])
+    out[:, :length].copy_(buffer[:, :length].repeat_interleave(num_sequences, dim=0))
+    return out
+
+class StaticKVCacheLayer(KVCacheLayer):
+    """Key/value buffers preallocated once for ``max_seq_len`` tokens.
+
+    Buffers are allocated on the first ``update`` so that their batch size,
+    width, dtype and device follow the attention layer that fills them.
+    """
+
+    def __init__(self, max_seq_len: int):
+        self.max_seq_len = max_seq_len
+        self.key: Optional[torch.Tensor] = None
+        self.value: Optional[torch.Tensor] = None
+        self.seq_len = 0
+
+    def update(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.key is None:
+            self.key = key.new_empty(key.size(0), self.max_seq_len, key.size(-1))
+            self.value = value.new_empty(value.size(0), self.max_seq_len, value.size(-1))
+        end = self.seq_len + key.size(1)
+        if end > self.max_seq_len:
+            raise ValueError(f'Cannot cache {end} tokens, the static KV cache was allocated for max_seq_len={self.max_seq_len}.')
+        self.key[:, self.seq_len:end].copy_(key)
+        self.value[:, self.seq_len:end].copy_(value)
+        self.seq_len = end
+        return (self.key[:, :end], self.value[:, :end])
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        if self.key is None:
+            return ()
+        return (self.key[:, :self.seq_len], self.value[:, :self.seq_len])
+
+    def crop(self, length: int):
+        self.seq_len = min(self.seq_len, max(length, 0))
+
+    def expand(self, num_sequences: int):
+        if self.key is not None:
+            (self.key, self.value) = (_repeat_prefix(self.key, num_sequences, self.seq_len), _repeat_prefix(self.value, num_sequences, self.seq_len))
+
+class KVCache(list):
+    """A list of per-layer caches that can stand in for legacy ``past_key_values``.
+
+    ``decode_state`` holds per-sequence values the model precomputes for its
+    single-token decode path; it is reset when the cache is emptied.
+    """
+    layer_class = KVCacheLayer
+    decode_state = None
+
+    def __init__(self, n_layers: int, **layer_kwargs):
+        super().__init__((self.layer_class(**layer_kwargs) for _ in range(n_layers)))
+
+    @property
+    def seq_len(self) -> int:
+        return self[0].seq_len if len(self) else 0
+
+    @property
+    def seen_tokens(self) -> int:
+        return self[0].seen_tokens if len(self) else 0
+
+    def align_attention_mask(self, attention_mask: Optional[torch.Tensor], num_new_tokens: int) -> Optional[torch.Tensor]:
+        """Maps a mask over every seen and new token onto the cached and new keys."""
+        return attention_mask
+
+    def crop(self, length: int):
+        """Discards cached tokens past ``length``, e.g. to roll back rejected tokens."""
+        for layer in self:
+            layer.crop(length)
+        if length <= 0:
+            self.decode_state = None
+
+    def expand(self, num_sequences: int):
+        """Repeats every cached sequence ``num_sequences`` times, in place.
+
+        Used to prefill a prompt once and decode several samples from it; rows
+        are ordered like ``repeat_interleave``. ``decode_state`` does not depend
+        on the batch size and is kept.
+        """
+        for layer in self:
+            layer.expand(num_sequences)
+
+    def to_legacy(self) -> List[Tuple[torch.Tensor, ...]]:
+        return [tuple(layer) for layer in self]
+
+class StaticKVCache(KVCache):
+    """KV cache sized once per sequence and written in place on every step.
+
+    Replaces the per-step ``torch.cat`` of the legacy cache, which copies the
+    whole K/V history of every layer for each generated token.
+    """
+    layer_class = StaticKVCacheLayer
+
+    def __init__(self, n_layers: int, max_seq_len: int):
+        super().__init__(n_layers, max_seq_len=max_seq_len)
+
+class KVBlockPool:
+    """A shared pool of fixed-size K/V blocks for many concurrent sequences.
+
+    Each layer owns a ``(num_blocks, block_size, kv_dim)`` key and value tensor,
+    allocated on first use. Sequences take blocks from the pool as tokens
+    arrive and hand them back when released, so memory is committed per block
+    instead of per worst-case sequence. Blocks are reference counted so that
+    several sequences can share the same prefix blocks.
+    """
+
+    def __init__(self, n_layers: int, num_blocks: int, block_size: int=16):
+        self.n_layers = n_layers
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.key_blocks: List[Optional[torch.Tensor]] = [None] * n_layers
+        self.value_blocks: List[Optional[torch.Tensor]] = [None] * n_layers
+        self.ref_counts = [0] * num_blocks
+        self._free_blocks = list(range(num_blocks - 1, -1, -1))
+        self._lock = threading.Lock()
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free_blocks)
+
+    def allocate(self) -> int:
+        with self._lock:
+            if not self._free_blocks:
+                raise RuntimeError(f'KV block pool is exhausted (num_blocks={self.num_blocks}, block_size={self.block_size}).')
+            block = self._free_blocks.pop()
+            self.ref_counts[block] = 1
+            return block
+
+    def share(self, block: int):
+        with self._lock:
+            self.ref_counts[block] += 1
+
+    def free(self, block: int):
+        with self._lock:
+            self.ref_counts[block] -= 1
+            if self.ref_counts[block] == 0:
+                self._free_blocks.append(block)
+
+    def copy_block(self, block: int) -> int:
+        """Moves one reference of ``block`` to a newly allocated copy of it, for every layer."""
+        new_block = self.allocate()
+        for (key_blocks, value_blocks) in zip(self.key_blocks, self.value_blocks):
+            if key_blocks is not None:
+                key_blocks[new_block].copy_(key_blocks[block])
+                value_blocks[new_block].copy_(value_blocks[block])
+        self.free(block)
+        return new_block
+
+    def storage(self, layer_idx: int, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.key_blocks[layer_idx] is None:
+            with self._lock:
+                if self.key_blocks[layer_idx] is None:
+                    self.value_blocks[layer_idx] = value.new_empty(self.num_blocks, self.block_size, value.size(-1))
+                    self.key_blocks[layer_idx] = key.new_empty(self.num_blocks, self.block_size, key.size(-1))
+        return (self.key_blocks[layer_idx], self.value_blocks[layer_idx])
+
+class BlockTables:
+    """Per-row lists of pool blocks shared by all layers of one paged cache."""
+
+    def __init__(self, pool: KVBlockPool):
+        self.pool = pool
+        self.tables: List[List[int]] = []
+        self._tensor: Optional[torch.Tensor] = None
+
+    def reserve(self, batch_size: int, num_tokens: int):
+        if not self.tables:
+            self.tables = [[] for _ in range(batch_size)]
+        n_blocks = math.ceil(num_tokens / self.pool.block_size)
+        for table in self.tables:
+            while len(table) < n_blocks:
+                table.append(self.pool.allocate())
+                self._tensor = None
+
+    def slots(self, start: int, end: int, device) -> torch.Tensor:
+        """Flat ``block * block_size + offset`` indices of token positions ``[start, end)``."""
+        pos = torch.arange(start, end, device=device)
+        return self.as_tensor(device)[:, pos // self.pool.block_size] * self.pool.block_size + pos % self.pool.block_size
+
+    def as_tensor(self, device) -> torch.Tensor:
+        if self._tensor is None or self._tensor.device != device:
+            self._tensor = torch.tensor(self.tables, dtype=torch.long, device=device)
+        return self._tensor
+
+    def fork(self, num_sequences: int):
+        """Repeats every row ``num_sequences`` times; the copies share the row's blocks."""
+        for table in self.tables:
+            for block in table:
+                for _ in range(num_sequences - 1):
+                    self.pool.share(block)
+        self.tables = [list(table) for table in self.tables for _ in range(num_sequences)]
+        self._tensor = None
+
+    def unshare(self, start: int, end: int):
+        """Copy-on-write: gives each row a private copy of shared blocks holding positions ``[start, end)``."""
+        first = start // self.pool.block_size
+        for table in self.tables:
+            for idx in range(first, min(len(table), math.ceil(end / self.pool.block_size))):
+                if self.pool.ref_counts[table[idx]] > 1:
+                    table[idx] = self.pool.copy_block(table[idx])
+                    self._tensor = None
+
+    def truncate(self, num_tokens: int):
+        n_blocks = math.ceil(num_tokens / self.pool.block_size)
+        for table in self.tables:
+            while len(table) > n_blocks:
+                self.pool.free(table.pop())
+                self._tensor = None
+
+def gather_kv_blocks(blocks: torch.Tensor, block_table: torch.Tensor, seq_len: int) -> torch.Tensor:
+    """Reads ``(batch, seq_len, kv_dim)`` keys or values through a ``(batch, n_blocks)`` block table."""
+    (b, n_blocks) = block_table.shape
+    block_size = blocks.size(1)
+    return blocks.index_select(0, block_table.view(-1)).view(b, n_blocks * block_size, blocks.size(-1))[:, :seq_len]
+
+class PagedKVCacheLayer(KVCacheLayer):
+    """Writes K/V into pool blocks and reads them back through the block table."""
+
+    def __init__(self, pool: KVBlockPool, layer_idx: int, block_tables: BlockTables):
+        self.pool = pool
+        self.layer_idx = layer_idx
+        self.block_tables = block_tables
+        self.seq_len = 0
+
+    def update(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        (key_blocks, value_blocks) = self.pool.storage(self.layer_idx, key, value)
+        end = self.seq_len + key.size(1)
+        self.block_tables.reserve(key.size(0), end)
+        self.block_tables.unshare(self.seq_len, end)
+        slots = self.block_tables.slots(self.seq_len, end, key.device).reshape(-1)
+        key_blocks.view(-1, key_blocks.size(-1)).index_copy_(0, slots, key.reshape(-1, key.size(-1)))
+        value_blocks.view(-1, value_blocks.size(-1)).index_copy_(0, slots, value.reshape(-1, value.size(-1)))
+        self.seq_len = end
+        return self.get()
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        if self.seq_len == 0:
+            return ()
+        block_table = self.block_tables.as_tensor(self.pool.key_blocks[self.layer_idx].device)
+        return (gather_kv_blocks(self.pool.key_blocks[self.layer_idx], block_table, self.seq_len), gather_kv_blocks(self.pool.value_blocks[self.layer_idx], block_table, self.seq_len))
+
+    def crop(self, length: int):
+        self.seq_len = min(self.seq_len, max(length, 0))
+
+class PagedKVCache(KVCache):
+    """KV cache for one batch of sequences backed by a shared ``KVBlockPool``.
+
+    Call ``release`` once generation is done to return the blocks to the pool.
+    """
+
+    def __init__(self, n_layers: int, pool: KVBlockPool):
+        self.pool = pool
+        self.block_tables = BlockTables(pool)
+        if pool.n_layers != n_layers:
+            raise ValueError(f'KV block pool was built for {pool.n_layers} layers, expected {n_layers}.')
+        list.__init__(self, (PagedKVCacheLayer(pool, layer_idx, self.block_tables) for layer_idx in range(n_layers)))
+
+    def crop(self, length: int):
+        super().crop(length)
+        self.block_tables.truncate(self.seq_len)
+
+    def expand(self, num_sequences: int):
+        """Shares the cached blocks between the copies; a copy's partly filled last
+        block is only duplicated when it writes to it."""
+        self.block_tables.fork(num_sequences)
+
+    def release(self):
+        self.crop(0)
+
+    def __del__(self):
+        self.release()
+
+
+class SinkKVCacheLayer(KVCacheLayer):
+    """Keeps the first ``sink_tokens`` tokens plus a rolling window of recent ones.
+
+    New tokens attend over the sinks, the window and themselves; the cache is
+    trimmed back to ``sink_tokens + window_size`` afterwards.
+    """
+
+    def __init__(self, sink_tokens: int, window_size: int):
+        self.sink_tokens = sink_tokens
+        self.window_size = window_size
+        self.key: Optional[torch.Tensor] = None
+        self.value: Optional[torch.Tensor] = None
+        self.seq_len = 0
+        self._seen_tokens = 0
+
+    @property
+    def seen_tokens(self) -> int:
+        return self._seen_tokens
+
+    def update(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        self._seen_tokens += key.size(1)
+        if self.key is not None:
+            key = torch.cat([self.key, key], dim=1)
+            value = torch.cat([self.value, value], dim=1)
+        if key.size(1) > self.sink_tokens + self.window_size:
+            self.key = torch.cat([key[:, :self.sink_tokens], key[:, -self.window_size:]], dim=1)
+            self.value = torch.cat([value[:, :self.sink_tokens], value[:, -self.window_size:]], dim=1)
+        else:
+            (self.key, self.value) = (key, value)
+        self.seq_len = self.key.size(1)
+        return (key, value)
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        if self.key is None:
+            return ()
+        return (self.key, self.value)
+
+    def crop(self, length: int):
+        length = max(length, 0)
+        if length >= self._seen_tokens:
+            return
+        if self._seen_tokens != self.seq_len:
+            raise NotImplementedError('Cannot roll back a sink KV cache that has already evicted tokens.')
+        self._seen_tokens = self.seq_len = length
+        if length == 0:
+            (self.key, self.value) = (None, None)
+        else:
+            (self.key, self.value) = (self.key[:, :length], self.value[:, :length])
+
+    def expand(self, num_sequences: int):
+        if self.key is not None:
+            (self.key, self.value) = (_repeat_rows(self.key, num_sequences), _repeat_rows(self.value, num_sequences))
+
+class SinkKVCache(KVCache):
+    """Attention-sink streaming cache with constant memory per sequence.
+
+    Holds ``sink_tokens`` initial tokens and the ``window_size`` most recent
+    ones, so generation can run past ``max_seq_len`` at a constant per-step
+    cost. Cached keys are treated as contiguous, so ALiBi distances are taken
+    relative to the window rather than to absolute positions.
+    """
+    layer_class = SinkKVCacheLayer
+
+    def __init__(self, n_layers: int, sink_tokens: int=4, window_size: int=1024):
+        super().__init__(n_layers, sink_tokens=sink_tokens, window_size=window_size)
+        self.sink_tokens = sink_tokens
+
+    def align_attention_mask(self, attention_mask: Optional[torch.Tensor], num_new_tokens: int) -> Optional[torch.Tensor]:
+        if attention_mask is None or self.seen_tokens == self.seq_len:
+            return attention_mask
+        recent = self.seq_len - self.sink_tokens + num_new_tokens
+        return torch.cat([attention_mask[:, :self.sink_tokens], attention_mask[:, -recent:]], dim=1)
+
+class HeavyHitterKVCacheLayer(KVCacheLayer):
+    """Keeps the ``window_size`` most recent tokens plus the ``heavy_tokens``
+    older ones that received the most attention (heavy-hitter / H2O eviction).
+
+    Attention mass is accumulated per sequence and cached token over all heads
+    and queries; once more than ``heavy_tokens + window_size`` tokens are
+    cached, the lowest-scoring tokens outside the recent window are evicted.
+    """
+    needs_attn_weights = True
+
+    def __init__(self, heavy_tokens: int, window_size: int):
+        self.heavy_tokens = heavy_tokens
+        self.window_size = window_size
+        self.key: Optional[torch.Tensor] = None
+        self.value: Optional[torch.Tensor] = None
+        self.scores: Optional[torch.Tensor] = None
+        self.key_mask: Optional[torch.Tensor] = None
+        self.seq_len = 0
+        self._seen_tokens = 0
+
+    @property
+    def seen_tokens(self) -> int:
+        return self._seen_tokens
+
+    def update(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        self._seen_tokens += key.size(1)
+        new_scores = key.new_zeros(key.shape[:2], dtype=torch.float32)
+        if self.key is not None:
+            key = torch.cat([self.key, key], dim=1)
+            value = torch.cat([self.value, value], dim=1)
+            new_scores = torch.cat([self.scores, new_scores], dim=1)
+        (self.key, self.value, self.scores) = (key, value, new_scores)
+        self.seq_len = key.size(1)
+        return (key, value)
+
+    def observe(self, attn_weights: torch.Tensor):
+        weights = attn_weights.float().sum(dim=1)
+        if self.key_mask is not None:
+            weights = weights * self.key_mask[:, -weights.size(1):, None]
+        self.scores += weights.sum(dim=1)
+        scores = self.scores
+        if self.key_mask is not None:
+            scores = scores.masked_fill(~self.key_mask, -1.0)
+        if self.seq_len <= self.heavy_tokens + self.window_size:
+            return
+        older = self.seq_len - self.window_size
+        heavy = scores[:, :older].topk(self.heavy_tokens, dim=1).indices.sort(dim=1).values
+        recent = torch.arange(older, self.seq_len, device=heavy.device).expand(heavy.size(0), -1)
+        keep = torch.cat([heavy, recent], dim=1)
+        self.key = self.key.gather(1, keep.unsqueeze(-1).expand(-1, -1, self.key.size(-1)))
+        self.value = self.value.gather(1, keep.unsqueeze(-1).expand(-1, -1, self.value.size(-1)))
+        self.scores = self.scores.gather(1, keep)
+        self.seq_len = keep.size(1)
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        if self.key is None:
+            return ()
+        return (self.key, self.value)
+
+    def crop(self, length: int):
+        length = max(length, 0)
+        if length >= self._seen_tokens:
+            return
+        if self._seen_tokens != self.seq_len:
+            raise NotImplementedError('Cannot roll back a heavy-hitter KV cache that has already evicted tokens.')
+        self._seen_tokens = self.seq_len = length
+        if length == 0:
+            (self.key, self.value, self.scores) = (None, None, None)
+        else:
+            (self.key, self.value, self.scores) = (self.key[:, :length], self.value[:, :length], self.scores[:, :length])
+
+    def expand(self, num_sequences: int):
+        if self.key is not None:
+            (self.key, self.value) = (_repeat_rows(self.key, num_sequences), _repeat_rows(self.value, num_sequences))
+            self.scores = self.scores.repeat_interleave(num_sequences, dim=0)
+
+class HeavyHitterKVCache(KVCache):
+    """Heavy-hitter eviction cache holding at most ``heavy_tokens + window_size``
+    tokens per sequence.
+
+    Each layer evicts different tokens, so cached keys are treated as
+    contiguous and ALiBi distances are taken within the cache. Padded keys are
+    always evicted first, which keeps a single left-padding mask valid for
+    every layer; the aligned mask is handed to the layers so that padding
+    neither gives nor receives attention mass.
+    """
+    layer_class = HeavyHitterKVCacheLayer
+
+    def align_attention_mask(self, attention_mask: Optional[torch.Tensor], num_new_tokens: int) -> Optional[torch.Tensor]:
+        if attention_mask is not None and self.seen_tokens != self.seq_len:
+            evicted = self.seen_tokens - self.seq_len
+            num_padding = (~attention_mask[:, :self.seen_tokens].bool()).sum(dim=1, keepdim=True)
+            positions = torch.arange(self.seq_len, device=attention_mask.device)
+            cached = positions >= (num_padding - evicted).clamp(min=0)
+            attention_mask = torch.cat([cached.to(attention_mask.dtype), attention_mask[:, -num_new_tokens:]], dim=1)
+        for layer in self:
+            layer.key_mask = attention_mask.bool() if attention_mask is not None else None
+        return attention_mask
+
+def quantize_kv(x: torch.Tensor, n_heads: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric int8 quantization of ``(batch, seq, n_heads * head_dim)`` K or V
+    with one scale per token and head."""
+    x = x.view(*x.shape[:2], n_heads, -1)
+    scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-08) / 127
+    q = torch.round(x / scale).clamp(-127, 127).to(torch.int8)
+    return (q.flatten(2), scale.squeeze(-1))
+
+def dequantize_kv(q: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Inverse of ``quantize_kv``, returning a ``(batch, seq, kv_dim)`` tensor in ``dtype``."""
+    n_heads = scale.size(-1)
+    x = q.view(*q.shape[:2], n_heads, -1).to(dtype) * scale.unsqueeze(-1).to(dtype)
+    return x.flatten(2)
+
+class Int8KVCacheLayer(KVCacheLayer):
+    """Preallocated int8 K/V buffers with a scale per token and head.
+
+    New K/V are quantized as they are written; ``update`` and ``get`` return
+    the cached tokens dequantized to the dtype of the attention layer.
+    """
+
+    def __init__(self, max_seq_len: int, n_heads: int):
+        self.max_seq_len = max_seq_len
+        self.n_heads = n_heads
+        self.key: Optional[torch.Tensor] = None
+        self.value: Optional[torch.Tensor] = None
+        self.key_scale: Optional[torch.Tensor] = None
+        self.value_scale: Optional[torch.Tensor] = None
+        self.dtype: Optional[torch.dtype] = None
+        self.seq_len = 0
+
+    def update(self, key: torch.Tensor, value: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.key is None:
+            shape = (key.size(0), self.max_seq_len)
+            self.key = key.new_empty(*shape, key.size(-1), dtype=torch.int8)
+            self.value = value.new_empty(*shape, value.size(-1), dtype=torch.int8)
+            self.key_scale = key.new_empty(*shape, self.n_heads, dtype=torch.float32)
+            self.value_scale = value.new_empty(*shape, self.n_heads, dtype=torch.float32)
+            self.dtype = key.dtype
+        end = self.seq_len + key.size(1)
+        if end > self.max_seq_len:
+            raise ValueError(f'Cannot cache {end} tokens, the int8 KV cache was allocated for max_seq_len={self.max_seq_len}.')
+        for (x, data, scale) in ((key, self.key, self.key_scale), (value, self.value, self.value_scale)):
+            (q, s) = quantize_kv(x.float(), self.n_heads)
+            data[:, self.seq_len:end].copy_(q)
+            scale[:, self.seq_len:end].copy_(s)
+        self.seq_len = end
+        return self.get()
+
+    def get(self) -> Tuple[torch.Tensor, ...]:
+        if self.key is None:
+            return ()
+        end = self.seq_len
+        return (dequantize_kv(self.key[:, :end], self.key_scale[:, :end], self.dtype), dequantize_kv(self.value[:, :end], self.value_scale[:, :end], self.dtype))
+
+    def crop(self, length: int):
+        self.seq_len = min(self.seq_len, max(length, 0))
+
+    def expand(self, num_sequences: int):
+        if self.key is not None:
+            (self.key, self.value) = (_repeat_prefix(self.key, num_sequences, self.seq_len), _repeat_prefix(self.value, num_sequences, self.seq_len))
+            (self.key_scale, self.value_scale) = (_repeat_prefix(self.key_scale, num_sequences, self.seq_len), _repeat_prefix(self.value_scale, num_sequences, self.seq_len))
+
+class Int8KVCache(KVCache):
+    """KV cache holding K/V as int8 with per-token, per-head scales.
+
+    Cuts KV memory 4x against fp32 activations (2x against fp16) at the cost
+    of dequantizing the cached tokens on every forward.
+    """
+    layer_class = Int8KVCacheLayer
+
+    def __init__(self, n_layers: int, max_seq_len: int, n_heads: int):
+        super().__init__(n_layers, max_seq_len=max_seq_len, n_heads=n_heads)
+
+KV_CACHE_REGISTRY = {'static': StaticKVCache, 'paged': PagedKVCache, 'sink': SinkKVCache, 'heavy_hitter': HeavyHitterKVCache, 'int8': Int8KVCache}
+
+def build_kv_cache(n_layers: int, name: str='dynamic', **kwargs):
+    """Builds an empty cache for ``n_layers`` layers.
+
+    ``name='dynamic'`` returns the legacy list of empty tuples, any other name
+    is looked up in ``KV_CACHE_REGISTRY``.
+    """
+    if name == 'dynamic':
+        return [() for _ in range(n_layers)]
+    if name not in KV_CACHE_REGISTRY:
+        cache_options = ' | '.join(['dynamic', *KV_CACHE_REGISTRY.keys()])
+        raise ValueError(f'Unknown kv cache name={name!r} (Options: {cache_options}).')
+    return KV_CACHE_REGISTRY[name](n_layers=n_layers, **kwargs)
+
+def get_past_length(past_key_values) -> int:
+    """Number of tokens already fed through a legacy or registry KV cache."""
+    if past_key_values is None or len(past_key_values) == 0:
+        return 0
+    layer_past = past_key_values[0]
+    if isinstance(layer_past, KVCacheLayer):
+        return layer_past.seen_tokens
+    if len(layer_past) == 0:
+        return 0
+    return layer_past[0].size(1)
@@ -0,0 +1,60 @@
+"""Running a model whose blocks do not all fit in memory at once."""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Optional
+import torch
+import torch.nn as nn
+
+class BlockStreamer:
+    """Streams the weights of ``blocks`` from a checkpoint while they run.
+
+    Iterating yields the blocks in order. Block ``i`` is materialized from the
+    checkpoint just before it is yielded and released back to the meta device
+    once the caller moves on. The next ``window - 1`` blocks, wrapping around
+    to the start for the next forward, are read on a background thread while
+    the current one computes, so at most ``window`` blocks are resident.
+    """
+
+    def __init__(self, blocks: nn.ModuleList, readers: Dict[str, Callable[[], torch.Tensor]], prefix: str, window: int=2, dtype: Optional[torch.dtype]=None):
+        if window < 1:
+            raise ValueError(f'window must be at least 1, got {window}.')
+        self.blocks = blocks
+        self.window = min(window, len(blocks))
+        self.dtype = dtype
+        self._readers = [{name[len(f'{prefix}{i}.'):]: reader for (name, reader) in readers.items() if name.startswith(f'{prefix}{i}.')} for i in range(len(blocks))]
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mpt-block-prefetch')
+        self._pending: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+
+    def _read_block(self, idx: int) -> Dict[str, torch.Tensor]:
+        state_dict = {}
+        for (name, reader) in self._readers[idx].items():
+            tensor = reader()
+            if self.dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(self.dtype)
+            state_dict[name] = tensor.contiguous()
+        return state_dict
+
+    def _prefetch(self, idx: int):
+        if idx not in self._pending:
+            self._pending[idx] = self._executor.submit(self._read_block, idx)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self) -> Iterator[nn.Module]:
+        n = len(self.blocks)
+        with self._lock:
+            for idx in range(n):
+                for ahead in range(self.window):
+                    self._prefetch((idx + ahead) % n)
+                block = self.blocks[idx]
+                block.load_state_dict(self._pending.pop(idx).result(), assign=True)
+                try:
+                    yield block
+                finally:
+                    block.to(device='meta')
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._pending.clear()
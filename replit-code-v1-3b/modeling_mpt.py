@@ -3,28 +3,80 @@
 Inspired by https://github.com/karpathy/minGPT/blob/master/mingpt/model.py
 """
 import math
+import os
 import warnings
-from typing import List, Optional, Tuple, Union
+from typing import Iterator, List, Optional, Tuple, Union
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
-from transformers import PreTrainedModel, PreTrainedTokenizer, PreTrainedTokenizerFast
+from transformers import GenerationConfig, PreTrainedModel, PreTrainedTokenizer, PreTrainedTokenizerFast
 from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
 from .attention import attn_bias_shape, build_attn_bias
 from .blocks import MPTBlock
+from .checkpoint import blocks_prefix, checkpoint_shards, load_shard, open_lazy_checkpoint
+from .kv_cache import KVBlockPool, KVCache, build_kv_cache, get_past_length
+from .layer_streaming import BlockStreamer
 from .norm import NORM_CLASS_REGISTRY
+from .onnx_export import export_onnx
 from .configuration_mpt import MPTConfig
 from .adapt_tokenizer import AutoTokenizerForMOD, adapt_tokenizer_for_denoising
+from .inference_optim import optimize_for_inference
 from .hf_prefixlm_converter import add_bidirectional_mask_if_missing, convert_hf_causal_lm_to_prefix_lm
 from .meta_init_context import init_empty_weights
 from .param_init_fns import MODEL_INIT_REGISTRY, generic_param_init_fn_
+from .quantization import QuantizedEmbedding, quantize_model
+from .tensor_parallel import load_sharded_state_dict, parallelize_blocks
 Tokenizer = Union[PreTrainedTokenizer, PreTrainedTokenizerFast]
+META_LOAD_KWARGS = {'config', 'torch_dtype', 'trust_remote_code', 'revision', 'cache_dir', 'local_files_only', 'token', 'use_auth_token', 'force_download', 'resume_download', 'proxies', 'code_revision', 'low_cpu_mem_usage', 'use_safetensors', '_from_auto', '_from_pipeline', '_commit_hash'}
 
 class MPTPreTrainedModel(PreTrainedModel):
     config_class = MPTConfig
     base_model_prefix = 'model'
     _no_split_modules=["MPTBlock"]
 
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, *model_args, **kwargs):
+        """Loads a local checkpoint without allocating or randomly initializing weights first.
+
+        The model is built on the meta device under ``init_empty_weights`` and
+        its parameters are then bound to the tensors read from the checkpoint.
+        Hub repos and options this path does not handle (``device_map``,
+        quantization, ...) go through ``PreTrainedModel.from_pretrained``.
+        As there, weights are cast to the default dtype unless ``torch_dtype``
+        says otherwise.
+        """
+        path = str(pretrained_model_name_or_path)
+        shards = checkpoint_shards(path) if os.path.isdir(path) else None
+        if shards is None or model_args or set(kwargs) - META_LOAD_KWARGS or kwargs.get('low_cpu_mem_usage') is False:
+            return super().from_pretrained(pretrained_model_name_or_path, *model_args, **kwargs)
+        config = kwargs.get('config') or cls.config_class.from_pretrained(path)
+        torch_dtype = kwargs.get('torch_dtype')
+        if torch_dtype is None:
+            torch_dtype = torch.get_default_dtype()
+        elif torch_dtype == 'auto':
+            torch_dtype = getattr(torch, config.torch_dtype) if isinstance(config.torch_dtype, str) else config.torch_dtype
+        init_device = config.init_device
+        config.init_device = 'meta'
+        try:
+            with init_empty_weights():
+                model = cls(config)
+        finally:
+            config.init_device = init_device
+        for shard in shards:
+            state_dict = load_shard(shard)
+            if torch_dtype is not None:
+                state_dict = {k: v.to(torch_dtype) if v.is_floating_point() else v for (k, v) in state_dict.items()}
+            model.load_state_dict(state_dict, strict=False, assign=True)
+        missing = [name for (name, tensor) in [*model.named_parameters(), *model.named_buffers()] if tensor.is_meta]
+        if missing:
+            raise ValueError(f'Checkpoint at {path} is missing weights for: {missing}')
+        try:
+            model.generation_config = GenerationConfig.from_pretrained(path)
+        except OSError:
+            pass
+        return model.eval()
+
 class MPTModel(MPTPreTrainedModel):
 
     def __init__(self, config: MPTConfig):
@@ -52,6 +104,12 @@ class MPTModel(MPTPreTrainedModel):
         self.is_causal = not self.prefix_lm
         self._attn_bias_initialized = False
         self.attn_bias = None
+        self.kv_block_pool = None
+        self.decode_fast_path = True
+        self.block_streamer = None
+        self.compiled_blocks = None
+        self.tensor_parallel = None
+        self.pipeline_stage = None
         self.attn_bias_shape = attn_bias_shape(self.attn_impl, config.n_heads, config.max_seq_len, self.alibi, prefix_lm=self.prefix_lm, causal=self.is_causal, use_sequence_id=self.attn_uses_sequence_id)
         if config.no_bias:
             for module in self.modules():
@@ -73,12 +131,247 @@ class MPTModel(MPTPreTrainedModel):
     def set_input_embeddings(self, value):
         self.wte = value
 
+    def compile_blocks(self, mode: Optional[str]=None, dynamic: bool=True, warmup_lengths: Tuple[int, ...]=(), warmup_decode_steps: int=2, name: Optional[str]=None, padded: bool=False) -> bool:
+        """Runs every ``MPTBlock`` through ``torch.compile`` to cut per-layer Python dispatch.
+
+        Prefill and single-token decode trace to separate graphs, and
+        ``dynamic=True`` keeps sequence and cache lengths symbolic so decoding
+        does not recompile per token; callers bucket prompt lengths to bound
+        the number of prefill graphs. Each length in ``warmup_lengths`` is
+        prefilled and decoded for ``warmup_decode_steps`` tokens right away so
+        that compilation happens now rather than on the first request. The
+        warmup must see the inputs later requests pass, or dynamo guards miss
+        and the blocks recompile: ``name`` is the KV cache to build (defaults to
+        ``kv_cache_config['name']``), and ``padded=True`` passes an
+        ``attention_mask`` with a left-padded token, as for prompts padded to a
+        bucket. Every bucket adds graphs, so callers with many should raise
+        ``torch._dynamo.config.cache_size_limit`` first. Compilation errors
+        fall back to eager: returns False, with the model left uncompiled, if
+        compiling or warming up fails.
+        """
+        if self.block_streamer is not None:
+            raise ValueError('Blocks streamed from disk cannot be compiled.')
+        if not hasattr(torch, 'compile'):
+            warnings.warn('torch.compile is not available (requires torch>=2.0); running eagerly.')
+            return False
+        try:
+            self.compiled_blocks = [torch.compile(block, mode=mode, dynamic=dynamic) for block in self.blocks]
+            device = [*self.parameters(), *self.buffers()][0].device
+            with torch.no_grad():
+                for length in warmup_lengths:
+                    input_ids = torch.zeros((1, length), dtype=torch.long, device=device)
+                    attention_mask = None
+                    if padded:
+                        attention_mask = torch.ones((1, length + warmup_decode_steps), dtype=torch.long, device=device)
+                        attention_mask[:, 0] = 0
+                    past_key_values = self.init_kv_cache(max_seq_len=length + warmup_decode_steps, name=name)
+                    for step in range(warmup_decode_steps + 1):
+                        step_mask = attention_mask[:, :length + step] if attention_mask is not None else None
+                        output = self(input_ids=input_ids if step == 0 else input_ids[:, -1:], past_key_values=past_key_values, attention_mask=step_mask, use_cache=True)
+                        past_key_values = output.past_key_values
+                    if hasattr(past_key_values, 'release'):
+                        past_key_values.release()
+        except Exception as e:
+            warnings.warn(f'Compiling MPT blocks failed, running eagerly: {e!r}')
+            self.compiled_blocks = None
+            return False
+        return True
+
+    def _iter_blocks(self):
+        if self.block_streamer is not None:
+            return iter(self.block_streamer)
+        if self.compiled_blocks is not None:
+            return iter(self.compiled_blocks)
+        return iter(self.blocks)
+
+    def enable_layer_streaming(self, checkpoint_path: str, window: int=2, dtype: Optional[torch.dtype]=None):
+        """Keeps only the embeddings, the final norm and ``window`` blocks resident.
+
+        Every other parameter is read from the checkpoint in ``checkpoint_path``.
+        Blocks are streamed from it on every forward, with upcoming blocks
+        prefetched on a background thread, trading per-token latency for a
+        memory footprint of a few blocks. ``dtype`` casts the weights as they
+        are read.
+        """
+        readers = open_lazy_checkpoint(checkpoint_path)
+        prefix = blocks_prefix(readers, checkpoint_path)
+        state_dict = {}
+        for (name, reader) in readers.items():
+            if name.startswith(prefix) and (not name.startswith(prefix + 'blocks.')):
+                tensor = reader()
+                state_dict[name[len(prefix):]] = tensor.to(dtype) if dtype is not None and tensor.is_floating_point() else tensor
+        self.load_state_dict(state_dict, strict=False, assign=True)
+        self.blocks.to(device='meta')
+        missing = [name for (name, tensor) in [*self.named_parameters(), *self.named_buffers()] if tensor.is_meta and (not name.startswith('blocks.'))]
+        if missing:
+            raise ValueError(f'Checkpoint at {checkpoint_path} is missing weights for: {missing}')
+        if self.block_streamer is not None:
+            self.block_streamer.close()
+        self.block_streamer = BlockStreamer(self.blocks, readers, prefix=prefix + 'blocks.', window=window, dtype=dtype)
+
+    def enable_tensor_parallel(self, rank: Optional[int]=None, world_size: Optional[int]=None, checkpoint_path: Optional[str]=None, dtype: Optional[torch.dtype]=None, group: Optional[dist.ProcessGroup]=None):
+        """Splits the attention heads and FFN hidden units of every block across processes.
+
+        Needs an initialized ``torch.distributed`` process group (gloo on CPU);
+        ``rank`` and ``world_size`` default to those of ``group``. Embeddings
+        and norms stay replicated. With ``checkpoint_path`` the model is
+        expected on the meta device and each rank reads only its shards of the
+        block weights; otherwise the resident weights are sliced.
+        """
+        rank = dist.get_rank(group) if rank is None else rank
+        world_size = dist.get_world_size(group) if world_size is None else world_size
+        if self.block_streamer is not None or self.compiled_blocks is not None or self.tensor_parallel is not None or self.pipeline_stage is not None:
+            raise ValueError('Enable tensor parallelism on the eager, unsharded model.')
+        if self.config.quant_config['bits']:
+            raise NotImplementedError('Tensor parallelism does not support quantized weights.')
+        shapes = {name: tuple(tensor.shape) for (name, tensor) in self.state_dict().items()}
+        parallelize_blocks(self.blocks, rank, world_size, group=group)
+        if checkpoint_path is not None:
+            readers = open_lazy_checkpoint(checkpoint_path)
+            prefix = blocks_prefix(readers, checkpoint_path)
+            readers = {name[len(prefix):]: reader for (name, reader) in readers.items() if name.startswith(prefix) and name[len(prefix):] in shapes}
+            self.load_state_dict(load_sharded_state_dict(readers, shapes, rank, world_size, dtype=dtype), strict=False, assign=True)
+            missing = [name for (name, tensor) in [*self.named_parameters(), *self.named_buffers()] if tensor.is_meta]
+            if missing:
+                raise ValueError(f'Checkpoint at {checkpoint_path} is missing weights for: {missing}')
+        self.tensor_parallel = (rank, world_size)
+        self._attn_bias_initialized = False
+        self.attn_bias = None
+        self.kv_block_pool = None
+        return self
+
+    def enable_pipeline_stage(self, start: int, end: int, checkpoint_path: Optional[str]=None, dtype: Optional[torch.dtype]=None):
+        """Keeps only ``blocks[start:end]``, making this model one stage of a pipeline.
+
+        The first stage also keeps the token embedding and the last stage the
+        final norm and the tied ``wte`` head; every other weight is moved to
+        the meta device. With ``checkpoint_path`` the model is expected on the
+        meta device and only the stage's tensors are read. Run the stage with
+        ``forward_stage``; caches from ``init_kv_cache`` then hold only the
+        stage's layers.
+        """
+        if not 0 <= start < end <= self.config.n_layers:
+            raise ValueError(f'Invalid pipeline stage blocks[{start}:{end}] for n_layers={self.config.n_layers}.')
+        if not self.alibi:
+            raise NotImplementedError('Pipeline stages require alibi; learned position embeddings are not supported.')
+        if self.block_streamer is not None or self.compiled_blocks is not None or self.tensor_parallel is not None or self.pipeline_stage is not None:
+            raise ValueError('Enable a pipeline stage on the eager, unsplit model.')
+        self.pipeline_stage = (start, end)
+        for (idx, block) in enumerate(self.blocks):
+            if not start <= idx < end:
+                block.to(device='meta')
+        if not self._stage_owns('wte.weight'):
+            self.wte.to(device='meta')
+        if not self._stage_owns('norm_f.weight'):
+            self.norm_f.to(device='meta')
+        if checkpoint_path is not None:
+            readers = open_lazy_checkpoint(checkpoint_path)
+            prefix = blocks_prefix(readers, checkpoint_path)
+            state_dict = {}
+            for (name, reader) in readers.items():
+                if name.startswith(prefix) and self._stage_owns(name[len(prefix):]):
+                    tensor = reader()
+                    state_dict[name[len(prefix):]] = tensor.to(dtype) if dtype is not None and tensor.is_floating_point() else tensor
+            self.load_state_dict(state_dict, strict=False, assign=True)
+        missing = [name for (name, tensor) in [*self.named_parameters(), *self.named_buffers()] if tensor.is_meta and self._stage_owns(name)]
+        if missing:
+            raise ValueError(f'Pipeline stage blocks[{start}:{end}] is missing weights for: {missing}')
+        self.kv_block_pool = None
+        return self
+
+    def _stage_owns(self, name: str) -> bool:
+        (start, end) = self.pipeline_stage
+        if name.startswith('blocks.'):
+            return start <= int(name.split('.')[1]) < end
+        if name.startswith('wte.'):
+            return start == 0 or end == self.config.n_layers
+        if name.startswith('norm_f.'):
+            return end == self.config.n_layers
+        return True
+
+    def _num_cache_layers(self) -> int:
+        if self.pipeline_stage is None:
+            return self.config.n_layers
+        return self.pipeline_stage[1] - self.pipeline_stage[0]
+
+    def forward_stage(self, x: torch.Tensor, past_key_values: Optional[KVCache]=None, attention_mask: Optional[torch.ByteTensor]=None) -> torch.Tensor:
+        """Runs the blocks of this pipeline stage.
+
+        The first stage takes token ids, later stages the hidden states of the
+        previous one. ``attention_mask`` covers every seen and new token, as in
+        ``forward``. The last stage returns hidden states after ``norm_f``.
+        """
+        (start, end) = self.pipeline_stage
+        if start == 0:
+            x = self.wte(x)
+        if attention_mask is not None:
+            attention_mask = attention_mask.bool()
+        if isinstance(past_key_values, KVCache):
+            attention_mask = past_key_values.align_attention_mask(attention_mask, x.size(1))
+        (attn_bias, attention_mask) = self._attn_bias(device=x.device, dtype=self._attn_bias_dtype(x.dtype), attention_mask=attention_mask)
+        for (idx, block) in enumerate(self.blocks[start:end]):
+            past_key_value = past_key_values[idx] if past_key_values is not None else None
+            (x, past_key_value) = block(x, past_key_value=past_key_value, attn_bias=attn_bias, attention_mask=attention_mask, is_causal=self.is_causal)
+            if past_key_values is not None:
+                past_key_values[idx] = past_key_value
+        if end == self.config.n_layers:
+            x = self.norm_f(x)
+        return x
+
+    def init_kv_cache(self, max_seq_len: Optional[int]=None, name: Optional[str]=None):
+        """Builds an empty KV cache as configured by ``config.kv_cache_config``.
+
+        ``max_seq_len`` and ``name`` override the configured values, e.g. to size
+        a static cache to ``prompt length + max_new_tokens`` instead of the full context.
+        """
+        name = name if name is not None else self.config.kv_cache_config['name']
+        n_layers = self._num_cache_layers()
+        if name == 'dynamic':
+            return build_kv_cache(n_layers)
+        if name == 'paged':
+            return build_kv_cache(n_layers, name=name, pool=self.get_kv_block_pool())
+        if name == 'sink':
+            sink_tokens = self.config.kv_cache_config['sink_tokens']
+            window_size = self.config.kv_cache_config['window_size'] or self.config.max_seq_len // 2
+            if sink_tokens + window_size >= self.config.max_seq_len:
+                raise ValueError(f'sink_tokens + window_size must be smaller than max_seq_len={self.config.max_seq_len}, got {sink_tokens} + {window_size}.')
+            return build_kv_cache(n_layers, name=name, sink_tokens=sink_tokens, window_size=window_size)
+        if name == 'heavy_hitter':
+            if self.attn_impl != 'torch':
+                raise NotImplementedError(f'The heavy_hitter KV cache needs attention weights, which attn_impl: {self.attn_impl} does not return.')
+            heavy_tokens = self.config.kv_cache_config['heavy_tokens'] or self.config.max_seq_len // 4
+            window_size = self.config.kv_cache_config['window_size'] or self.config.max_seq_len // 4
+            if heavy_tokens + window_size >= self.config.max_seq_len:
+                raise ValueError(f'heavy_tokens + window_size must be smaller than max_seq_len={self.config.max_seq_len}, got {heavy_tokens} + {window_size}.')
+            return build_kv_cache(n_layers, name=name, heavy_tokens=heavy_tokens, window_size=window_size)
+        max_seq_len = max_seq_len or self.config.kv_cache_config['max_seq_len'] or self.config.max_seq_len
+        if name == 'int8':
+            n_kv_heads = 1 if self.config.attn_config['attn_type'] == 'multiquery_attention' else self.blocks[0].attn.n_heads
+            return build_kv_cache(n_layers, name=name, max_seq_len=max_seq_len, n_heads=n_kv_heads)
+        return build_kv_cache(n_layers, name=name, max_seq_len=max_seq_len)
+
+    def get_kv_block_pool(self) -> KVBlockPool:
+        """Returns the block pool shared by every paged cache of this model."""
+        if self.kv_block_pool is None:
+            block_size = self.config.kv_cache_config['block_size']
+            num_blocks = self.config.kv_cache_config['num_blocks'] or math.ceil(self.config.max_seq_len / block_size)
+            self.kv_block_pool = KVBlockPool(self._num_cache_layers(), num_blocks=num_blocks, block_size=block_size)
+        return self.kv_block_pool
+
+    def _attn_bias_dtype(self, dtype: torch.dtype) -> torch.dtype:
+        """The torch attention path softmaxes bf16 scores in float32, so its ALiBi bias keeps full precision there."""
+        return torch.float32 if self.attn_impl == 'torch' and dtype == torch.bfloat16 else dtype
+
     @torch.no_grad()
     def _attn_bias(self, device, dtype, attention_mask: Optional[torch.ByteTensor]=None, prefix_mask: Optional[torch.ByteTensor]=None, sequence_id: Optional[torch.LongTensor]=None):
         if not self._attn_bias_initialized:
             if self.attn_bias_shape:
                 self.attn_bias = torch.zeros(self.attn_bias_shape, device=device, dtype=dtype)
                 self.attn_bias = build_attn_bias(self.attn_impl, self.attn_bias, self.config.n_heads, self.config.max_seq_len, causal=self.is_causal, alibi=self.alibi, alibi_bias_max=self.alibi_bias_max)
+                if self.tensor_parallel is not None and self.attn_bias.size(1) == self.config.n_heads:
+                    (rank, world_size) = self.tensor_parallel
+                    n_local_heads = self.config.n_heads // world_size
+                    self.attn_bias = self.attn_bias[:, rank * n_local_heads:(rank + 1) * n_local_heads].contiguous()
             self._attn_bias_initialized = True
         if self.attn_impl == 'flash':
             return (self.attn_bias, attention_mask)
@@ -132,6 +425,14 @@ class MPTModel(MPTPreTrainedModel):
     def forward(self, input_ids: torch.LongTensor, past_key_values: Optional[List[Tuple[torch.FloatTensor]]]=None, attention_mask: Optional[torch.ByteTensor]=None, prefix_mask: Optional[torch.ByteTensor]=None, sequence_id: Optional[torch.LongTensor]=None, return_dict: Optional[bool]=None, output_attentions: Optional[bool]=None, output_hidden_states: Optional[bool]=None, use_cache: Optional[bool]=None):
         return_dict = return_dict if return_dict is not None else self.config.return_dict
         use_cache = use_cache if use_cache is not None else self.config.use_cache
+        if self.decode_fast_path and (not self.training) and input_ids.size(1) == 1 and isinstance(past_key_values, KVCache) and past_key_values.seq_len > 0 and self.alibi and self.attn_impl != 'flash' and (not (self.prefix_lm or output_attentions or output_hidden_states)):
+            return self._forward_decode_step(input_ids, past_key_values, attention_mask)
+        prefill_chunk_size = self.config.kv_cache_config['prefill_chunk_size']
+        if prefill_chunk_size and use_cache and (not self.training) and input_ids.size(1) > prefill_chunk_size and self.attn_impl in ['torch', 'sdpa'] and (not (self.prefix_lm or sequence_id is not None or output_hidden_states)):
+            if past_key_values is None:
+                past_key_values = self.init_kv_cache()
+            chunks = [output.last_hidden_state for output in self.iter_prefill_chunks(input_ids, past_key_values=past_key_values, attention_mask=attention_mask, chunk_size=prefill_chunk_size)]
+            return BaseModelOutputWithPast(last_hidden_state=torch.cat(chunks, dim=1), past_key_values=past_key_values)
         if attention_mask is not None:
             attention_mask = attention_mask.bool()
         if prefix_mask is not None:
@@ -140,7 +441,7 @@ class MPTModel(MPTPreTrainedModel):
             raise NotImplementedError('return_dict False is not implemented yet for MPT')
         if output_attentions:
             raise NotImplementedError('output_attentions is not implemented yet for MPT')
-        if attention_mask is not None and attention_mask[:, 0].sum() != attention_mask.shape[0] and self.training:
+        if self.training and attention_mask is not None and attention_mask[:, 0].sum() != attention_mask.shape[0]:
             raise NotImplementedError('MPT does not support training with left padding.')
         if self.prefix_lm and prefix_mask is None:
             raise ValueError('prefix_mask is a required argument when MPT is configured with prefix_lm=True.')
@@ -159,7 +460,7 @@ class MPTModel(MPTPreTrainedModel):
             if past_key_values is not None:
                 if len(past_key_values) != self.config.n_layers:
                     raise ValueError(f'past_key_values must provide a past_key_value for each attention ' + f'layer in the network (len(past_key_values)={len(past_key_values)!r}; self.config.n_layers={self.config.n_layers!r}).')
-                past_position = past_key_values[0][0].size(1)
+                past_position = get_past_length(past_key_values)
             if S + past_position > self.config.max_seq_len:
                 raise ValueError(f'Cannot forward input with past sequence length {past_position} and current sequence length {S + 1}, this model only supports total sequence length <= {self.config.max_seq_len}.')
             pos = torch.arange(past_position, S + past_position, dtype=torch.long, device=input_ids.device).unsqueeze(0)
@@ -173,11 +474,13 @@ class MPTModel(MPTPreTrainedModel):
             x_shrunk = x * self.embedding_fraction + x.detach() * (1 - self.embedding_fraction)
             assert isinstance(self.emb_drop, nn.Module)
             x = self.emb_drop(x_shrunk)
-        (attn_bias, attention_mask) = self._attn_bias(device=x.device, dtype=x.dtype, attention_mask=attention_mask, prefix_mask=prefix_mask, sequence_id=sequence_id)
+        if isinstance(past_key_values, KVCache):
+            attention_mask = past_key_values.align_attention_mask(attention_mask, S)
+        (attn_bias, attention_mask) = self._attn_bias(device=x.device, dtype=self._attn_bias_dtype(x.dtype), attention_mask=attention_mask, prefix_mask=prefix_mask, sequence_id=sequence_id)
         if use_cache and past_key_values is None:
-            past_key_values = [() for _ in range(self.config.n_layers)]
+            past_key_values = self.init_kv_cache()
         all_hidden_states = () if output_hidden_states else None
-        for (b_idx, block) in enumerate(self.blocks):
+        for (b_idx, block) in enumerate(self._iter_blocks()):
             if output_hidden_states:
                 assert all_hidden_states is not None
                 all_hidden_states = all_hidden_states + (x,)
@@ -188,6 +491,46 @@ class MPTModel(MPTPreTrainedModel):
         x = self.norm_f(x)
         return BaseModelOutputWithPast(last_hidden_state=x, past_key_values=past_key_values, hidden_states=all_hidden_states)
 
+    def iter_prefill_chunks(self, input_ids: torch.LongTensor, past_key_values=None, attention_mask: Optional[torch.ByteTensor]=None, chunk_size: int=512) -> Iterator[BaseModelOutputWithPast]:
+        """Prefills ``input_ids`` into the KV cache ``chunk_size`` tokens at a time.
+
+        Yields the output of every chunk, so a caller can interleave other
+        sequences' decode steps between chunks of a long prompt.
+        ``attention_mask`` covers the cached and the new tokens, as in ``forward``.
+        """
+        if past_key_values is None:
+            past_key_values = self.init_kv_cache()
+        past_length = get_past_length(past_key_values)
+        S = input_ids.size(1)
+        for start in range(0, S, chunk_size):
+            end = min(start + chunk_size, S)
+            chunk_mask = attention_mask[:, :past_length + end] if attention_mask is not None else None
+            yield self(input_ids[:, start:end], past_key_values=past_key_values, attention_mask=chunk_mask, use_cache=True)
+
+    def _forward_decode_step(self, input_ids: torch.LongTensor, past_key_values: KVCache, attention_mask: Optional[torch.ByteTensor]=None):
+        """Single-token decode step against a registry KV cache.
+
+        The ALiBi bias and whether the sequence is padded are resolved on the
+        first decode step and stored on the cache, so later steps skip input
+        validation, bias casting and masking and only slice the bias.
+        """
+        x = self.wte(input_ids)
+        if past_key_values.decode_state is None:
+            (attn_bias, _) = self._attn_bias(device=x.device, dtype=self._attn_bias_dtype(x.dtype))
+            has_padding = attention_mask is not None and (not bool(attention_mask.bool().all()))
+            past_key_values.decode_state = (attn_bias, has_padding)
+        (attn_bias, has_padding) = past_key_values.decode_state
+        s_k = past_key_values.seq_len + 1
+        attn_bias = attn_bias[:, :, :, -s_k:]
+        key_mask = past_key_values.align_attention_mask(attention_mask.bool() if has_padding else None, 1)
+        if has_padding:
+            key_mask = key_mask[:, -s_k:]
+            attn_bias = attn_bias.masked_fill(~key_mask.view(-1, 1, 1, s_k), torch.finfo(attn_bias.dtype).min)
+        for (block, layer_past) in zip(self._iter_blocks(), past_key_values):
+            (x, _) = block(x, past_key_value=layer_past, attn_bias=attn_bias, is_causal=self.is_causal)
+        x = self.norm_f(x)
+        return BaseModelOutputWithPast(last_hidden_state=x, past_key_values=past_key_values)
+
     def param_init_fn(self, module):
         init_fn_name = self.config.init_config['name']
         MODEL_INIT_REGISTRY[init_fn_name](module=module, n_layers=self.config.n_layers, d_model=self.config.d_model, **self.config.init_config)
@@ -205,6 +548,8 @@ class MPTForCausalLM(MPTPreTrainedModel):
         if not config.tie_word_embeddings:
             raise ValueError('MPTForCausalLM only supports tied word embeddings')
         self.transformer = MPTModel(config)
+        if config.quant_config['bits']:
+            quantize_model(self.transformer, bits=config.quant_config['bits'], group_size=config.quant_config['group_size'], empty=True)
         self.logit_scale = None
         if config.logit_scale is not None:
             logit_scale = config.logit_scale
@@ -222,6 +567,8 @@ class MPTForCausalLM(MPTPreTrainedModel):
         self.transformer.wte = value
 
     def get_output_embeddings(self):
+        if isinstance(self.transformer.wte, QuantizedEmbedding):
+            return None
         return self.transformer.wte
 
     def set_output_embeddings(self, new_embeddings):
@@ -233,15 +580,58 @@ class MPTForCausalLM(MPTPreTrainedModel):
     def get_decoder(self):
         return self.transformer
 
-    def forward(self, input_ids: torch.LongTensor, past_key_values: Optional[List[Tuple[torch.FloatTensor]]]=None, attention_mask: Optional[torch.ByteTensor]=None, prefix_mask: Optional[torch.ByteTensor]=None, sequence_id: Optional[torch.LongTensor]=None, labels: Optional[torch.LongTensor]=None, return_dict: Optional[bool]=None, output_attentions: Optional[bool]=None, output_hidden_states: Optional[bool]=None, use_cache: Optional[bool]=None):
-        return_dict = return_dict if return_dict is not None else self.config.return_dict
-        use_cache = use_cache if use_cache is not None else self.config.use_cache
-        outputs = self.transformer(input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask, prefix_mask=prefix_mask, sequence_id=sequence_id, return_dict=return_dict, output_attentions=output_attentions, output_hidden_states=output_hidden_states, use_cache=use_cache)
-        logits = F.linear(outputs.last_hidden_state, self.transformer.wte.weight)
+    def optimize_for_inference(self, prepack: bool=True, check_input_ids: Optional[torch.LongTensor]=None, atol: float=0.001):
+        """Strips dropout, folds norm affines into the following linears and
+        prepacks linear weights for oneDNN. See ``inference_optim.optimize_for_inference``."""
+        return optimize_for_inference(self, prepack=prepack, check_input_ids=check_input_ids, atol=atol)
+
+    def export_onnx(self, output_dir: str, opset: int=17):
+        """Exports ONNX prefill and decode graphs with explicit per-layer K/V
+        inputs and outputs. See ``onnx_export.export_onnx``."""
+        return export_onnx(self, output_dir, opset=opset)
+
+    def quantize(self, bits: int=8, group_size: int=128):
+        """Quantizes the attention and FFN linears and the tied ``wte`` embedding
+        to weight-only int8 or int4 in place.
+
+        The choice is recorded in ``config.quant_config``, so ``save_pretrained``
+        writes a checkpoint that ``from_pretrained`` loads already quantized.
+        """
+        if self.config.quant_config['bits']:
+            raise ValueError(f"Model weights are already quantized to {self.config.quant_config['bits']} bits.")
+        if self.transformer.tensor_parallel is not None:
+            raise NotImplementedError('Tensor-parallel models cannot be quantized.')
+        quantize_model(self.transformer, bits=bits, group_size=group_size)
+        self.config.quant_config = {**self.config.quant_config, 'bits': bits, 'group_size': group_size}
+        return self
+
+    def compute_logits(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        """Projects final hidden states onto the vocabulary with the tied ``wte``."""
+        if isinstance(self.transformer.wte, QuantizedEmbedding):
+            logits = self.transformer.wte.unembed(hidden_states)
+        else:
+            logits = F.linear(hidden_states, self.transformer.wte.weight)
         if self.logit_scale is not None:
             if self.logit_scale == 0:
                 warnings.warn(f'Multiplying logits by self.logit_scale={self.logit_scale!r}. This will produce uniform (uninformative) outputs.')
             logits *= self.logit_scale
+        return logits
+
+    def forward(self, input_ids: torch.LongTensor, past_key_values: Optional[List[Tuple[torch.FloatTensor]]]=None, attention_mask: Optional[torch.ByteTensor]=None, prefix_mask: Optional[torch.ByteTensor]=None, sequence_id: Optional[torch.LongTensor]=None, labels: Optional[torch.LongTensor]=None, return_dict: Optional[bool]=None, output_attentions: Optional[bool]=None, output_hidden_states: Optional[bool]=None, use_cache: Optional[bool]=None, logits_to_keep: int=0):
+        """Runs the decoder and projects hidden states onto the vocabulary.
+
+        ``logits_to_keep`` > 0 only computes logits for that many trailing
+        positions, e.g. ``1`` during generation where only the last row is
+        sampled from. ``0`` keeps every position. It is ignored when ``labels``
+        are passed since the loss needs every position.
+        """
+        return_dict = return_dict if return_dict is not None else self.config.return_dict
+        use_cache = use_cache if use_cache is not None else self.config.use_cache
+        outputs = self.transformer(input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask, prefix_mask=prefix_mask, sequence_id=sequence_id, return_dict=return_dict, output_attentions=output_attentions, output_hidden_states=output_hidden_states, use_cache=use_cache)
+        hidden_states = outputs.last_hidden_state
+        if logits_to_keep and labels is None:
+            hidden_states = hidden_states[:, -logits_to_keep:]
+        logits = self.compute_logits(hidden_states)
         loss = None
         if labels is not None:
             labels = torch.roll(labels, shifts=-1)
@@ -269,15 +659,18 @@ class MPTForCausalLM(MPTPreTrainedModel):
             sequence_id = torch.zeros_like(input_ids[:1])
         else:
             sequence_id = None
-        if past_key_values is not None:
-            input_ids = input_ids[:, -1].unsqueeze(-1)
+        if past_key_values is None and kwargs.get('use_cache', True):
+            past_key_values = self.transformer.init_kv_cache()
+        past_length = get_past_length(past_key_values)
+        if past_length > 0:
+            input_ids = input_ids[:, past_length:]
         if self.transformer.prefix_lm:
             prefix_mask = torch.ones_like(attention_mask)
             if kwargs.get('use_cache') == False:
                 raise NotImplementedError('MPT with prefix_lm=True does not support use_cache=False.')
         else:
             prefix_mask = None
-        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'prefix_mask': prefix_mask, 'sequence_id': sequence_id, 'past_key_values': past_key_values, 'use_cache': kwargs.get('use_cache', True)}
+        return {'input_ids': input_ids, 'attention_mask': attention_mask, 'prefix_mask': prefix_mask, 'sequence_id': sequence_id, 'past_key_values': past_key_values, 'use_cache': kwargs.get('use_cache', True), 'logits_to_keep': kwargs.get('logits_to_keep', 1)}
 
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
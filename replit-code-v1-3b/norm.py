@@ -11,6 +11,24 @@ def _cast_if_autocast_enabled(tensor):
         return tensor.to(dtype=dtype)
     return tensor
 
+try:
+    torch.is_autocast_enabled('cpu')
+    _AUTOCAST_BY_DEVICE = True
+except TypeError:
+    _AUTOCAST_BY_DEVICE = False
+
+def _autocast_enabled(device_type):
+    if _AUTOCAST_BY_DEVICE:
+        return torch.is_autocast_enabled(device_type)
+    if device_type == 'cpu':
+        return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+    return torch.is_autocast_enabled()
+
+def _layer_norm_fp32(x, normalized_shape, weight, bias, eps):
+    weight = weight.float() if weight is not None else weight
+    bias = bias.float() if bias is not None else bias
+    return torch.nn.functional.layer_norm(x.float(), normalized_shape, weight, bias, eps).to(dtype=x.dtype)
+
 class LPLayerNorm(torch.nn.LayerNorm):
 
     def __init__(self, normalized_shape, eps=1e-05, elementwise_affine=True, device=None, dtype=None):
@@ -18,6 +36,10 @@ class LPLayerNorm(torch.nn.LayerNorm):
 
     def forward(self, x):
         module_device = x.device
+        if not _autocast_enabled(module_device.type):
+            if x.dtype in (torch.float16, torch.bfloat16):
+                return _layer_norm_fp32(x, self.normalized_shape, self.weight, self.bias, self.eps)
+            return torch.nn.functional.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
         downcast_x = _cast_if_autocast_enabled(x)
         downcast_weight = _cast_if_autocast_enabled(self.weight) if self.weight is not None else self.weight
         downcast_bias = _cast_if_autocast_enabled(self.bias) if self.bias is not None else self.bias
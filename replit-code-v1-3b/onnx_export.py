@@ -0,0 +1,73 @@
+"""Exporting MPTForCausalLM to ONNX prefill and decode graphs with explicit K/V tensors."""
+import json
+import os
+from typing import Dict, List
+import torch
+import torch.nn as nn
+ONNX_CONFIG_NAME = 'onnx_config.json'
+
+class _PrefillGraph(nn.Module):
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor):
+        n_layers = self.model.config.n_layers
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=[() for _ in range(n_layers)], use_cache=True, logits_to_keep=1)
+        return (output.logits[:, -1], *[t for layer in output.past_key_values for t in layer])
+
+class _DecodeGraph(nn.Module):
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, *past: torch.Tensor):
+        past_key_values = [(past[2 * i], past[2 * i + 1]) for i in range(len(past) // 2)]
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask, past_key_values=past_key_values, use_cache=True, logits_to_keep=1)
+        return (output.logits[:, -1], *[t for layer in output.past_key_values for t in layer])
+
+def _kv_names(prefix: str, n_layers: int) -> List[str]:
+    return [f'{prefix}.{i}.{kv}' for i in range(n_layers) for kv in ('key', 'value')]
+
+def export_onnx(model: nn.Module, output_dir: str, opset: int=17, prefill_len: int=8) -> Dict[str, str]:
+    """Writes ``prefill.onnx`` and ``decode.onnx`` for ``model`` to ``output_dir``.
+
+    The prefill graph maps ``input_ids`` and ``attention_mask`` to the logits of
+    the last position and ``present.{i}.key`` / ``present.{i}.value`` for every
+    layer. The decode graph additionally takes the previous step's K/V as
+    ``past.{i}.key`` / ``past.{i}.value`` and one new token per sequence. K/V
+    are ``(batch, seq, kv_dim)``; the ALiBi bias is baked into both graphs as
+    a constant. ``onnx_config.json`` records the names and shapes a runtime
+    needs.
+    """
+    if model.config.attn_config['attn_impl'] != 'torch':
+        raise ValueError("ONNX export traces the attn_impl: torch attention path; load the model with attn_impl='torch'.")
+    if model.config.kv_cache_config['prefill_chunk_size']:
+        raise ValueError('Disable kv_cache_config prefill_chunk_size before exporting.')
+    decoder = model.get_decoder()
+    if decoder.block_streamer is not None or decoder.compiled_blocks is not None:
+        raise ValueError('Export the eager model, before enabling layer streaming or compile_blocks.')
+    os.makedirs(output_dir, exist_ok=True)
+    model = model.eval()
+    fast_path = decoder.decode_fast_path
+    decoder.decode_fast_path = False
+    n_layers = model.config.n_layers
+    param = next(model.parameters())
+    input_ids = torch.zeros((1, prefill_len), dtype=torch.long, device=param.device)
+    attention_mask = torch.ones_like(input_ids)
+    present = _kv_names('present', n_layers)
+    try:
+        with torch.no_grad():
+            prefill_outputs = _PrefillGraph(model)(input_ids, attention_mask)
+            torch.onnx.export(_PrefillGraph(model), (input_ids, attention_mask), os.path.join(output_dir, 'prefill.onnx'), input_names=['input_ids', 'attention_mask'], output_names=['logits', *present], dynamic_axes={'input_ids': {0: 'batch', 1: 'seq'}, 'attention_mask': {0: 'batch', 1: 'seq'}, 'logits': {0: 'batch'}, **{name: {0: 'batch', 1: 'seq'} for name in present}}, opset_version=opset, do_constant_folding=True)
+            past = _kv_names('past', n_layers)
+            decode_inputs = (input_ids[:, -1:], torch.ones((1, prefill_len + 1), dtype=torch.long, device=param.device), *prefill_outputs[1:])
+            torch.onnx.export(_DecodeGraph(model), decode_inputs, os.path.join(output_dir, 'decode.onnx'), input_names=['input_ids', 'attention_mask', *past], output_names=['logits', *present], dynamic_axes={'input_ids': {0: 'batch'}, 'attention_mask': {0: 'batch', 1: 'total_seq'}, 'logits': {0: 'batch'}, **{name: {0: 'batch', 1: 'past_seq'} for name in past}, **{name: {0: 'batch', 1: 'total_seq'} for name in present}}, opset_version=opset, do_constant_folding=True)
+    finally:
+        decoder.decode_fast_path = fast_path
+    onnx_config = {'n_layers': n_layers, 'kv_dim': prefill_outputs[1].size(-1), 'max_seq_len': model.config.max_seq_len, 'vocab_size': model.config.vocab_size, 'dtype': str(param.dtype).replace('torch.', ''), 'past_names': _kv_names('past', n_layers), 'present_names': present}
+    with open(os.path.join(output_dir, ONNX_CONFIG_NAME), 'w') as f:
+        json.dump(onnx_config, f, indent=2)
+    return {'prefill': os.path.join(output_dir, 'prefill.onnx'), 'decode': os.path.join(output_dir, 'decode.onnx'), 'config': os.path.join(output_dir, ONNX_CONFIG_NAME)}
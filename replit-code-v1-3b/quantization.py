@@ -0,0 +1,144 @@
+"""Weight-only int8 / int4 quantization for CPU inference.
+
+Weights are stored as int8, or as two int4 values packed per byte, with one
+scale per ``group_size`` consecutive input features of every output row.
+Matmuls dequantize the weight a slab of output rows at a time, so the full
+precision copy of a weight never exists in memory at once.
+"""
+from typing import Optional, Tuple
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+QUANT_TARGETS = ('Wqkv', 'out_proj', 'up_proj', 'down_proj')
+DEQUANT_CHUNK_NUMEL = 2 ** 20
+
+def quantize_weight(weight: torch.Tensor, bits: int, group_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric group-wise quantization of a ``(rows, in_features)`` weight.
+
+    Returns the quantized weight (``int8``, or ``uint8`` holding two int4 values
+    per byte) and float32 scales of shape ``(rows, in_features // group_size)``.
+    """
+    if bits not in (4, 8):
+        raise ValueError(f'Only 8 and 4 bit weights are supported, got bits={bits}.')
+    (rows, in_features) = weight.shape
+    if in_features % group_size != 0:
+        raise ValueError(f'in_features={in_features} must be divisible by group_size={group_size}.')
+    qmax = 2 ** (bits - 1) - 1
+    w = weight.detach().float().view(rows, -1, group_size)
+    scales = w.abs().amax(dim=-1, keepdim=True).clamp(min=1e-08) / qmax
+    q = torch.round(w / scales).clamp(-qmax - 1, qmax).to(torch.int8).view(rows, in_features)
+    if bits == 4:
+        q = (q + 8).to(torch.uint8)
+        q = q[:, 0::2] | q[:, 1::2] << 4
+    return (q, scales.squeeze(-1))
+
+def dequantize_weight(qweight: torch.Tensor, scales: torch.Tensor, bits: int, dtype: torch.dtype) -> torch.Tensor:
+    """Inverse of ``quantize_weight`` for any slab of rows."""
+    if bits == 4:
+        q = torch.stack([qweight & 15, qweight >> 4], dim=-1).view(qweight.size(0), -1).to(torch.int8) - 8
+    else:
+        q = qweight
+    w = q.view(*scales.shape, -1).to(dtype) * scales.unsqueeze(-1).to(dtype)
+    return w.view(q.shape)
+
+class QuantizedLinear(nn.Module):
+    """Weight-only quantized replacement for ``nn.Linear``."""
+
+    def __init__(self, in_features: int, out_features: int, bias: bool=True, bits: int=8, group_size: int=128, device: Optional[str]=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        packed = in_features // 2 if bits == 4 else in_features
+        self.register_buffer('qweight', torch.empty(out_features, packed, dtype=torch.uint8 if bits == 4 else torch.int8, device=device))
+        self.register_buffer('scales', torch.empty(out_features, in_features // group_size, device=device))
+        self.register_buffer('bias', torch.empty(out_features, device=device) if bias else None)
+        self.rows_per_chunk = max(1, DEQUANT_CHUNK_NUMEL // in_features)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, bits: int=8, group_size: int=128) -> 'QuantizedLinear':
+        module = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, bits=bits, group_size=group_size, device=linear.weight.device)
+        (module.qweight, module.scales) = quantize_weight(linear.weight, bits, group_size)
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().clone()
+        return module
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return quantized_linear(x, self.qweight, self.scales, self.bits, self.bias, self.rows_per_chunk)
+
+    def extra_repr(self) -> str:
+        return f'in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, bits={self.bits}, group_size={self.group_size}'
+
+def quantized_linear(x: torch.Tensor, qweight: torch.Tensor, scales: torch.Tensor, bits: int, bias: Optional[torch.Tensor]=None, rows_per_chunk: Optional[int]=None) -> torch.Tensor:
+    rows = qweight.size(0)
+    rows_per_chunk = rows_per_chunk or rows
+    out = [F.linear(x, dequantize_weight(qweight[start:start + rows_per_chunk], scales[start:start + rows_per_chunk], bits, x.dtype)) for start in range(0, rows, rows_per_chunk)]
+    out = out[0] if len(out) == 1 else torch.cat(out, dim=-1)
+    if bias is not None:
+        out = out + bias.to(out.dtype)
+    return out
+
+class QuantizedEmbedding(nn.Module):
+    """Weight-only quantized replacement for the tied ``wte`` embedding.
+
+    ``forward`` dequantizes only the looked-up rows, to the dtype of the
+    original weight, and ``unembed`` computes the tied LM head logits.
+    """
+
+    def __init__(self, num_embeddings: int, embedding_dim: int, bits: int=8, group_size: int=128, device: Optional[str]=None, dtype: Optional[torch.dtype]=None):
+        super().__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.bits = bits
+        self.group_size = group_size
+        packed = embedding_dim // 2 if bits == 4 else embedding_dim
+        self.register_buffer('qweight', torch.empty(num_embeddings, packed, dtype=torch.uint8 if bits == 4 else torch.int8, device=device))
+        self.register_buffer('scales', torch.empty(num_embeddings, embedding_dim // group_size, device=device))
+        self.activation_dtype = dtype or torch.get_default_dtype()
+        self.rows_per_chunk = max(1, DEQUANT_CHUNK_NUMEL // embedding_dim)
+
+    @classmethod
+    def from_embedding(cls, embedding: nn.Embedding, bits: int=8, group_size: int=128) -> 'QuantizedEmbedding':
+        module = cls(embedding.num_embeddings, embedding.embedding_dim, bits=bits, group_size=group_size, device=embedding.weight.device, dtype=embedding.weight.dtype)
+        (module.qweight, module.scales) = quantize_weight(embedding.weight, bits, group_size)
+        return module
+
+    def forward(self, input_ids: torch.Tensor) -> torch.Tensor:
+        flat = input_ids.reshape(-1)
+        w = dequantize_weight(self.qweight[flat], self.scales[flat], self.bits, self.activation_dtype)
+        return w.view(*input_ids.shape, self.embedding_dim)
+
+    def _apply(self, fn, *args, **kwargs):
+        self.activation_dtype = fn(torch.empty(0, dtype=self.activation_dtype)).dtype
+        return super()._apply(fn, *args, **kwargs)
+
+    def unembed(self, x: torch.Tensor) -> torch.Tensor:
+        return quantized_linear(x, self.qweight, self.scales, self.bits, rows_per_chunk=self.rows_per_chunk)
+
+    def extra_repr(self) -> str:
+        return f'{self.num_embeddings}, {self.embedding_dim}, bits={self.bits}, group_size={self.group_size}'
+
+def quantize_model(model: nn.Module, bits: int=8, group_size: int=128, empty: bool=False) -> nn.Module:
+    """Replaces the ``QUANT_TARGETS`` linears and the ``wte`` embedding of
+    ``model`` with weight-only quantized modules, in place.
+
+    With ``empty=True`` the new modules are left uninitialized so that a
+    quantized state dict can be loaded into them.
+    """
+    for module in list(model.modules()):
+        for (child_name, child) in list(module.named_children()):
+            if isinstance(child, nn.Linear) and child_name in QUANT_TARGETS:
+                if empty:
+                    new = QuantizedLinear(child.in_features, child.out_features, bias=child.bias is not None, bits=bits, group_size=group_size, device=child.weight.device)
+                else:
+                    new = QuantizedLinear.from_linear(child, bits=bits, group_size=group_size)
+            elif isinstance(child, nn.Embedding) and child_name == 'wte':
+                if empty:
+                    new = QuantizedEmbedding(child.num_embeddings, child.embedding_dim, bits=bits, group_size=group_size, device=child.weight.device, dtype=child.weight.dtype)
+                else:
+                    new = QuantizedEmbedding.from_embedding(child, bits=bits, group_size=group_size)
+            else:
+                continue
+            setattr(module, child_name, new)
+    return model
@@ -0,0 +1,109 @@
+"""Megatron-style tensor parallelism of MPT blocks across processes."""
+from typing import Callable, Dict, List, Optional, Tuple
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+import torch.nn.functional as F
+from .attention import MultiheadAttention
+TP_SHARD_RULES = {'attn.Wqkv.weight': (0, 3), 'attn.Wqkv.bias': (0, 3), 'attn.out_proj.weight': (1, 1), 'ffn.up_proj.weight': (0, 1), 'ffn.up_proj.bias': (0, 1), 'ffn.down_proj.weight': (1, 1)}
+
+class RowParallelLinear(nn.Linear):
+    """A linear whose input features are split across ranks.
+
+    Each rank multiplies its slice of the input by its slice of the weight and
+    the partial outputs are summed with an all-reduce. The bias is not split
+    and is added once, after the reduction.
+    """
+
+    def __init__(self, in_features: int, out_features: int, bias: bool=True, group: Optional[dist.ProcessGroup]=None, device=None, dtype=None):
+        super().__init__(in_features, out_features, bias=bias, device=device, dtype=dtype)
+        self.group = group
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = F.linear(x, self.weight)
+        dist.all_reduce(out, group=self.group)
+        if self.bias is not None:
+            out = out + self.bias
+        return out
+
+def shard_index(name: str, shape: Tuple[int, ...], rank: int, world_size: int) -> Optional[Tuple[int, List[Tuple[slice, ...]]]]:
+    """The dimension along which ``name`` is split and the index expressions
+    selecting ``rank``'s shard of the full tensor of ``shape``.
+
+    Returns None for tensors every rank holds in full. Fused ``Wqkv`` tensors
+    give one index per q, k and v part, to be concatenated along that dimension.
+    """
+    rule = next((rule for (suffix, rule) in TP_SHARD_RULES.items() if name.endswith(suffix)), None)
+    if rule is None:
+        return None
+    (dim, parts) = rule
+    part_size = shape[dim] // parts
+    shard_size = part_size // world_size
+    index = []
+    for part in range(parts):
+        start = part * part_size + rank * shard_size
+        index.append((slice(None),) * dim + (slice(start, start + shard_size),))
+    return (dim, index)
+
+def shard_tensor(name: str, read: Callable[..., torch.Tensor], shape: Tuple[int, ...], rank: int, world_size: int) -> torch.Tensor:
+    """Reads ``rank``'s shard of ``name`` with ``read(index)``, which may read only the slice."""
+    shard = shard_index(name, shape, rank, world_size)
+    if shard is None:
+        return read()
+    (dim, index) = shard
+    return torch.cat([read(idx) for idx in index], dim=dim)
+
+def _column_linear(linear: nn.Linear, out_features: int) -> nn.Linear:
+    return nn.Linear(linear.in_features, out_features, bias=linear.bias is not None, device=linear.weight.device, dtype=linear.weight.dtype)
+
+def _row_linear(linear: nn.Linear, in_features: int, group: Optional[dist.ProcessGroup]) -> RowParallelLinear:
+    row = RowParallelLinear(in_features, linear.out_features, bias=linear.bias is not None, group=group, device=linear.weight.device, dtype=linear.weight.dtype)
+    row._is_residual = True
+    return row
+
+def parallelize_blocks(blocks: nn.ModuleList, rank: int, world_size: int, group: Optional[dist.ProcessGroup]=None):
+    """Splits every block's attention by heads and its FFN by hidden dimension, in place.
+
+    ``Wqkv`` and ``up_proj`` keep ``rank``'s output features and ``out_proj``
+    and ``down_proj`` become ``RowParallelLinear`` over the matching input
+    features, so each block needs two all-reduces per forward. Materialized
+    weights are sliced; on the meta device only the structure changes and the
+    shards are expected to be loaded with ``load_state_dict(assign=True)``.
+    """
+    for block in blocks:
+        attn = block.attn
+        if not isinstance(attn, MultiheadAttention):
+            raise NotImplementedError(f'Tensor parallelism splits attention heads and does not support {attn.__class__.__name__}.')
+        if attn.n_heads % world_size:
+            raise ValueError(f'n_heads={attn.n_heads} is not divisible by world_size={world_size}.')
+        if getattr(attn, 'qk_ln', False):
+            raise NotImplementedError('Tensor parallelism does not support qk_ln.')
+        ffn_dim = block.ffn.up_proj.out_features
+        if ffn_dim % world_size:
+            raise ValueError(f'FFN hidden size {ffn_dim} is not divisible by world_size={world_size}.')
+        state_dict = {}
+        if not attn.Wqkv.weight.is_meta:
+            full = {f'attn.{name}': tensor for (name, tensor) in attn.state_dict().items()}
+            full.update({f'ffn.{name}': tensor for (name, tensor) in block.ffn.state_dict().items()})
+            for (name, tensor) in full.items():
+                state_dict[name] = shard_tensor(name, lambda index=None, tensor=tensor: tensor if index is None else tensor[index], tuple(tensor.shape), rank, world_size).clone()
+        local_d_model = attn.d_model // world_size
+        attn.Wqkv = _column_linear(attn.Wqkv, 3 * local_d_model)
+        attn.out_proj = _row_linear(attn.out_proj, local_d_model, group)
+        attn.n_heads //= world_size
+        attn.d_model = local_d_model
+        block.ffn.up_proj = _column_linear(block.ffn.up_proj, ffn_dim // world_size)
+        block.ffn.down_proj = _row_linear(block.ffn.down_proj, ffn_dim // world_size, group)
+        if state_dict:
+            block.attn.load_state_dict({name[len('attn.'):]: t for (name, t) in state_dict.items() if name.startswith('attn.')}, assign=True)
+            block.ffn.load_state_dict({name[len('ffn.'):]: t for (name, t) in state_dict.items() if name.startswith('ffn.')}, assign=True)
+
+def load_sharded_state_dict(readers: Dict[str, Callable[..., torch.Tensor]], shapes: Dict[str, Tuple[int, ...]], rank: int, world_size: int, dtype: Optional[torch.dtype]=None) -> Dict[str, torch.Tensor]:
+    """Reads ``rank``'s shard of every tensor in ``readers``, keyed like ``shapes``."""
+    state_dict = {}
+    for (name, reader) in readers.items():
+        tensor = shard_tensor(name, reader, shapes[name], rank, world_size)
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        state_dict[name] = tensor.contiguous()
+    return state_dict
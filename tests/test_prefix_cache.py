@@ -0,0 +1,114 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app import prefix_cache  # noqa: E402
+from app.prefix_cache import PrefixKVCache  # noqa: E402
+
+# One layer with one channel: every cached token costs 8 bytes of K and V
+TOKEN_BYTES = 8
+
+
+@pytest.fixture(autouse=True)
+def _clock(monkeypatch):
+    # Distinct access times, so LRU order does not depend on the clock's resolution
+    ticks = itertools.count()
+    monkeypatch.setattr(prefix_cache, "time", SimpleNamespace(monotonic=lambda: next(ticks)))
+
+
+def _kv(*values):
+    # K/V whose entries tag where each position came from
+    t = torch.tensor(values, dtype=torch.float32).view(1, -1, 1)
+    return [(t, -t)]
+
+
+def _keys(kv):
+    return kv[0][0].view(-1).tolist()
+
+
+def test_lookup_miss():
+    cache = PrefixKVCache(max_bytes=1024)
+    matched, kv, handle = cache.lookup([1, 2, 3])
+    cache.release(handle)
+    assert (matched, kv) == (0, None)
+
+
+def test_lookup_partial_prefix():
+    cache = PrefixKVCache(max_bytes=1024)
+    cache.insert([1, 2, 3, 4], _kv(0, 1, 2, 3))
+    matched, kv, handle = cache.lookup([1, 2, 3, 9])
+    cache.release(handle)
+    assert matched == 3
+    assert _keys(kv) == [0, 1, 2]
+    assert kv[0][1].view(-1).tolist() == [0, -1, -2]
+
+
+def test_insert_splits_a_shared_edge():
+    cache = PrefixKVCache(max_bytes=1024)
+    cache.insert([1, 2, 3, 4], _kv(0, 1, 2, 3))
+    cache.insert([1, 2, 5, 6], _kv(10, 11, 12, 13))
+    assert cache.nbytes == 6 * TOKEN_BYTES
+    for tokens, keys in [([1, 2, 3, 4], [0, 1, 2, 3]), ([1, 2, 5, 6], [0, 1, 12, 13])]:
+        matched, kv, handle = cache.lookup(tokens)
+        cache.release(handle)
+        assert matched == 4
+        assert _keys(kv) == keys
+
+
+def test_insert_after_a_cached_prefix():
+    cache = PrefixKVCache(max_bytes=1024)
+    cache.insert([1, 2], _kv(0, 1))
+    cache.insert([1, 2, 3], _kv(2), start=2)
+    matched, kv, handle = cache.lookup([1, 2, 3])
+    cache.release(handle)
+    assert matched == 3
+    assert _keys(kv) == [0, 1, 2]
+
+
+def test_evicts_least_recently_used_leaf():
+    cache = PrefixKVCache(max_bytes=6 * TOKEN_BYTES)
+    cache.insert([1, 2, 3], _kv(0, 1, 2))
+    cache.insert([4, 5, 6], _kv(0, 1, 2))
+    cache.release(cache.lookup([1, 2, 3])[2])
+    cache.insert([7, 8], _kv(0, 1))
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.lookup([1, 2, 3])[0] == 3
+    assert cache.lookup([4, 5, 6])[0] == 0
+
+
+def test_split_keeps_a_held_path_alive():
+    cache = PrefixKVCache(max_bytes=6 * TOKEN_BYTES)
+    cache.insert([1, 2, 3, 4], _kv(0, 1, 2, 3))
+    _, _, handle = cache.lookup([1, 2, 3, 4])
+    # Splits the edge the handle holds into [1, 2] and [3, 4]
+    cache.insert([1, 2, 5, 6], _kv(0, 1, 2, 3))
+    cache.insert([7, 8, 9], _kv(0, 1, 2))
+    assert cache.nbytes <= cache.max_bytes
+    matched, kv, held_again = cache.lookup([1, 2, 3, 4])
+    cache.release(held_again)
+    assert matched == 4
+    assert _keys(kv) == [0, 1, 2, 3]
+    # Once released, the split halves are evictable again
+    cache.max_bytes = 0
+    cache.release(handle)
+    assert cache.nbytes == 0
+    assert cache.lookup([1, 2, 3, 4])[0] == 0
+
+
+def test_save_and_load(tmp_path):
+    cache = PrefixKVCache(max_bytes=1024)
+    cache.insert([1, 2, 3, 4], _kv(0, 1, 2, 3))
+    cache.insert([1, 2, 5], _kv(0, 1, 7))
+    path = str(tmp_path / "prefix.pt")
+    cache.save(path)
+    loaded = PrefixKVCache(max_bytes=1024)
+    loaded.load(path)
+    assert loaded.nbytes == cache.nbytes
+    for tokens in ([1, 2, 3, 4], [1, 2, 5]):
+        matched, kv, handle = loaded.lookup(tokens)
+        loaded.release(handle)
+        assert matched == len(tokens)
+        assert _keys(kv) == _keys(cache.lookup(tokens)[1])
@@ -0,0 +1,135 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from app.stopping import (  # noqa: E402
+    COMPLETE,
+    INCOMPLETE,
+    INVALID,
+    CodeStoppingCriteria,
+    StopStringMatcher,
+    python_status,
+    token_pieces,
+)
+
+FENCE = "\n```\n"
+
+
+class _Tokenizer:
+    all_special_ids = [0]
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def convert_ids_to_tokens(self, ids):
+        return [self.tokens[i] for i in ids]
+
+
+def _feed(matcher, token_ids):
+    state, result = 0, None
+    for token_id in token_ids:
+        state, end, length = matcher.step(state, token_id)
+        result = (end, length)
+    return result
+
+
+def _generate(criteria, prompt, generated, pieces):
+    # Calls the criteria after every token, as the decode loop does, and returns the kept text
+    ids = [pieces.index(p) for p in prompt + generated]
+    for step in range(len(prompt) + 1, len(ids) + 1):
+        done = criteria(torch.tensor([ids[:step]]))
+        if done.all():
+            break
+    (keep,), (drop,) = criteria.keep, criteria.drop
+    text = "".join(generated[: len(generated) if keep is None else keep])
+    return done.tolist(), text[: len(text) - drop]
+
+
+def test_token_pieces():
+    tokenizer = _Tokenizer(["<|endoftext|>", "▁os", "<0x0A>", "<0xE2>"])
+    assert token_pieces(tokenizer) == ["", " os", "\n", "�"]
+
+
+def test_matcher_matches_across_tokens():
+    pieces = ["\n", "```", "x"]
+    matcher = StopStringMatcher([FENCE], pieces)
+    assert _feed(matcher, [0, 1]) == (-1, 0)
+    assert _feed(matcher, [0, 1, 0]) == (1, len(FENCE))
+
+
+def test_matcher_matches_inside_one_token():
+    pieces = ["foo\nTask: bar"]
+    matcher = StopStringMatcher(["\nTask:"], pieces)
+    assert _feed(matcher, [0]) == (9, 6)
+
+
+def test_matcher_follows_fail_links():
+    # After "ab" the trie expects "d"; "c" has to fall back to the "b" of "bc"
+    pieces = ["a", "b", "c", "d"]
+    matcher = StopStringMatcher(["abd", "bc"], pieces)
+    assert _feed(matcher, [0, 1, 2]) == (1, 2)
+    assert _feed(matcher, [0, 1, 3]) == (1, 3)
+
+
+def test_matcher_inert_tokens_reset_the_match():
+    pieces = ["\n", "```", "xyz"]
+    matcher = StopStringMatcher([FENCE], pieces)
+    assert matcher.inert == [False, False, True]
+    state, _, _ = matcher.step(0, 0)
+    state, _, _ = matcher.step(state, 1)
+    assert state != 0
+    assert matcher.step(state, 2) == (0, -1, 0)
+
+
+@pytest.mark.parametrize(
+    "source, status",
+    [
+        ("x = 1\n", COMPLETE),
+        ("def f():\n    return 1\n", COMPLETE),
+        ("def f():\n", INCOMPLETE),
+        ("x = (1,\n", INCOMPLETE),
+        ("x = 1\n```\n", INVALID),
+        ("Here is the app:\n", INVALID),
+    ],
+)
+def test_python_status(source, status):
+    assert python_status(source) == status
+
+
+def test_stop_string_cut_inside_a_token():
+    pieces = ["Task", "import", " os", "\n", "print", "(x)\n", "```\n"]
+    criteria = CodeStoppingCriteria(StopStringMatcher([FENCE], pieces), prompt_len=1)
+    done, text = _generate(criteria, ["Task"], ["import", " os", "\n", "print", "(x)\n", "```\n"], pieces)
+    assert done == [True]
+    assert criteria.keep == [5]
+    assert criteria.drop == [1]
+    assert text == "import os\nprint(x)"
+
+
+def test_opening_fence_does_not_stop():
+    pieces = ["Task", FENCE, "x = 1"]
+    criteria = CodeStoppingCriteria(StopStringMatcher([FENCE], pieces), prompt_len=1)
+    done, text = _generate(criteria, ["Task"], [FENCE, "x = 1", FENCE], pieces)
+    assert done == [True]
+    assert text == FENCE + "x = 1"
+
+
+def test_complete_program_cut_inside_a_token():
+    pieces = ["Task", "Sure:", "\n", "x = 1", "print(x)", "\nHere is", " the app"]
+    criteria = CodeStoppingCriteria(StopStringMatcher([], pieces), prompt_len=1, check_python=True)
+    generated = ["Sure:", "\n", "x = 1", "\n", "print(x)", "\nHere is", " the app", "\n"]
+    done, text = _generate(criteria, ["Task"], generated, pieces)
+    assert done == [True]
+    assert text == "Sure:\nx = 1\nprint(x)\n"
+
+
+def test_rows_stop_independently():
+    pieces = ["Task", "x = 1", FENCE, "\n"]
+    criteria = CodeStoppingCriteria(StopStringMatcher([FENCE], pieces), prompt_len=1)
+    criteria(torch.tensor([[0, 1], [0, 1]]))
+    done = criteria(torch.tensor([[0, 1, 2], [0, 1, 3]]))
+    assert done.tolist() == [True, False]
+    assert criteria.keep == [1, None]